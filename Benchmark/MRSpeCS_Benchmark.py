@@ -0,0 +1,249 @@
+#!/usr/bin/python
+#
+# MRSpeCS_Benchmark - timing benchmark of MRSpeCS without patient data
+#
+# generates synthetic T1 phantoms (head with scalp, skull, CSF, GM, WM and
+# ventricles) at several resolutions with SPAR files for a range of voxel
+# angulations, runs MRSpeCS on every phantom (all spectro voxels in one run)
+# with the FSL stand-ins of MRSpeCS_Standins.py (or the real FSL with --fsl)
+# and reports the per stage and end-to-end timings (median of --repeat runs,
+# see MRSpeCS_Profile.py)
+# the timings are compared with a stored baseline: a stage that is more than
+# --tolerance slower (and at least 0.05s) or changed fractions are reported
+# as regressions (exit code 1), --save-baseline stores the current timings
+# baselines are machine specific and not part of the repository, store one
+# with --save-baseline on the machine that runs the checks
+#
+# ----- VERSION HISTORY -----
+#
+# Version 0.1 - 18, October 2026
+#       - initial version
+#
+# ----- LICENSE -----
+#
+#    GPL, see details inside MRSpeCS.py
+#
+# ----- REQUIREMENTS -----
+#
+#    numpy, MRSpeCS.py and its modules (from the directory above)
+#    Linux or MacOS (the FSL stand-ins are found via FSLDIR)
+#
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import platform
+from getopt import getopt
+import numpy as np
+benchdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(benchdir))
+import MRSpeCS
+from MRSpeCS_Nifti import set_field, mat44_to_quatern
+from MRSpeCS_Standins import tools
+
+
+resolutions = [1.0, 0.8, 0.5] # [mm]
+field_of_view = (160., 192., 160.) # LR, AP, FH [mm]
+# spectro voxels: (AP, LR, FH) angulation [degrees], all 20mm cubes around the same center
+angulations = [(0., 0., 0.), (15., 0., 0.), (0., -20., 0.), (0., 0., 25.),
+               (10., -15., 20.), (-30., 25., -10.)]
+offcenter = (10., -15., 20.) # AP, LR, FH [mm]
+baseline_file = os.path.join(benchdir, 'MRSpeCS_Benchmark_Baseline.json')
+tolerance = 0.25 # allowed relative slowdown per stage
+min_delta = 0.05 # [s] smaller slowdowns are noise
+fraction_tolerance = 1e-4
+
+
+def write_nifti (filename, data, affine):
+    # new single file NIFTI, int16, qform and sform = affine (scanner anat)
+    header = bytearray(348); endian = '<'
+    set_field(header, endian, 'sizeof_hdr', 348)
+    set_field(header, endian, 'dim', [3]+list(data.shape)+[1,1,1,1])
+    set_field(header, endian, 'datatype', 4)
+    set_field(header, endian, 'bitpix', 16)
+    quatern, qoffset, qfac = mat44_to_quatern(affine)
+    pixdim = [qfac]+list(np.sqrt((affine[0:3,0:3]**2).sum(axis=0)))+[0.,0.,0.,0.]
+    set_field(header, endian, 'pixdim', pixdim)
+    set_field(header, endian, 'vox_offset', 352.)
+    set_field(header, endian, 'scl_slope', 1.)
+    header[123] = 10 # xyzt_units: mm, s
+    set_field(header, endian, 'qform_code', 1)
+    set_field(header, endian, 'sform_code', 1)
+    set_field(header, endian, 'quatern', quatern)
+    set_field(header, endian, 'qoffset', qoffset)
+    for i, name in enumerate(('srow_x','srow_y','srow_z')): set_field(header, endian, name, list(affine[i,:]))
+    set_field(header, endian, 'magic', b'n+1\x00')
+    f = open(filename, 'wb')
+    try:
+        f.write(bytes(header)); f.write(b'\x00\x00\x00\x00')
+        f.write(data.astype('<i2').tobytes(order='F'))
+    finally: f.close()
+def make_phantom (filename, resolution, seed=0):
+    # synthetic T1 head, radiological orientation (as dcm2nii "o" files after -x)
+    shape = [int(round(size/resolution)) for size in field_of_view]
+    x, y, z = [(np.arange(shape[i], dtype=np.float32)-shape[i]/2.)*resolution for i in range(3)]
+    x = x[:,None,None]; y = y[None,:,None]; z = z[None,None,:]
+    # depth below the head surface [mm], approximated from the ellipsoid radius
+    depth = (1.-np.sqrt((x/70.)**2+(y/90.)**2+(z/75.)**2))*78.
+    data = np.zeros(shape, dtype=np.float32)
+    for start, value in [(0., 120.), (5., 20.), (10., 40.), (13., 70.), (18., 100.)]: # scalp .. WM
+        data[depth>=start] = value
+    ventricles = ((np.abs(x)-8.)/6.)**2+(y/25.)**2+((z-10.)/12.)**2<1.
+    data[ventricles] = 40.
+    del depth, ventricles
+    noise = np.random.RandomState(seed).normal(0., 3., shape).astype(np.float32)
+    data[data>0] += noise[data>0]
+    affine = np.diag([-resolution, resolution, resolution, 1.])
+    affine[0:3,3] = [shape[0]/2.*resolution, -shape[1]/2.*resolution, -shape[2]/2.*resolution]
+    write_nifti(filename, np.clip(data, 0, None), affine)
+    return shape
+def write_spar (filename, angulation, size=20.):
+    # the geometry fields of a Philips SPAR file
+    f = open(filename, 'w')
+    for name in ('ap_size', 'lr_size', 'cc_size'): f.write(name+' : '+str(size)+'\n')
+    for name, value in zip(('ap_off_center', 'lr_off_center', 'cc_off_center'), offcenter):
+        f.write(name+' : '+str(value)+'\n')
+    for name, value in zip(('ap_angulation', 'lr_angulation', 'cc_angulation'), angulation):
+        f.write(name+' : '+str(value)+'\n')
+    f.close()
+def install_standins (directory):
+    # launchers named like the FSL tools in <directory>/bin, returns FSLDIR
+    bindir = os.path.join(directory, 'bin')
+    if not os.path.isdir(bindir): os.makedirs(bindir)
+    for tool in tools:
+        f = open(os.path.join(bindir, tool), 'w')
+        f.write('#!'+sys.executable+'\n')
+        f.write('import sys\nsys.path.insert(0, '+repr(benchdir)+')\n')
+        f.write('from MRSpeCS_Standins import main\nmain('+repr(tool)+')\n')
+        f.close()
+        os.chmod(os.path.join(bindir, tool), 0o755)
+    return directory
+
+
+def flatten (nodes, path='', timings=None):
+    # {'stage/tool': duration} from the nested timings of run_mrspecs
+    if timings==None: timings = {}
+    for node in nodes:
+        name = path+node['name']
+        if node['duration']!=None: timings[name] = timings.get(name, 0.)+node['duration']
+        flatten(node['children'], name+'/', timings)
+    return timings
+def run_case (image, spectro, outdir, options):
+    # one run_mrspecs, console output suppressed, returns (timings, fractions)
+    if os.path.isdir(outdir): shutil.rmtree(outdir)
+    os.makedirs(outdir)
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try: results = MRSpeCS.run_mrspecs(image, spectro, outdir, options)
+    finally: MRSpeCS.close_log(); sys.stdout.close(); sys.stdout = stdout
+    fractions = dict([(os.path.basename(voxel['Spectro_File']), [voxel['CSF'], voxel['GM'], voxel['WM']])
+                      for voxel in results['voxels']])
+    return flatten(results['timings']), fractions
+def benchmark (workdir, resolutions, repeat, options):
+    # {resolution: {'shape', 'timings' (median per stage), 'fractions'}}
+    results = {}
+    for resolution in resolutions:
+        key = '%.1f' % resolution
+        casedir = os.path.join(workdir, 'phantom_'+key)
+        specdir = os.path.join(casedir, 'spectro')
+        if not os.path.isdir(specdir): os.makedirs(specdir)
+        image = os.path.join(casedir, 'T1_phantom.nii')
+        start = time.time()
+        shape = make_phantom(image, resolution)
+        for index, angulation in enumerate(angulations):
+            write_spar(os.path.join(specdir, 'voxel%d.SPAR' % (index+1)), angulation)
+        print ('phantom %s mm %s voxels (%.1fs)' % (key, 'x'.join([str(size) for size in shape]), time.time()-start))
+        runs = []
+        for iteration in range(repeat):
+            timings, fractions = run_case(image, specdir, os.path.join(casedir, 'out'), options)
+            runs.append(timings)
+            print ('   run %d: %.2fs' % (iteration+1, timings['case']))
+        median = dict([(name, float(np.median([run.get(name, 0.) for run in runs]))) for name in runs[0]])
+        results[key] = {'shape': shape, 'timings': median, 'fractions': fractions}
+    return results
+def report (results, baseline=None):
+    # prints the timings (and the baseline), returns the list of regressions
+    regressions = []
+    for key in sorted(results, key=float, reverse=True):
+        timings = results[key]['timings']
+        reference = {}
+        if baseline!=None and key in baseline['results']: reference = baseline['results'][key]['timings']
+        print ('')
+        print ('%s mm %s' % (key, 'x'.join([str(size) for size in results[key]['shape']])))
+        print ('   %-32s %9s %9s' % ('stage', 'time [s]', 'baseline'))
+        for name in sorted(timings, key=lambda name: (name!='case', name)):
+            line = '   %-32s %9.3f' % (name, timings[name])
+            if name in reference:
+                line += ' %9.3f' % reference[name]
+                if timings[name]>reference[name]*(1.+tolerance) and timings[name]-reference[name]>min_delta:
+                    line += '  REGRESSION'; regressions.append(key+' mm '+name)
+            print (line)
+        if baseline!=None and key in baseline['results']:
+            expected = baseline['results'][key]['fractions']
+            for name in sorted(results[key]['fractions']):
+                if not name in expected: continue
+                difference = max([abs(a-b) for a, b in zip(results[key]['fractions'][name], expected[name])])
+                if difference>fraction_tolerance:
+                    print ('   %s: fractions differ from the baseline by %.6f  REGRESSION' % (name, difference))
+                    regressions.append(key+' mm '+name+' fractions')
+    return regressions
+
+
+def main ():
+    global tolerance
+    opts, args = getopt(sys.argv[1:], 'h', ['help', 'resolutions=', 'repeat=', 'workdir=', 'baseline=',
+                                            'save-baseline', 'tolerance=', 'pvbox', 'fsl', 'keep'])
+    argDict = dict(opts)
+    if '-h' in argDict or '--help' in argDict or len(args)>0:
+        print ('Usage: MRSpeCS_Benchmark.py [--resolutions=1,0.8,0.5] [--repeat=3] [--workdir=<path>]')
+        print ('                            [--baseline=<file>] [--save-baseline] [--tolerance=0.25]')
+        print ('                            [--pvbox] [--fsl] [--keep]')
+        print ('   --fsl  : use the FSL installation in FSLDIR instead of the stand-ins')
+        print ('   --keep : keep the phantoms and outputs in the work directory')
+        return 0
+    selected = resolutions
+    if '--resolutions' in argDict: selected = [float(value) for value in argDict['--resolutions'].split(',')]
+    repeat = int(argDict.get('--repeat', 3))
+    baseline = argDict.get('--baseline', baseline_file)
+    if '--tolerance' in argDict: tolerance = float(argDict['--tolerance'])
+    if sys.platform=="win32": print ('ERROR:  the benchmark needs Linux or MacOS'); return 2
+    workdir = argDict.get('--workdir', '')
+    if workdir=='': workdir = tempfile.mkdtemp(prefix='MRSpeCS_Benchmark')
+    workdir = os.path.abspath(workdir)
+    toolset = 'stand-ins'
+    if '--fsl' in argDict: toolset = 'FSL'
+    else: os.environ['FSLDIR'] = install_standins(os.path.join(workdir, 'fsl'))
+    options = {'pvbox': '--pvbox' in argDict}
+    print ('MRSpeCS '+MRSpeCS.Program_version+' benchmark with '+toolset+', work directory '+workdir)
+    try: results = benchmark(workdir, selected, repeat, options)
+    except MRSpeCS.MRSpeCSError as error: print ('ERROR:  '+error.message); return 1
+    finally:
+        if not '--keep' in argDict and not '--workdir' in argDict: shutil.rmtree(workdir, ignore_errors=True)
+    stored = None
+    if os.path.isfile(baseline) and not '--save-baseline' in argDict:
+        stored = json.load(open(baseline))
+        if stored['tools']!=toolset or stored['options']!=options:
+            print ('WARNING: baseline recorded with '+stored['tools']+' '+str(stored['options'])+', not compared')
+            stored = None
+    regressions = report(results, stored)
+    if '--save-baseline' in argDict:
+        f = open(baseline, 'w')
+        json.dump({'version': MRSpeCS.Program_version, 'tools': toolset, 'options': options,
+                   'machine': platform.platform()+', Python '+platform.python_version(),
+                   'repeat': repeat, 'results': results}, f, indent=1, sort_keys=True)
+        f.close()
+        print ('\nBaseline written to '+baseline)
+    elif stored!=None:
+        print ('\nBaseline: '+stored['machine']+', MRSpeCS '+stored['version'])
+        if len(regressions)>0:
+            print (str(len(regressions))+' regressions: '+', '.join(regressions)); return 1
+        print ('no regressions')
+    else: print ('\nNo baseline '+baseline+', store one with --save-baseline')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
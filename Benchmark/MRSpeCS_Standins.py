@@ -0,0 +1,132 @@
+#
+# MRSpeCS_Standins - lightweight stand-ins for the FSL tools used by MRSpeCS
+#
+# for benchmarking the MRSpeCS orchestration without a full FSL install,
+# the results are NOT a brain extraction or segmentation, only files with
+# the names, datatypes and geometry that the real tools write:
+#    fslswapdim  in -x y z out          flips X, as dcm2nii "o" -> radiological
+#    bet2        in out                 zeroes voxels below 10% of the robust maximum
+#    fast        [options] in           3 class fuzzy k-means on the intensities,
+#                                       writes in_pve_0/1/2.nii (CSF/GM/WM)
+#    flirt       -in a -ref b -out c    copies the input (-applyxfm only)
+#    fslorient   -getqform/-getsform    prints the matrix, other options are ignored
+#    fslhd       in                     prints dims, pixdims and the orientation
+#    fslmaths    in [-thr v] [-bin] [-mul v|file] out
+#    fslmeants   -i in -m mask          prints the mean of in inside mask
+# MRSpeCS_Benchmark.py writes small launchers named like the tools into
+# <workdir>/fsl/bin that call main(<tool name>)
+#
+# ----- VERSION HISTORY -----
+#
+# Version 0.1 - 18, October 2026
+#       - initial version
+#
+# ----- LICENSE -----
+#
+#    GPL, see details inside MRSpeCS.py
+#
+# ----- REQUIREMENTS -----
+#
+#    numpy, MRSpeCS_Nifti.py (from the directory above)
+#
+
+from __future__ import print_function
+import os
+import sys
+import shutil
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from MRSpeCS_Nifti import read_header, get_field, set_field, write_volume, read_subvolume
+from MRSpeCS_Nifti import mat44_to_quatern, NiftiHeader
+
+
+def _nii (filename): # FSL adds the extension if missing (FSLOUTPUTTYPE=NIFTI)
+    if filename.endswith('.nii'): return filename
+    return filename+'.nii'
+def _read (filename): # all voxels, scaled (float64)
+    return read_subvolume(filename, (0,0,0), NiftiHeader(filename).dims)
+def _set_affine (filename, mat): # qform and sform of filename (in place)
+    header, endian = read_header(filename)
+    quatern, qoffset, qfac = mat44_to_quatern(mat)
+    pixdim = list(get_field(header, endian, 'pixdim')); pixdim[0] = qfac
+    set_field(header, endian, 'pixdim', pixdim)
+    set_field(header, endian, 'quatern', quatern)
+    set_field(header, endian, 'qoffset', qoffset)
+    for i, name in enumerate(('srow_x','srow_y','srow_z')): set_field(header, endian, name, list(mat[i,:]))
+    f = open(filename, 'r+b')
+    try: f.write(bytes(header))
+    finally: f.close()
+
+
+def fslswapdim (arguments):
+    source, target = arguments[0], _nii(arguments[-1])
+    if arguments[1:4]!=['-x','y','z']: raise ValueError('only "-x y z" is supported')
+    info = NiftiHeader(source)
+    data = _read(source)[::-1,:,:].astype(np.int16)
+    flip = np.diag([-1.,1.,1.,1.]); flip[0,3] = info.dims[0]-1
+    write_volume(target, data, source)
+    _set_affine(target, np.dot(info.qform, flip))
+def bet2 (arguments):
+    source, target = arguments[0], _nii(arguments[1])
+    if source.endswith('.hdr'): raise ValueError('ANALYZE is not supported')
+    data = _read(source)
+    threshold = 0.1*np.percentile(data[data>0], 98)
+    data[data<threshold] = 0
+    write_volume(target, data.astype(np.int16), source)
+def fast (arguments):
+    source = arguments[-1]
+    data = _read(source).astype(np.float32)
+    values = data[data>0]
+    values = values[::max(1, len(values)//1000000)] # class means from a sample
+    means = np.percentile(values, [10., 50., 90.]) # CSF < GM < WM in T1
+    for iteration in range(10): # fuzzy c-means, fuzziness 2
+        weights = 1./(np.array([(values-mean)**2 for mean in means])+1e-6)
+        membership = weights/weights.sum(axis=0)
+        means = (membership**2*values).sum(axis=1)/(membership**2).sum(axis=1)
+    for i in range(3): # one map and a slab of slices at a time
+        pve = np.zeros(data.shape, dtype=np.float32)
+        for z in range(0, data.shape[2], 16):
+            slab = data[:,:,z:z+16]
+            weights = 1./(np.array([(slab-mean)**2 for mean in means], dtype=np.float32)+1e-6)
+            pve[:,:,z:z+16] = np.where(slab>0, weights[i]/weights.sum(axis=0), 0.)
+        write_volume(os.path.splitext(source)[0]+'_pve_'+str(i)+'.nii', pve, source)
+def flirt (arguments):
+    shutil.copyfile(arguments[arguments.index('-in')+1], _nii(arguments[arguments.index('-out')+1]))
+def fslorient (arguments):
+    if arguments[0] in ('-getqform', '-getsform'):
+        info = NiftiHeader(arguments[-1])
+        mat = info.qform if arguments[0]=='-getqform' else info.sform
+        print (' '.join(['%g' % value for value in mat.flatten()])+' ')
+def fslhd (arguments):
+    info = NiftiHeader(arguments[-1])
+    for i in range(3): print ('dim'+str(i+1)+'\t\t'+str(info.dims[i]))
+    for i in range(3): print ('pixdim'+str(i+1)+'\t\t'+'%.6f' % info.pixdims[i])
+    print ('qform_name\t'+info.qform_name)
+    for i, name in enumerate(('qform_xorient','qform_yorient','qform_zorient')): print (name+'\t'+info.qform_orient[i])
+    print ('sform_name\t'+info.sform_name)
+    for i, name in enumerate(('sform_xorient','sform_yorient','sform_zorient')): print (name+'\t'+info.sform_orient[i])
+def fslmaths (arguments):
+    source, target = arguments[0], _nii(arguments[-1])
+    data = _read(source); options = arguments[1:-1]
+    while len(options)>0:
+        option = options.pop(0)
+        if option=='-thr': data[data<float(options.pop(0))] = 0.
+        elif option=='-bin': data = (data!=0).astype(np.float64)
+        elif option=='-mul':
+            value = options.pop(0)
+            if os.path.isfile(value) or os.path.isfile(value+'.nii'): data = data*_read(_nii(value))
+            else: data = data*float(value)
+        else: raise ValueError('unsupported option '+option)
+    write_volume(target, data.astype(np.float32), source)
+def fslmeants (arguments):
+    data = _read(arguments[arguments.index('-i')+1])
+    mask = _read(arguments[arguments.index('-m')+1])
+    print ('%.6f ' % data[mask!=0].mean())
+
+
+tools = {'fslswapdim': fslswapdim, 'bet2': bet2, 'fast': fast, 'flirt': flirt, 'fslorient': fslorient,
+         'fslhd': fslhd, 'fslmaths': fslmaths, 'fslmeants': fslmeants}
+def main (tool):
+    try: tools[tool](sys.argv[1:])
+    except Exception as error:
+        print (tool+' (stand-in): '+str(error), file=sys.stderr); sys.exit(1)
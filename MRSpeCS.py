@@ -116,7 +116,10 @@
 #   tested in the FSL v5 Virtual machine under CentOS 6.3 (with Python 2.6.6)
 #   requires dcm2nii to be copied to FSL binary dir (usually /usr/local/fsl/bin)
 #
-#   For basic operation no additional Python libraries are required.
+#   For basic operation the numpy library is required 
+#   (to install try "yum install python-pip" then "pip install numpy")
+#   together with the supplied MRSpeCS_Geometry.py and MRSpeCS_Nifti.py
+#   (MRSpeCS_Cache.py and MRSpeCS_Profile.py are also required, standard library only)
 #   To interactively choose input file python tkinter is required 
 #   (if not already installed try "yum install tkinter")
 #   To read spectro files in DICOM format pydicom is required 
@@ -124,8 +127,8 @@
 #      or see http://pydicom.readthedocs.io/en/stable/getting_started.html 
 #     
 #   The program requires the following external files from FSL:
-#      avscale.exe, fslhd.exe, fslmaths.exe, fslmeants.exe, fslorient.exe,
-#      fslswapdim.exe, bet2.exe, convert_xfm.exe, fast.exe, flirt.exe
+#      fslswapdim.exe, bet2.exe, fast.exe,
+#      fslorient.exe, flirt.exe (debug mode only)
 #      cygwin1.dll (windows only)
 #   For Windows the above files are included from the old FSL v3.3.7 distribution
 #   running on Cygwin 1.5.18, source code is still available at 
@@ -152,7 +155,6 @@ Program_version = "v0.8" # program version
 
 
 import sys
-import math
 import os
 import signal
 import random
@@ -160,30 +162,34 @@ import shutil
 import subprocess
 import time
 import datetime
+import csv
+import multiprocessing
+import threading
+import errno
+try: import queue # Python3
+except: import Queue as queue # Python2
 from getopt import getopt
 from getopt import GetoptError
 from distutils.version import LooseVersion
-try: from MRSpeCS_Report import MRSpeCS_Report
+try: from MRSpeCS_Report import report_images, report_document, report_views, report_thumbnails, MRSpeCS_Summary
 except: pass
-
-
-TK_installed=True
-try: from tkFileDialog import askopenfilename # Python 2
-except: 
-  try: from tkinter.filedialog import askopenfilename; # Python3
-  except: TK_installed=False
-try: import Tkinter as tk; # Python2
-except: 
-  try: import tkinter as tk; # Python3
-  except: TK_installed=False
+numpy_installed=True
+try: 
+    import numpy as np
+    from MRSpeCS_Geometry import SpectroGeometry, measure_boxes
+    from MRSpeCS_Nifti import write_volume, reset_orientation, header_info, header_forget, memmap_volume, header_differences
+    from MRSpeCS_Nifti import nonzero_bounds, crop_volume, uncrop_volume, downsample_volume, set_display_range
+except: numpy_installed=False
+from MRSpeCS_Cache import cache_key, cache_get, cache_put, cache_evict
+from MRSpeCS_Profile import profile_reset, profile_stop, profile_begin, profile_end, profile_tree
+from MRSpeCS_Profile import tool_usage, write_profile, trace_filename
+try: import resource # unix only
+except ImportError: resource = None
 
 FNULL = open(os.devnull, 'w')
 old_target, sys.stderr = sys.stderr, FNULL # replace sys.stdout 
-pydicom_installed=False
-try: import dicom; pydicom_installed=True  # <v1.0
-except: pass
-try: import pydicom as dicom; pydicom_installed=True#  >v1.0
-except: pass
+from MRSpeCS_Dicom import spectro_header, spectro_header_forget, SpectroDicomError, dicom # header only reading
+pydicom_installed = dicom!=None
 sys.stderr = old_target # re-enable
 
 pywin32_installed=True
@@ -191,27 +197,53 @@ try: import win32console, win32gui, win32con
 except: pywin32_installed=True
 
 
+class MRSpeCSError(Exception):
+    # raised by run_mrspecs (via exit) after the error was reported with lprint,
+    # message is the last message printed, code the exit code of the command line program
+    def __init__(self, message, code):
+        Exception.__init__(self, message)
+        self.message = message
+        self.code = code
+
+
 def exit (code):
-    # cleanup 
-    try: shutil.rmtree(tempdir)
-    except: pass # silent
-    if pywin32_installed:
-        try: # reenable console windows close button (useful if called command line or batch file)
-            hwnd = win32console.GetConsoleWindow()
-            hMenu = win32gui.GetSystemMenu(hwnd, False)
-            win32gui.EnableMenuItem(hMenu, win32con.SC_CLOSE, win32con.MF_ENABLED)
-        except: pass #silent
-    sys.exit(code)
+    # cleanup, the command line program exits with code (see main)
+    # (off the main thread cleanup is left to run_stages and run_mrspecs)
+    global tempdir
+    if threading.current_thread().name!='MainThread': raise MRSpeCSError(last_message, code)
+    if tempdir:
+        try: shutil.rmtree(tempdir)
+        except: pass # silent
+    tempdir = ''
+    raise MRSpeCSError(last_message, code)
 def signal_handler(signal, frame):
     lprint ('User abort')
     exit(1)
 def logwrite(message): 
-    sys.stderr.write(datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S"))
-    sys.stderr.write(' ('+ID+') - '+message+'\n')
-    sys.stderr.flush()   
+    logfile.write(datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S"))
+    logfile.write(' ('+ID+') - '+message+'\n')
+    logfile.flush()   
 def lprint (message):
+    global last_message
     print (message)
     logwrite(message)
+    last_message = message
+def open_log (directory):
+    # append to <directory>/<Program_name>.log, kept open for following runs to the same directory
+    # (directory is created if missing, e.g. a new output directory of a batch case)
+    global logfile, logname
+    filename = os.path.join(directory, Program_name+'.log')
+    if filename == logname: return
+    close_log()
+    if not os.path.isdir(directory):
+        try: os.makedirs(directory)
+        except: lprint ('ERROR:  Problem creating output directory '+directory); exit(2)
+    try: logfile = open(filename, 'a'); logname = filename
+    except: lprint ('ERROR:  Problem opening logfile: '+filename); exit(2)
+def close_log ():
+    global logfile, logname
+    if logname: logfile.close()
+    logfile = sys.__stderr__; logname = ''
 def checkfile(file): # generic check if file exists
     if not os.path.isfile(file): 
         lprint ('ERROR:  File "'+file+'" not found '); exit(1)
@@ -229,20 +261,126 @@ def copy (fromfile, tofile):
     delete (tofile)   
     try: shutil.copy2(fromfile, tofile)
     except: lprint ('ERROR:  Unable to copy file '+fromfile); exit(1)     
-def run (command, parameters):
+def publish_file (fromfile, tofile):
+    # moves fromfile to tofile, tofile appears complete or not at all:
+    # rename (same filesystem), otherwise copy to a hidden file next to
+    # tofile and rename that, returns the method used
+    replace = getattr(os, 'replace', None) # python 3.3+, overwrites on windows too
+    if replace==None: delete (tofile); replace = os.rename
+    try: replace(fromfile, tofile); return 'rename'
+    except OSError as error:
+        if error.errno!=errno.EXDEV: raise # only other filesystems are copied
+    partial = os.path.join(os.path.dirname(tofile), '.'+os.path.basename(tofile)+'.partial'+str(os.getpid()))
+    try: 
+        shutil.copy2(fromfile, partial)
+        if replace==os.rename: delete (tofile)
+        replace(partial, tofile)
+    except: delete (partial); raise
+    delete (fromfile)
+    return 'copy'
+def stage_file (fromfile, directory):
+    # puts fromfile into directory without copying the data where possible:
+    # hardlink (same filesystem), symlink (not windows), copy otherwise
+    # returns the method used
+    tofile = os.path.join(directory, os.path.basename(fromfile))
+    if hasattr(os, 'link'):
+        try: os.link(fromfile, tofile); return 'hardlink'
+        except OSError: pass # other filesystem, not permitted
+    if hasattr(os, 'symlink') and sys.platform!="win32": # windows needs extra privileges
+        try: os.symlink(fromfile, tofile); return 'symlink'
+        except OSError: pass
+    shutil.copy2(fromfile, tofile); return 'copy'
+def _T1_max (header): # maximum of T1.nii stored by stage_reset_T1 (cal_max), None if not set
+    if header.cal_max>header.cal_min: return header.cal_max
+    return None
+def render_report (T1_File, Box_data, Box_lo, dpi=None):
+    # the images of the PDF report (see report_images, dpi of the images), T1_File memory mapped
+    T1, T1_scaling = memmap_volume(T1_File); header = header_info(T1_File)
+    try: return report_images(T1, header.pixdims, Box_data, Box_lo, T1_scaling, dpi, _T1_max(header))
+    finally: del T1 # close the memory map (windows can't rename open files)
+def write_report (T1_File, Box_data, Box_lo, fractions, PDF_File, dpi=None, images=None):
+    # renders the PDF report (see MRSpeCS_Report_arrays, dpi of the images, images if
+    # already rendered with render_report) to a hidden file next to PDF_File and
+    # renames it, PDF_File appears complete or not at all
+    if images==None: images = render_report(T1_File, Box_data, Box_lo, dpi)
+    partial = os.path.join(os.path.dirname(PDF_File), '.'+os.path.basename(PDF_File)+'.partial'+str(os.getpid()))
+    try: report_document(images, fractions, partial)
+    except: delete (partial); raise
+    publish_file (partial, PDF_File)
+report_threads = [] # reports rendered in the background (see run_mrspecs, wait_reports)
+def _background_reports (reports, log, log_ID):
+    # log and log_ID of the run that queued the reports, the global log may already
+    # be another case's (or closed) when they are written
+    def log_write (message): # as logwrite
+        line = datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S")+' ('+log_ID+') - '+message+'\n'
+        try:
+            if log=='': sys.__stderr__.write(line); return # no log open (see close_log)
+            f = open(log, 'a')
+            try: f.write(line)
+            finally: f.close()
+        except: pass # silent
+    for T1_File, Box_data, Box_lo, fractions, PDF_File, dpi in reports:
+        try: 
+            write_report (T1_File, Box_data, Box_lo, fractions, PDF_File, dpi)
+            log_write ('PDF report written  '+PDF_File)
+        except: log_write ('PDF report '+PDF_File+' generation failed ('+str(sys.exc_info()[1])+')')
+def wait_reports ():
+    # waits until the reports rendered in the background are written
+    while len(report_threads)>0: report_threads.pop(0).join()
+def _communicate (process):
+    # process.communicate() that also returns the resource usage of the process
+    # from os.wait4 (includes the programs started by the shell), None without wait4
+    if not hasattr(os, 'wait4'): 
+        (stdout, stderr) = process.communicate(); return stdout, stderr, None
+    output = []
+    reader = threading.Thread(target=lambda: output.append(process.stderr.read()))
+    reader.start()
+    stdout = process.stdout.read(); reader.join()
+    process.stdout.close(); process.stderr.close()
+    while True:
+        try: pid, status, usage = os.wait4(process.pid, 0); break
+        except OSError as error: 
+            if error.errno!=errno.EINTR: raise
+    if os.WIFSIGNALED(status): process.returncode = -os.WTERMSIG(status)
+    else: process.returncode = os.WEXITSTATUS(status)
+    return stdout, output[0], usage
+def run (command, parameters, env=None): # env defaults to my_env
     string = '"'+command+'" '+parameters
     if debug: logwrite (string)
-    process = subprocess.Popen(string, env=my_env,
+    if env==None: env = my_env
+    event = profile_begin(os.path.basename(command), 'tool', {'parameters': parameters})
+    process = subprocess.Popen(string, env=env,
                   shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    (stdout, stderr) = process.communicate()  
-    if debug: logwrite (stdout)
-    if debug: logwrite (stderr)    
+    (stdout, stderr, usage) = _communicate(process)
+    profile_end(event)
+    if usage!=None: tool_usage(event, usage)
+    if debug: 
+        if usage!=None: logwrite ('%.2f s, CPU %.2f s user %.2f s system, peak RSS %.0f MB' 
+                                  % (event['duration'], event['cpu_user'], event['cpu_system'], event['peak_rss']/1024.**2))
+        else: logwrite ('%.2f s' % event['duration'])
+    if debug: logwrite (stdout.decode('ascii', 'replace')) # bytes on Python 3
+    if debug: logwrite (stderr.decode('ascii', 'replace'))    
     if process.returncode != 0: 
         lprint ('ERROR:  returned from "'+os.path.basename(command)+
                 '", for details inspect logfile in debug mode')
         exit(1)
     return stdout 
-def reset_NIFTI_header (filename):
+def reset_NIFTI_header (filename, origin):
+    # orientation cleanup & image center as origin, header only (in place),
+    # writes the same header as the fslorient sequence in _reset_NIFTI_header_fsl
+    if debug: # reference: a copy of the original header, reset with fslorient
+        reference = os.path.splitext(filename)[0]+'_fslorient.nii'
+        copy (filename, reference)
+        _reset_NIFTI_header_fsl ('"'+reference+'"', origin)
+    try: reset_orientation(filename, origin)
+    except: lprint ('ERROR:  Problem writing NIFTI header '+os.path.basename(filename)); exit(1)
+    if debug: 
+        differences = header_differences(filename, reference)
+        if len(differences)==0: logwrite ('NIFTI header identical to fslorient '+os.path.basename(filename))
+        else:
+            logwrite ('WARNING: NIFTI header differs from fslorient '+os.path.basename(filename))
+            for difference in differences: logwrite ('         '+difference+' (fslorient)')
+def _reset_NIFTI_header_fsl (filename, origin): # reference implementation (debug mode only)
     command=resourcedir+'fslorient'; checkcommand(command)
     parameters=' -deleteorient '+filename
     run(command,parameters)
@@ -253,9 +391,9 @@ def reset_NIFTI_header (filename):
     # set image center
     parameters=' -getqform '+filename
     output = run(command, parameters).decode('ascii').rstrip('\n').split(' ')
-    output[3] =str( Image_center_X*Image_Resolution_X)
-    output[7] =str(-Image_center_Y*Image_Resolution_Y)
-    output[11]=str(-Image_center_Z*Image_Resolution_Z)
+    output[3] =str(origin[0])
+    output[7] =str(origin[1])
+    output[11]=str(origin[2])
     output = ' '.join(output)
     parameters=' -setqform '+output+' '+filename
     run(command, parameters)
@@ -266,11 +404,6 @@ def _get_from_SPAR (input, varstring):
     if len(value)==1: value = value[0]
     else: lprint ('ERROR: unable to read parameter "'+varstring+'" in SPAR'); exit(1)
     return value
-def _get_HDRvalue (input, varstring):
-    value = [''.join(text.replace("\t"," ").split(' ')[1:]) for text in input if text.replace("\t"," ").split(' ')[0]==varstring]
-    if len(value)==1: value = value[0]
-    else: lprint ('ERROR: unable to read parameter "'+varstring+'" from NIFTI header'); exit(1)
-    return value        
 def isDICOM (file): # borrowed from linux' file command's magic pattern file
     try: f = open(file, "rb")
     except: lprint ('ERROR: opening file'), file; exit(1)
@@ -281,6 +414,13 @@ def isDICOM (file): # borrowed from linux' file command's magic pattern file
     except: return False # on error probably not a DICOM file
     if test.decode('ascii') == 'DICM': return True 
     else: return False
+def isSpectroDICOM (file):
+    # DICOM file with a Philips spectro header (header only, see MRSpeCS_Dicom),
+    # without pydicom every DICOM file (read_spectro_geometry reports the problem)
+    if not isDICOM(file): return False
+    if not pydicom_installed: return True
+    try: spectro_header(file); return True
+    except: return False
 def _vax_to_ieee_single_float(data): # borrowed from the python VeSPA project
     #Converts a float in Vax format to IEEE format.
     #data should be a single string of chars that have been read in from 
@@ -312,6 +452,93 @@ def _vax_to_ieee_single_float(data): # borrowed from the python VeSPA project
         elif expon == 0 and sign == 0: f.append(0)
         else: f.append(0) # may want to raise an exception here ...
     return f        
+def read_spectro_geometry (Spectro_File):
+    # spectro voxel size/offset/angulation as stored in SPAR or Philips DICOM
+    # returns a dictionary with keys like 'AP_size', 'LR_offset', 'FH_rot'
+    geometry = {}
+    extension = os.path.splitext(Spectro_File)[1]
+    if extension.lower()=='.spar': # read spectro orientation from SPAR
+        try: input = open(Spectro_File, "r").readlines()
+        except: lprint ('ERROR: reading SPAR file'); exit(1)
+        for direction, SPAR_direction in [('AP','ap'), ('LR','lr'), ('FH','cc')]:
+            geometry[direction+'_size'] = float(_get_from_SPAR(input,SPAR_direction+'_size'))
+            geometry[direction+'_offset'] = float(_get_from_SPAR(input,SPAR_direction+'_off_center'))
+            geometry[direction+'_rot'] = float(_get_from_SPAR(input,SPAR_direction+'_angulation'))
+        return geometry
+    #try to read spectro orientation from DICOM
+    if not isDICOM(Spectro_File): lprint ('ERROR:  specified spectro file is not DICOM'); exit(2)
+    if not pydicom_installed: 
+        lprint ('ERROR:  Spectro file seems to be in DICOM format but pydicom is not installed ')
+        lprint ('        see http://pydicom.readthedocs.io/en/stable/getting_started.html')
+        lprint ('        or simply try "yum install python-pip" then "pip install pydicom"')
+        exit(2)
+    # header only: stops before the spectroscopy data, checks Modality/Manufacturer/ImageType
+    try: header = spectro_header(Spectro_File)
+    except SpectroDicomError as error: lprint ('ERROR:  '+str(error)); exit(1)
+    except: lprint ('ERROR:  Problem reading DICOM spectro file'); exit(2)
+    for direction, index in [('AP',0), ('LR',1), ('FH',2)]:
+        geometry[direction+'_size'] = header.size[index]
+        geometry[direction+'_offset'] = header.offset[index]
+        geometry[direction+'_rot'] = header.rot[index]
+    return geometry
+def read_spectro_voxel (Spectro_File):
+    # spectro voxel size/offset/angulation (LR,AP,FH) with the sign conventions of
+    # SpectroGeometry applied, returns (Spectro_File, size, offset, angulation)
+    # try correct accidental SDAT choice
+    if os.path.splitext(Spectro_File)[1] == '.SDAT': 
+        Spectro_File=os.path.splitext(Spectro_File)[0]+'.SPAR'
+    if debug:
+        if os.path.splitext(Spectro_File)[1].lower()=='.spar': 
+             logwrite ('Using SPAR spectro  '+Spectro_File)
+        else: logwrite ('Using Spectro File  '+Spectro_File)
+    Spectro = read_spectro_geometry(Spectro_File)
+    Spectro_AP_size, Spectro_LR_size, Spectro_FH_size = Spectro['AP_size'], Spectro['LR_size'], Spectro['FH_size']
+    Spectro_AP_offset, Spectro_LR_offset, Spectro_FH_offset = Spectro['AP_offset'], Spectro['LR_offset'], Spectro['FH_offset']
+    Spectro_AP_rot, Spectro_LR_rot, Spectro_FH_rot = Spectro['AP_rot'], Spectro['LR_rot'], Spectro['FH_rot']
+    # write found geometry to logfile
+    if debug:    
+        logwrite ('Found Spectro Voxel size       (AP/LR/FH) = '
+               +str(Spectro_AP_size)+' / '+ str(Spectro_LR_size)+' / '+str(Spectro_FH_size))
+        logwrite ('Found Spectro Voxel offset     (AP/LR/FH) = '
+               +str(Spectro_AP_offset)+' / '+ str(Spectro_LR_offset)+' / '+str(Spectro_FH_offset))
+        logwrite ('Found Spectro Voxel angulation (AP/LR/FH) = '
+               +str(Spectro_AP_rot)+' / '+ str(Spectro_LR_rot)+' / '+str(Spectro_FH_rot))
+    #twiddling with the spectro geometry to get results correct
+    Spectro_AP_offset = -Spectro_AP_offset # AP swap (duno why) 
+    Spectro_LR_rot = -Spectro_LR_rot       # AP swap (duno why)
+    Spectro_FH_rot = -Spectro_FH_rot       # AP swap (duno why)
+    Spectro_LR_offset = -Spectro_LR_offset # LR swap, spectro = radiological, dcm2nii -> neurological
+    Spectro_AP_rot = -Spectro_AP_rot       # LR swap, spectro = radiological, dcm2nii -> neurological
+    Spectro_FH_rot = -Spectro_FH_rot       # LR swap, spectro = radiological, dcm2nii -> neurological
+    Spectro_LR_rot = -Spectro_LR_rot       # whoo, yet another problem (duno why) 
+    Spectro_FH_rot = -Spectro_FH_rot       # whoo, yet another problem (duno why) 
+    return (Spectro_File, (Spectro_LR_size, Spectro_AP_size, Spectro_FH_size),
+            (Spectro_LR_offset, Spectro_AP_offset, Spectro_FH_offset),
+            (Spectro_LR_rot, Spectro_AP_rot, Spectro_FH_rot))
+def spectro_files (Spectro_File):
+    # list of spectro files from one file, a directory (all .SPAR files, without
+    # these all spectro DICOM XX* files) or a list of files/directories
+    if isinstance(Spectro_File, (list, tuple)): 
+        return [file for entry in Spectro_File for file in spectro_files(entry)]
+    Spectro_File = os.path.abspath(Spectro_File)
+    if not os.path.isdir(Spectro_File): checkfile(Spectro_File); return [Spectro_File]
+    names = sorted(os.listdir(Spectro_File))
+    files = [os.path.join(Spectro_File, name) for name in names if name.lower().endswith('.spar')]
+    if len(files)==0: 
+        files = [os.path.join(Spectro_File, name) for name in names if name.startswith('XX')]
+        files = [file for file in files if os.path.isfile(file) and isSpectroDICOM(file)]
+    if len(files)==0: lprint ('ERROR:  No spectro files found in '+Spectro_File); exit(1)
+    return files
+def voxel_suffixes (Spectro_Files):
+    # suffixes of the output names of the spectro voxels (e.g. SpectroBOX_<name>.nii),
+    # none with one voxel, the voxel number added to repeated spectro names
+    suffixes = []
+    if len(Spectro_Files)<2: return ['']*len(Spectro_Files)
+    for index, file in enumerate(Spectro_Files):
+        suffix = '_'+os.path.splitext(os.path.basename(file))[0]
+        if suffix in suffixes[:index]: suffix += '_'+str(index+1)
+        suffixes.append(suffix)
+    return suffixes
 def usage():
     lprint ('')
     lprint ('Usage: '+Program_name+' [options] --img=<inputimage> --spec=<inputspectro>')
@@ -320,6 +547,27 @@ def usage():
     lprint ('       --outdir=<path> : output directory, if not specified')
     lprint ('                         output goes to current working directory')
     lprint ('       --noseg         : skip segmentation, only create the Spectro Box')
+    lprint ('       --pvbox         : partial volume weighted Spectro Box, see help')
+    lprint ('       --spec can be repeated or a directory for several spectro voxels')
+    lprint ('       --batch=<file>  : process all cases of a manifest or a directory')
+    lprint ('                         in parallel instead of --img/--spec, see help')
+    lprint ('       --jobs=<n>      : number of parallel cases for --batch')
+    lprint ('                         (default: number of cores, limited by memory)')
+    lprint ('       --cache=<path>  : keep NIFTI conversion and segmentation for reuse,')
+    lprint ('                         default from environment variable MRSPECS_CACHE')
+    lprint ('       --cachesize=<n> : cache size limit in MB (default '+str(cache_size)+')')
+    lprint ('       --workdir=<path> : directory for the intermediate files (e.g. /dev/shm),')
+    lprint ('                         default from environment variable MRSPECS_WORKDIR,')
+    lprint ('                         otherwise the output directory')
+    lprint ('       --seg-profile=<name> : segmentation preview, standard (default) or full')
+    lprint ('       --validate=<file> : compare --seg-profile (default preview) with standard')
+    lprint ('                         on the cases of a manifest or directory, see help')
+    lprint ('       --profile=<file> : write the timings of stages and tool calls, see help')
+    lprint ('       --report=<mode> : PDF report inline (default), background or none')
+    lprint ('       --report-only=<path> : write the missing PDF reports of finished runs')
+    lprint ('       --report-dpi=<n> : resolution of the report images as printed (default 100)')
+    lprint ('       --summary=<path> : one PDF with the results and images of all finished')
+    lprint ('                         runs in <path> and its subdirectories, see help')
     lprint ('       -h --help       : usage and help')
     lprint ('       -d --debug      : debug mode, see help for details')
     lprint ('       --version       : version information')
@@ -328,10 +576,13 @@ def help():
     lprint ('')
     lprint ('Debug mode writes additional information and error messages to the logfile')
     lprint ('and outputs results without angulations/translations labeled "*Isocenter*"')
-    lprint ('---- CAUTION: FINAL RESULTS ARE SLIGHTLY DIFFERENT FROM NORMAL MODE -----')
-    lprint ('this is because in debug mode the spectro box transformation is done in two')
-    lprint ('Separate steps: straigh->isocenter & isocenter->image space, which results in')
-    lprint ('slight rounding errors, whereas in normal mode this is done in one single step')
+    lprint ('the transformation matrices are also written to the logfile')
+    lprint ('')
+    lprint ('')
+    lprint ('By default the Spectro Box is binary: a voxel belongs to the box if its center')
+    lprint ('is inside the (rotated) spectro voxel. With --pvbox each voxel of SpectroBOX.nii')
+    lprint ('holds the fraction of its volume inside the spectro voxel instead, and the')
+    lprint ('CSF/GM/WM fractions are calculated with these values as weights')
     lprint ('')
     lprint ('')
     lprint ('The program can be called without --img and --spec options,')
@@ -359,637 +610,1129 @@ def help():
     lprint ('                 lr_angulation : value LR angulation [degrees, -45.0 to 45.0]')
     lprint ('                 cc_angulation : value LR angulation [degrees, -45.0 to 45.0]')
     lprint ('')
+    lprint ('Several spectro voxels on the same image (--spec repeated, or a directory with')
+    lprint ('the .SPAR files) are processed with one conversion and segmentation. Every')
+    lprint ('voxel gets its own box (SpectroBOX_<name>.nii), report and line in the results,')
+    lprint ('SpectroBOX.nii then is a label volume with the voxels numbered 1, 2, ...')
+    lprint ('')
+    lprint ('')
+    lprint ('--batch processes many cases in parallel, cases that already have results')
+    lprint ('(MRSpeCS_Results.txt) are skipped. The batch is either a manifest, a CSV file')
+    lprint ('with lines  image,spectro,outdir  (outdir optional, defaults to the directory')
+    lprint ('of the image, relative paths are relative to the manifest), or a directory')
+    lprint ('where every subdirectory is one case: the spectro is the .SPAR file (or a')
+    lprint ('DICOM XX* file), the image the .nii/.nii.gz file or the largest DICOM file,')
+    lprint ('output goes to the subdirectory. All results are collected in')
+    lprint ('MRSpeCS_Batch_Results.txt in the output directory (--outdir), together with')
+    lprint ('MRSpeCS_Batch_Summary.pdf, a row with the fractions and the axial, coronal and')
+    lprint ('sagittal images per spectro voxel (also with --summary=<path> for earlier runs)')
+    lprint ('')
+    lprint ('')
+    lprint ('With --cache the NIFTI conversion and segmentation of the image are stored')
+    lprint ('in the cache directory, further runs with the same image (e.g. other spectro')
+    lprint ('voxels) skip directly to the Spectro Box generation and measurement.')
+    lprint ('Cache entries are identified by the image file contents, the FSL version and')
+    lprint ('the segmentation parameters, the least recently used entries are removed')
+    lprint ('when the cache grows beyond --cachesize')
+    lprint ('')
+    lprint ('')
+    lprint ('--workdir puts the temporary directory with the intermediate files on a local')
+    lprint ('disk or tmpfs (/dev/shm) instead of the output directory, only the final')
+    lprint ('outputs are written to the output directory (useful if that is a network share)')
+    lprint ('')
+    lprint ('')
+    lprint ('--seg-profile selects speed against accuracy of the segmentation: preview')
+    lprint ('segments the image downsampled 2x with few iterations and without bias field')
+    lprint ('correction (an approximate result in seconds), full doubles the iterations.')
+    lprint ('--validate runs the cases of a validation set (manifest or directory as for')
+    lprint ('--batch) with --seg-profile and with standard and reports the differences of')
+    lprint ('the fractions in MRSpeCS_Validation_<profile>.txt in the output directory')
+    lprint ('')
+    lprint ('')
+    lprint ('--profile writes the wall clock times of all processing stages and external')
+    lprint ('tool calls (nested by stage) as JSON to <file> and as a Chrome trace-event')
+    lprint ('file to <file>_trace.json (view with chrome://tracing or ui.perfetto.dev),')
+    lprint ('with --batch the files of every case go to its output directory. Tool calls')
+    lprint ('also get their CPU time and peak memory (RSS), stages the peak of the memory')
+    lprint ('allocated in Python (tracemalloc, Python 3.9+)')
+    lprint ('')
+    lprint ('')
+    lprint ('--report=background publishes the results and images first and writes the')
+    lprint ('PDF reports afterwards (the program exits when they are written), with')
+    lprint ('--report=none no reports are written, --report-only=<path> writes them later')
+    lprint ('for all finished runs in <path> and its subdirectories (also with --noseg,')
+    lprint ('then without the fractions)')
+    lprint ('')
+    lprint ('')
+    lprint ('The processing is also available from Python, see run_mrspecs:')
+    lprint ('   from MRSpeCS import run_mrspecs')
+    lprint ('   results = run_mrspecs(inputimage, inputspectro, outdir, {"pvbox": True})')
+    lprint ('   print (results["CSF"], results["GM"], results["WM"], results["WCONC"])')
+    lprint ('')
          
 
 # general initialization stuff   
-debug=False; NIFTI_Input=False; SPAR_Input=True
-Image_File=''; Spectro_File=''
+debug=False
 space=' '; slash='/'; 
 if sys.platform=="win32": slash='\\' # not really needed, but looks nicer ;)
-Program_name = os.path.basename(sys.argv[0]); 
-if Program_name.find('.')>0: Program_name = Program_name[:Program_name.find('.')]
-basedir = os.getcwd()+slash # current working directory is the default output directory 
-for arg in sys.argv[1:]: # look in command line arguments if the output directory specified
-    if "--outdir" in arg: basedir = os.path.abspath(arg[arg.find('=')+1:])+slash #
+if __name__ == '__main__':
+    Program_name = os.path.basename(sys.argv[0]); 
+    if Program_name.find('.')>0: Program_name = Program_name[:Program_name.find('.')]
+else: Program_name = 'MRSpeCS'
 ID = str(random.randrange(1000, 2000));ID=ID[:3] # create 3 digit random ID for logfile 
-try: sys.stderr = open(basedir+Program_name+'.log', 'a'); # open logfile to append
-except: print('Problem opening logfile: '+basedir+Program_name+'.log'); exit(2)
-my_env = os.environ.copy(); my_env["FSLOUTPUTTYPE"] = "NIFTI" # set FSLOUTPUTTYPE=NIFTI
-FNULL = open(os.devnull, 'w')
-# catch signals to be able to cleanup temp files before exit
-signal.signal(signal.SIGINT, signal_handler)  # keyboard interrupt
-signal.signal(signal.SIGTERM, signal_handler) # kill/shutdown
-if  'SIGHUP' in dir(signal): signal.signal(signal.SIGHUP, signal_handler)  # shell exit (linux)
-# make tempdir
-timestamp=datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-tempname='.'+Program_name+'_temp'+timestamp
-tempdir=basedir+tempname+slash
-if os.path.isdir(tempdir): # this should never happen
-    lprint ('ERROR:  Problem creating temp dir (already exists)'); exit(1) 
-try: os.mkdir (tempdir)
-except: lprint ('ERROR:  Problem creating temp dir: '+tempdir); exit(1) 
-
-  
-# configuration specific initializations
+logfile = sys.stderr; logname = ''; last_message = ''
+tempdir = ''; resourcedir = ''
+# segmentation profiles (--seg-profile, see stage_segmentation), part of the cache key
+#    name: (FAST parameters, downsampling factor of the image before BET/FAST)
+if sys.platform=="win32": 
+    seg_profiles = {'preview':  (' -v0 -n -e -ov -b 0.1 -l 20 -i 1 --p', 2),
+                    'standard': (' -v0 -n -e -ov -b 0.1 -l 20 -i 4 --p', 1),
+                    'full':     (' -v0 -n -e -ov -b 0.1 -l 20 -i 8 --p', 1)}
+else: 
+    seg_profiles = {'preview':  (' -N -I 1 -O 1 -W 5', 2), # no bias field, few iterations
+                    'standard': ('', 1),                   # no option switches default is OK in FSL v5
+                    'full':     (' -I 8 -O 8 -W 30', 1)}  # twice the default iterations
+crop_margin = 5. # FAST runs on the brain bounding box plus this margin [mm], part of the cache key
+cache_size = 10*1024 # default cache size limit [MB]
 # compare python versions with e.g. if LooseVersion(python_version)>LooseVersion("2.7.6"):
 python_version = str(sys.version_info[0])+'.'+str(sys.version_info[1])+'.'+str(sys.version_info[2])
-# sys.platform = [linux2, win32, cygwin, darwin, os2, os2emx, riscos, atheos, freebsd7, freebsd8]
-if sys.platform=="win32":
-    os.system("title "+Program_name)
-    try: resourcedir = sys._MEIPASS+slash # when on PyInstaller 
-    except: # in plain python this is where the script was run from
-        resourcedir = os.path.abspath(os.path.dirname(sys.argv[0]))+slash; 
-    command='attrib'; parameters=' +H "'+tempdir[:len(tempdir)-1]+'"'; 
-    run(command, parameters) # hide tempdir
-    if pywin32_installed:
-        try: # disable console windows close button (substitutes catch shell exit under linux)
-            hwnd = win32console.GetConsoleWindow()
-            hMenu = win32gui.GetSystemMenu(hwnd, False)
-            win32gui.EnableMenuItem(hMenu, win32con.SC_CLOSE, win32con.MF_GRAYED) 
-        except: pass #silent
-else:
-    try: fsldir = os.environ['FSLDIR']; 
-    except: fsldir='/usr/local/fsl'; my_env["FSLDIR"] = fsldir # best guess
-    resourcedir = os.path.abspath(fsldir+'/bin')+slash
-    if not os.path.isdir(resourcedir): 
-        print ('ERROR: FSL not found, ')
-        print ('set the FSLDIR environment variable to point to the FSL installation directory\n')
-        exit(2)
-if TK_installed:        
-    TKwindows = tk.Tk(); TKwindows.withdraw() #hiding tkinter window
-    TKwindows.update()
-    # the following tries to disable showing hidden files/folders under linux
-    try: TKwindows.tk.call('tk_getOpenFile', '-foobarz')
-    except: pass
-    try: TKwindows.tk.call('namespace', 'import', '::tk::dialog::file::')
-    except: pass
-    try: TKwindows.tk.call('set', '::tk::dialog::file::showHiddenBtn', '1')
-    except: pass
-    try: TKwindows.tk.call('set', '::tk::dialog::file::showHiddenVar', '0')
-    except: pass
-    TKwindows.update()
-
-
-# parse commandline parameters (if present)
-try: opts, args =  getopt( sys.argv[1:],'hd',['help','version','debug','img=','spec=','outdir=','noseg'])
-except:
-    error=str(sys.argv[1:]).replace("[","").replace("]","")
-    if "-" in str(error) and not "--" in str(error): 
-          lprint ('ERROR: Commandline '+str(error)+',   maybe you mean "--"')
-    else: lprint ('ERROR: Commandline '+str(error))
-    usage(); exit(2)
-if len(args)>0: 
-    lprint ('ERROR: Commandline option "'+args[0]+'" not recognized')
-    lprint ('       (see logfile for details)')
-    logwrite ('       Calling parameters: '+str(sys.argv[1:]).replace("[","").replace("]",""))
-    usage(); exit(2)  
-argDict = dict(opts)
-if "--outdir" in argDict and not [True for arg in sys.argv[1:] if "--outdir" in arg]:
-    # "--outdir" must be spelled out, getopt also excepts substrings (e.g. "--outd"), but
-    # my simple pre-initialization code to get basedir early doesn't
-    lprint ('ERROR: Commandline option "--outdir" must be spelled out')
-    usage(); exit(2)
-if '-h' in argDict: usage(); help(); exit(0)   
-if '--help' in argDict: usage(); help(); exit(0)  
-if '-d' in argDict: debug = True  
-if '--debug' in argDict: debug = True   
-if '--version' in argDict: lprint (Program_name+' '+Program_version); exit(0)
-if '--img' in argDict: Image_File=argDict['--img']; checkfile(Image_File)
-if '--spec' in argDict: Spectro_File=argDict['--spec']; checkfile(Spectro_File)
-if '--noseg' in argDict: nosegmentation=True
-else: nosegmentation=False
-
-
-# ----- start to really do something -----
-lprint ('Starting   Spectro Compartment Segmentation - '+Program_name+' '+Program_version)
-logwrite ('Calling sequence    '+' '.join(sys.argv))
-logwrite ('OS & Python version '+sys.platform+' '+python_version)
-logwrite ('tkinter & pydicom   '+str(TK_installed)+' '+str(pydicom_installed))
-
-Interactive = False
-# Interactive Input
-if TK_installed:
-    # Choose Image file
-    if Image_File == "" and not NIFTI_Input: # use interactive input if not in commandline
-        Image_File = askopenfilename(title="Choose Image file")
-        if Image_File == "": lprint ('ERROR:  No Image input file specified'); exit(2)
-        Interactive = True
-    TKwindows.update()
-    # Choose Spectro file
-    if Spectro_File == "": # use interactive input if not specified in commandline
-        Spectro_File = askopenfilename(title="Choose Spectro file")
-        if Spectro_File == "": lprint ('ERROR:  No Spectro input file specified'); exit(2)
-        Interactive = True
-    TKwindows.update()    
-else:
-    if Image_File == "": 
-        lprint ('ERROR:  No Image input file specified');
-        lprint ('        to interactively choose input files you need tkinter')
-        lprint ('        on Linux try "yum install tkinter"')
-        lprint ('        on MacOS install ActiveTcl from:')
-        lprint ('        http://www.activestate.com/activetcl/downloads')
-        usage()
+
+
+def setup_environment ():
+    # locate the external programs, configuration specific initializations
+    global my_env, resourcedir
+    my_env = os.environ.copy(); my_env["FSLOUTPUTTYPE"] = "NIFTI" # set FSLOUTPUTTYPE=NIFTI
+    # sys.platform = [linux2, win32, cygwin, darwin, os2, os2emx, riscos, atheos, freebsd7, freebsd8]
+    if sys.platform=="win32":
+        try: resourcedir = sys._MEIPASS+slash # when on PyInstaller 
+        except: # in plain python this is where the script was run from
+            resourcedir = os.path.abspath(os.path.dirname(sys.argv[0]))+slash; 
+    else:
+        try: fsldir = os.environ['FSLDIR']; 
+        except: fsldir='/usr/local/fsl'; my_env["FSLDIR"] = fsldir # best guess
+        resourcedir = os.path.abspath(fsldir+'/bin')+slash
+        if not os.path.isdir(resourcedir): 
+            lprint ('ERROR: FSL not found, ')
+            lprint ('set the FSLDIR environment variable to point to the FSL installation directory\n')
+            exit(2)
+
+
+def toolchain_version ():
+    # FSL version and sizes of the programs that produce T1.nii and the segmentation,
+    # part of the cache key
+    version = ''
+    try: version = open(os.path.join(os.path.dirname(resourcedir[:-1]),'etc','fslversion')).read().strip()
+    except: pass # not a full FSL installation (e.g. windows)
+    for program in ['dcm2nii', 'fslswapdim', 'bet2', 'fast']:
+        file = resourcedir+program
+        if sys.platform=="win32": file = file+'.exe'
+        try: version += ' '+program+':'+str(os.path.getsize(file))
+        except: version += ' '+program+':none'
+    return version
+def run_stages (stages):
+    # stages is a list of (name, function, names of the stages it depends on), every stage
+    # is started in its own thread as soon as its dependencies are done, on errors no
+    # new stages are started and the first error is raised when the running ones ended
+    global last_message
+    done = []; running = []; errors = []; finished = queue.Queue()
+    def start (name, function):
+        def stage ():
+            event = profile_begin(name)
+            try: function()
+            except MRSpeCSError as error: errors.append(error)
+            except Exception as error: 
+                lprint ('ERROR:  stage "'+name+'" failed: '+str(error)); errors.append(MRSpeCSError(last_message, 1))
+            profile_end(event)
+            finished.put(name)
+        thread = threading.Thread(target=stage, name='stage '+name)
+        thread.daemon = True # don't keep the program alive on user abort
+        thread.start(); running.append(name)
+    pending = list(stages)
+    while len(pending)>0 or len(running)>0:
+        if len(errors)==0:
+            for name, function, after in pending[:]:
+                if not [True for stage in after if not stage in done]: 
+                    pending.remove((name, function, after)); start(name, function)
+        if len(running)==0: 
+            if len(errors)==0: lprint ('ERROR:  unresolved stage dependencies '+str([stage[0] for stage in pending]))
+            break
+        while True: # with timeout, to stay responsive to signals (Python2)
+            try: name = finished.get(True, 1); break
+            except queue.Empty: pass
+        running.remove(name); done.append(name)
+    if len(errors)>0: last_message = errors[0].message; exit(errors[0].code)
+    if len(pending)>0: exit(1)
+
+
+run_lock = threading.Lock() # one run_mrspecs at a time (see there)
+def run_mrspecs (Image_File, Spectro_File, outdir, options=None):
+    # the complete processing of one case, output goes to outdir
+    # options is a dictionary of flags like the commandline options:
+    #    'debug', 'noseg', 'pvbox', 
+    #    'cache' (cache directory for T1.nii and the segmentation, see MRSpeCS_Cache.py), 
+    #    'cache_size' (cache size limit in MB),
+    #    'workdir' (directory for the tempdir, default outdir),
+    #    'report' ('inline' (default), 'background': the PDF reports are written by a
+    #              thread after the other outputs are published, see wait_reports,
+    #              or 'none': no reports, see report_only),
+    #    'report_dpi' (resolution of the report images, default report_dpi of MRSpeCS_Report.py),
+    #    'seg_profile' (name in seg_profiles, default 'standard'),
+    #    'profile' (file for the timings, JSON and Chrome trace, see MRSpeCS_Profile.py),
+    #    'memory' (tracemalloc peaks of the stages, on with 'profile')
+    # Spectro_File can also be a directory or a list of files (several spectro voxels)
+    # returns a dictionary with the results:
+    #    'CSF', 'GM', 'WM', 'WCONC' (None with 'noseg'), 
+    #    'matrices' (the 4x4 transformation matrices by name), 
+    #    'outputs' (output file paths by name, e.g. 'SpectroBOX.nii'), 
+    #    'Image_File', 'Spectro_File', 'outdir'
+    #    'timings' (nested wall clock times of stages and tool calls, see profile_tree,
+    #               with CPU time and peak RSS of the tools, memory peaks with 'memory')
+    #    'voxels' (list with the above 'Spectro_File', 'CSF' .. 'matrices' and 
+    #             'SpectroBOX' for every spectro voxel, the above are from the first)
+    # on errors MRSpeCSError is raised (message printed & logged as usual)
+    # the tempdir is removed in any case, also when called from a thread
+    # not reentrant: the log, debug flag, ID and tempdir are module globals, so calls
+    # from several threads run one at a time (parallel cases: processes, see run_batch)
+    global tempdir
+    with run_lock:
+        try: return _run_mrspecs(Image_File, Spectro_File, outdir, options)
+        finally:
+            if tempdir:
+                try: shutil.rmtree(tempdir)
+                except: pass # silent
+            tempdir = ''
+def _run_mrspecs (Image_File, Spectro_File, outdir, options):
+    global debug, ID, tempdir
+    if options==None: options = {}
+    debug = bool(options.get('debug', False))
+    nosegmentation = bool(options.get('noseg', False))
+    pvbox = bool(options.get('pvbox', False))
+    cache = options.get('cache', '')
+    seg_profile = options.get('seg_profile', 'standard')
+    report = options.get('report', 'inline')
+    report_dpi = options.get('report_dpi', None)
+    basedir = os.path.abspath(outdir)+slash
+    open_log (basedir)
+    profile_reset(options.get('memory', False) or bool(options.get('profile', '')))
+    case_event = profile_begin('case', 'case', {'Image_File': Image_File, 'Spectro_File': str(Spectro_File)})
+    ID = str(random.randrange(1000, 2000));ID=ID[:3] # create 3 digit random ID for logfile 
+    if not numpy_installed:
+        lprint ('ERROR:  numpy is required (MRSpeCS_Geometry.py, MRSpeCS_Nifti.py)')
+        lprint ('        to install try "pip install numpy"')
         exit(2)
-    if Spectro_File == "": 
-        lprint ('ERROR:  No Spectro input file specified')
-        lprint ('        to interactively choose input files you need tkinter')
-        lprint ('        on Linux try "yum install tkinter"')
-        lprint ('        on MacOS install ActiveTcl from:')
-        lprint ('        http://www.activestate.com/activetcl/downloads')  
-        usage()
+    if not seg_profile in seg_profiles:
+        lprint ('ERROR:  Unknown segmentation profile "'+str(seg_profile)+'" (use '+'/'.join(sorted(seg_profiles))+')')
         exit(2)
-Image_File = os.path.abspath(Image_File) 
-Spectro_File = os.path.abspath(Spectro_File)       
-# auto detect NIFTI by filename extension
-extension = os.path.basename(Image_File); 
-extension = extension[extension.find('.'):].lower()
-if extension=='.nii.gz' or extension=='.nii': NIFTI_Input=True
-if debug:
-    if NIFTI_Input: logwrite ('Using NIFTI File at '+Image_File)
-    else: logwrite ('Using Image File at '+Image_File)
-
-
-# try correct accidental SDAT choice
-if os.path.splitext(Spectro_File)[1] == '.SDAT': 
-    Spectro_File=os.path.splitext(Spectro_File)[0]+'.SPAR'
-# detect SPAR by filename extension
-extension = os.path.splitext(Spectro_File)[1]
-if not extension.lower()=='.spar': SPAR_Input=False
-if debug:
-    if SPAR_Input: logwrite ('Using SPAR spectro  '+Spectro_File)
-    else: logwrite ('Using Spectro File  '+Spectro_File)
-    logwrite ('All output goes to  '+basedir)
-if SPAR_Input: # read spectro orientation from SPAR
-    try: input = open(Spectro_File, "r").readlines()
-    except: lprint ('ERROR: reading SPAR file'); exit(1)
-    Spectro_AP_size = float(_get_from_SPAR(input,'ap_size')) 
-    Spectro_LR_size = float(_get_from_SPAR(input,'lr_size'))
-    Spectro_FH_size = float(_get_from_SPAR(input,'cc_size'))
-    Spectro_AP_offset = float(_get_from_SPAR(input,'ap_off_center'))
-    Spectro_LR_offset = float(_get_from_SPAR(input,'lr_off_center'))
-    Spectro_FH_offset = float(_get_from_SPAR(input,'cc_off_center'))
-    Spectro_AP_rot = float(_get_from_SPAR(input,'ap_angulation'))
-    Spectro_LR_rot = float(_get_from_SPAR(input,'lr_angulation'))
-    Spectro_FH_rot = float(_get_from_SPAR(input,'cc_angulation'))
-else: #try to read spectro orientation from DICOM
-    if not isDICOM(Spectro_File): lprint ('ERROR:  specified spectro file is not DICOM'); exit(2)
-    if not pydicom_installed: 
-        lprint ('ERROR:  Spectro file seems to be in DICOM format but pydicom is not installed ')
-        lprint ('        see http://pydicom.readthedocs.io/en/stable/getting_started.html')
-        lprint ('        or simply try "yum install python-pip" then "pip install pydicom"')
+    if not report in ['inline', 'background', 'none']:
+        lprint ('ERROR:  Unknown report mode "'+str(report)+'" (use inline, background or none)')
         exit(2)
-    try: Dset = dicom.read_file(Spectro_File)
-    except: lprint ('ERROR:  Problem reading DICOM spectro file'); exit(2)
-    # some checks
-    try: Modality=str(Dset.Modality) # must be MR           
-    except: lprint ('ERROR:  Unable to determine DICOM Modality'); exit(1)
-    if Modality!='MR': lprint ('DICOM Modality not MR'); exit(1)
-    try: Manufacturer=str(Dset.Manufacturer) # currently Philips only
-    except: lprint ('ERROR:  Unable to determine Manufacturer'); exit(1)
-    if not Manufacturer.find("Philips")>=0: 
-        lprint ('ERROR:  Currently only Philips DICOM implemented'); exit(1)
-    try: ImageType=str(Dset.ImageType) # sanity check: spectroscopy   
-    except: 
-        lprint ('ERROR:  Unable to determine if DICOM contains spectroscopy data');exit(1)
-    if not ImageType.find("SPECTROSCOPY")>=0: 
-        lprint ('ERROR:  DICOM file does not contain spectroscopy data'); exit(1)
-    # try to get data out
-    i=0
-    try: Spectro_AP_rot=float(Dset[0x2005,0x1085][0][0x2005,0x1054].value); i=i+1
-    except: lprint ('ERROR:  Unable to extract geometry data from DICOM'); exit(1)
-    try: Spectro_FH_rot=float(Dset[0x2005,0x1085][0][0x2005,0x1055].value); i=i+1
-    except: lprint ('ERROR:  Unable to extract geometry data from DICOM'); exit(1)
-    try: Spectro_LR_rot=float(Dset[0x2005,0x1085][0][0x2005,0x1056].value); i=i+1
-    except: lprint ('ERROR:  Unable to extract geometry data from DICOM'); exit(1)
-    try: Spectro_AP_size=float(Dset[0x2005,0x1085][0][0x2005,0x1057].value); i=i+1
-    except: lprint ('ERROR:  Unable to extract geometry data from DICOM'); exit(1)
-    try: Spectro_FH_size=float(Dset[0x2005,0x1085][0][0x2005,0x1058].value); i=i+1
-    except: lprint ('ERROR:  Unable to extract geometry data from DICOM'); exit(1)
-    try: Spectro_LR_size=float(Dset[0x2005,0x1085][0][0x2005,0x1059].value); i=i+1
-    except: lprint ('ERROR:  Unable to extract geometry data from DICOM'); exit(1)
-    try: Spectro_AP_offset=float(Dset[0x2005,0x1085][0][0x2005,0x105A].value); i=i+1
-    except: lprint ('ERROR:  Unable to extract geometry data from DICOM'); exit(1)
-    try: Spectro_FH_offset=float(Dset[0x2005,0x1085][0][0x2005,0x105B].value); i=i+1
-    except: lprint ('ERROR:  Unable to extract geometry data from DICOM'); exit(1)
-    try: Spectro_LR_offset=float(Dset[0x2005,0x1085][0][0x2005,0x105C].value); i=i+1
-    except: lprint ('ERROR:  Unable to extract geometry data from DICOM'); exit(1)  
-    if i!=9: lprint ('ERROR:  Unable to extract all geometry data from DICOM'); exit(1) 
-# write found geometry to logfile
-if debug:    
-    logwrite ('Found Spectro Voxel size       (AP/LR/FH) = '
-           +str(Spectro_AP_size)+' / '+ str(Spectro_LR_size)+' / '+str(Spectro_FH_size))
-    logwrite ('Found Spectro Voxel offset     (AP/LR/FH) = '
-           +str(Spectro_AP_offset)+' / '+ str(Spectro_LR_offset)+' / '+str(Spectro_FH_offset))
-    logwrite ('Found Spectro Voxel angulation (AP/LR/FH) = '
-           +str(Spectro_AP_rot)+' / '+ str(Spectro_LR_rot)+' / '+str(Spectro_FH_rot))
-#twiddling with the spectro geometry to get results correct
-Spectro_AP_offset = -Spectro_AP_offset # AP swap (duno why) 
-Spectro_LR_rot = -Spectro_LR_rot       # AP swap (duno why)
-Spectro_FH_rot = -Spectro_FH_rot       # AP swap (duno why)
-Spectro_LR_offset = -Spectro_LR_offset # LR swap, spectro = radiological, dcm2nii -> neurological
-Spectro_AP_rot = -Spectro_AP_rot       # LR swap, spectro = radiological, dcm2nii -> neurological
-Spectro_FH_rot = -Spectro_FH_rot       # LR swap, spectro = radiological, dcm2nii -> neurological
-Spectro_LR_rot = -Spectro_LR_rot       # whoo, yet another problem (duno why) 
-Spectro_FH_rot = -Spectro_FH_rot       # whoo, yet another problem (duno why) 
-
-# ----- transform DICOM 2 NIFTI (uses dcm2nii) -----
-if not NIFTI_Input:
-    lprint ('Converting DICOM Image to NIFTI')
-    # copy DICOM file to tempdir
-    try: shutil.copy2(Image_File, tempdir)
-    except: lprint ('ERROR:  Problem copying DICOM File '); exit(1)
-    # convert DICOM file to NIFTI
-    command=resourcedir+'dcm2nii'; checkcommand(command)    
-    parameters  = ' -4 Y -3 N -a Y -c Y -d N -e N -f Y -g N -i N -k 0 -l N'
-    parameters += ' -m N -n Y -p N -r Y -t N -v Y -x N "'+tempdir+'"'
-    run(command, parameters)
-    # dcm2nii "o" files are in neurological orientation
-    # switch to radiological
-    command=resourcedir+'fslswapdim'; checkcommand(command)
-    filename='o'+os.path.basename(os.path.splitext(Image_File)[0])+'.nii'
-    parameters=' "'+tempdir+filename+'" -x y z "'+tempdir+'T1.nii"'
-    run(command,parameters)
-    delete(tempdir+os.path.basename(os.path.splitext(Image_File)[0])+'.nii') #delete unused file
-    delete(tempdir+'co'+os.path.basename(os.path.splitext(Image_File)[0])+'.nii') #delete unused
-else: 
-    # switch to radiological
-    command=resourcedir+'fslswapdim'; checkcommand(command)
-    parameters=' "'+Image_File+'" -x y z "'+tempdir+'T1.nii"'
-    run(command,parameters)
-# ----- check NIFTI file (neurological axial required) -----
-if not os.path.isfile(tempdir+'T1.nii'): lprint ('ERROR:  NIFTI file not found '); exit(1)
-command=resourcedir+'fslhd'; checkcommand(command)
-parameters=' "'+tempdir+'T1.nii"'
-output = run(command,parameters).decode('ascii')
-output = output.replace("\t"," ")
-output = " ".join(output.split())
-if not 'qform_name Scanner Anat' in output: 
-    lprint ('ERROR:  could not locate NIFTI information confirming neurological axial'); exit(1)
-if not 'qform_xorient Left-to-Right' in output: 
-    lprint ('ERROR:  could not locate NIFTI information confirming neurological axial'); exit(1)
-if not 'qform_yorient Posterior-to-Anterior' in output: 
-    lprint ('ERROR:  could not locate NIFTI information confirming neurological axial'); exit(1)
-if not 'qform_zorient Inferior-to-Superior' in output: 
-    lprint ('ERROR:  could not locate NIFTI information confirming neurological axial'); exit(1)
-if not 'sform_name Scanner Anat' in output: 
-    lprint ('ERROR:  could not locate NIFTI information confirming neurological axial'); exit(1)
-if not 'sform_xorient Left-to-Right' in output: 
-    lprint ('ERROR:  could not locate NIFTI information confirming neurological axial'); exit(1)
-if not 'sform_yorient Posterior-to-Anterior' in output: 
-    lprint ('ERROR:  could not locate NIFTI information confirming neurological axial'); exit(1)
-if not 'sform_zorient Inferior-to-Superior' in output: 
-    lprint ('ERROR:  could not locate NIFTI information confirming neurological axial'); exit(1)
-
-# ----- extract Image transformations -----
-lprint ('Extracting transformation matrix from Image')
-command=resourcedir+'fslorient'; checkcommand(command)
-parameters=' -getqform "'+tempdir+'T1.nii"'
-output = run(command, parameters).decode('ascii').split(' ')
-if len(output)!=17: lprint ('ERROR:  Problem reading qform form NIFTI '); exit(1)
-f = open(tempdir+'temp1.txt', 'w') # this matrix still contains scalings
-f.write(output[0]+space+output[1]+space+output[2]+space+output[3]+'\n') 
-f.write(output[4]+space+output[5]+space+output[6]+space+output[7]+'\n')
-f.write(output[8]+space+output[9]+space+output[10]+space+output[11]+'\n')
-f.write(output[12]+space+output[13]+space+output[14]+space+output[15]+'\n')
-f.close()
-# this isolates the rotations/translations only, without the scalings (data is in lines 1-4)
-command=resourcedir+'avscale'; checkcommand(command)
-parameters=' "'+tempdir+'temp1.txt"'
-output = run(command, parameters).decode('ascii').split('\n')
-f = open(tempdir+'ImageTransform_raw.mat', 'w')
-f.write(output[1]+'\n') 
-f.write(output[2]+'\n')
-f.write(output[3]+'\n')
-f.write(output[4]+'\n')
-f.close()
-# get image dimensions
-command=resourcedir+'fslhd'; checkcommand(command)
-parameters=' "'+tempdir+'T1.nii"'
-output = run(command,parameters).decode('ascii').split('\n')
-Image_size_X = int(_get_HDRvalue(output,'dim1'))
-Image_size_Y = int(_get_HDRvalue(output,'dim2'))
-Image_size_Z = int(_get_HDRvalue(output,'dim3'))
-Image_Resolution_X = float(_get_HDRvalue(output,'pixdim1'))
-Image_Resolution_Y = float(_get_HDRvalue(output,'pixdim2'))
-Image_Resolution_Z = float(_get_HDRvalue(output,'pixdim3'))
-Image_center_X = int(Image_size_X/2)
-Image_center_Y = int(Image_size_Y/2)
-Image_center_Z = int(Image_size_Z/2)
-# write translation matrices image_center <--> FSL_rotation_center (cubes corner)
-f = open(tempdir+'TranslImageOrigin.mat', 'w')
-f.write('1 0 0 '+str(-Image_center_X*Image_Resolution_X)+'\n') # in mm
-f.write('0 1 0 '+str(-Image_center_Y*Image_Resolution_Y)+'\n') # in mm
-f.write('0 0 1 '+str(-Image_center_Z*Image_Resolution_Z)+'\n') # in mm
-f.write('0 0 0 1\n')
-f.close()
-f = open(tempdir+'TranslImageOrigin_Inv.mat', 'w')
-f.write('1 0 0 '+str(Image_center_X*Image_Resolution_X)+'\n') # in mm
-f.write('0 1 0 '+str(Image_center_Y*Image_Resolution_Y)+'\n') # in mm
-f.write('0 0 1 '+str(Image_center_Z*Image_Resolution_Z)+'\n') # in mm
-f.write('0 0 0 1\n')
-f.close()  
-# concat the image transformations
-command=resourcedir+'convert_xfm'; checkcommand(command)
-parameters=' -omat "'+tempdir+'Image2Isocenter.mat"'
-parameters+=' -concat "'+tempdir+'TranslImageOrigin_Inv.mat"'
-parameters+=' "'+tempdir+'ImageTransform_raw.mat"'
-run(command,parameters)  
-# invert the final transformation
-command=resourcedir+'convert_xfm'; checkcommand(command)
-parameters=' -omat "'+tempdir+'Isocenter2Image.mat"'
-parameters+=' -inverse "'+tempdir+'Image2Isocenter.mat"'
-run(command,parameters)     
-# apply transformation (debug mode only)
-if debug:
-   print ('Applying   transformation matrix to NIFTI')
-   command=resourcedir+'flirt'; checkcommand(command)
-   parameters=' -in "'+tempdir+'T1.nii" -ref "'+tempdir+'T1.nii"'
-   parameters+=' -out "'+tempdir+'T1_Isocenter.nii"'
-   parameters+=' -init "'+tempdir+'Image2Isocenter.mat" -applyxfm'
-   run(command,parameters)
-
-# ----- extract Spectrum transformations -----
-lprint ('Extracting transformation matrix from Spectrum')
-d2r = math.pi/180. # degree to rad conversion
-f = open(tempdir+'SpectroRotationLR_raw.mat', 'w') #Spectro X rotation (raw)
-f.write('1 0 0 0\n')
-f.write('0 '+str( math.cos(Spectro_LR_rot*d2r))+' '+str(math.sin(Spectro_LR_rot*d2r))+' 0 \n')
-f.write('0 '+str(-math.sin(Spectro_LR_rot*d2r))+' '+str(math.cos(Spectro_LR_rot*d2r))+' 0 \n')
-f.write('0 0 0 1\n')
-f.close()
-f = open(tempdir+'SpectroRotationAP_raw.mat', 'w') #Spectro Y rotation (raw)
-f.write(str( math.cos(Spectro_AP_rot*d2r))+' 0 '+str(math.sin(Spectro_AP_rot*d2r))+' 0 \n')
-f.write('0 1 0 0\n')
-f.write(str(-math.sin(Spectro_AP_rot*d2r))+' 0 '+str(math.cos(Spectro_AP_rot*d2r))+' 0 \n')
-f.write('0 0 0 1\n')
-f.close()
-f = open(tempdir+'SpectroRotationFH_raw.mat', 'w') #Spectro Z rotation (raw)
-f.write(str( math.cos(Spectro_FH_rot*d2r))+' '+str(math.sin(Spectro_FH_rot*d2r))+' 0 0 \n')
-f.write(str(-math.sin(Spectro_FH_rot*d2r))+' '+str(math.cos(Spectro_FH_rot*d2r))+' 0 0 \n')
-f.write('0 0 1 0\n')
-f.write('0 0 0 1\n')
-f.close()
-#X
-command=resourcedir+'convert_xfm'; checkcommand(command)
-parameters=' -omat "'+tempdir+'temp.mat"'
-parameters+=' -concat "'+tempdir+'SpectroRotationLR_raw.mat"'
-parameters+=' "'+tempdir+'TranslImageOrigin.mat"'
-run(command,parameters)
-parameters=' -omat "'+tempdir+'SpectroRotationLR.mat"'
-parameters+=' -concat "'+tempdir+'TranslImageOrigin_Inv.mat"'
-parameters+=' "'+tempdir+'temp.mat"'
-run(command,parameters)
-#Y
-command=resourcedir+'convert_xfm'; checkcommand(command)
-parameters=' -omat "'+tempdir+'temp.mat"'
-parameters+=' -concat "'+tempdir+'SpectroRotationAP_raw.mat"'
-parameters+=' "'+tempdir+'TranslImageOrigin.mat"'
-run(command,parameters)
-parameters=' -omat "'+tempdir+'SpectroRotationAP.mat"'
-parameters+=' -concat "'+tempdir+'TranslImageOrigin_Inv.mat"'
-parameters+=' "'+tempdir+'temp.mat"'
-run(command,parameters)
-#Z
-command=resourcedir+'convert_xfm'; checkcommand(command)
-parameters=' -omat "'+tempdir+'temp.mat"'
-parameters+=' -concat "'+tempdir+'SpectroRotationFH_raw.mat"'
-parameters+=' "'+tempdir+'TranslImageOrigin.mat"'
-run(command,parameters)
-parameters=' -omat "'+tempdir+'SpectroRotationFH.mat"'
-parameters+=' -concat "'+tempdir+'TranslImageOrigin_Inv.mat"'
-parameters+=' "'+tempdir+'temp.mat"'
-run(command,parameters)
-#XYZ
-command=resourcedir+'convert_xfm'; checkcommand(command)
-parameters=' -omat "'+tempdir+'temp.mat"'
-parameters+=' -concat "'+tempdir+'SpectroRotationAP.mat"'
-parameters+=' "'+tempdir+'SpectroRotationLR.mat"'
-run(command,parameters)
-parameters=' -omat "'+tempdir+'SpectroRotation.mat"'
-parameters+=' -concat "'+tempdir+'SpectroRotationFH.mat"'
-parameters+=' "'+tempdir+'temp.mat"'
-run(command,parameters)
-#Spectro Translation
-f = open(tempdir+'SpectroTranslation.mat', 'w')
-f.write('1 0 0 '+str(Spectro_LR_offset)+'\n') #in mm
-f.write('0 1 0 '+str(Spectro_AP_offset)+'\n') #in mm
-f.write('0 0 1 '+str(Spectro_FH_offset)+'\n') #in mm
-f.write('0 0 0 1\n')
-f.close()
-#Spectro Transformation: all rotations and translations
-command=resourcedir+'convert_xfm'; checkcommand(command)
-parameters=' -omat "'+tempdir+'SpectroTransformation.mat"'
-parameters+=' -concat "'+tempdir+'SpectroTranslation.mat"'
-parameters+=' "'+tempdir+'SpectroRotation.mat"'
-run(command,parameters) 
-
-# ----- generate Spectrum BOX -----
-lprint ('Generating Spectro BOX')
-#make a box at image origin
-Xsize = int(Spectro_LR_size/Image_Resolution_X); sXsize = str(Xsize)
-Ysize = int(Spectro_AP_size/Image_Resolution_Y); sYsize = str(Ysize)
-Zsize = int(Spectro_FH_size/Image_Resolution_Z); sZsize = str(Zsize)
-Xmin  = int(Image_center_X - Xsize/2); sXmin = str(Xmin)
-Ymin  = int(Image_center_Y - Ysize/2); sYmin = str(Ymin)
-Zmin  = int(Image_center_Z - Zsize/2); sZmin = str(Zmin)
-command=resourcedir+'fslmaths'; checkcommand(command)
-parameters=' "'+tempdir+'T1.nii" -mul 0 -add 1 -roi '
-parameters+=sXmin+space+sXsize+space+sYmin+space+sYsize+space+sZmin+space+sZsize
-parameters+=' 0 1 "'+tempdir+'SpectroBOX_straight.nii" -odt float '
-run(command,parameters)
-if debug:    
-    # apply spectro transformation to isocenter 
-    command=resourcedir+'flirt'; checkcommand(command)
-    parameters=' -in "'+tempdir+'SpectroBOX_straight.nii"'
-    parameters+=' -ref "'+tempdir+'SpectroBOX_straight.nii"'
-    parameters+=' -out "'+tempdir+'SpectroBOX_Isocenter_raw.nii"'
-    parameters+=' -init "'+tempdir+'SpectroTransformation.mat" -applyxfm '
-    run(command,parameters)      
-    # bin result
-    command=resourcedir+'fslmaths'; checkcommand(command)
-    parameters=' "'+tempdir+'SpectroBOX_Isocenter_raw.nii"'
-    parameters+=' -bin "'+tempdir+'SpectroBOX_Isocenter.nii" -odt char'
-    run(command,parameters)     
-    # apply spectro transformation from isocenter to image space (inverse image transformation)
-    command=resourcedir+'flirt'; checkcommand(command)
-    parameters=' -in "'+tempdir+'SpectroBOX_Isocenter_raw.nii"'
-    parameters+=' -ref "'+tempdir+'SpectroBOX_Isocenter_raw.nii"'
-    parameters+=' -out "'+tempdir+'SpectroBOX_raw.nii"'
-    parameters+=' -init "'+tempdir+'Isocenter2Image.mat" -applyxfm '
-    run(command,parameters)
-else:    
-   # concat SpectroTransformation.mat & Isocenter2Image.mat
-    command=resourcedir+'convert_xfm'; checkcommand(command)
-    parameters=' -omat "'+tempdir+'Spectro2ImageTransformation.mat"'
-    parameters+=' -concat "'+tempdir+'Isocenter2Image.mat"'
-    parameters+=' "'+tempdir+'SpectroTransformation.mat"'
-    run(command,parameters) 
-    command=resourcedir+'flirt'; checkcommand(command)
-    parameters=' -in "'+tempdir+'SpectroBOX_straight.nii"'
-    parameters+=' -ref "'+tempdir+'SpectroBOX_straight.nii"'
-    parameters+=' -out "'+tempdir+'SpectroBOX_raw.nii"'
-    parameters+=' -init "'+tempdir+'Spectro2ImageTransformation.mat" -applyxfm '
-    run(command,parameters) 
-# bin result
-command=resourcedir+'fslmaths'; checkcommand(command)
-parameters=' "'+tempdir+'SpectroBOX_raw.nii" -bin "'+tempdir+'SpectroBOX.nii" -odt char'
-run(command,parameters)    
-# clean up NIFTI header
-reset_NIFTI_header ('"'+tempdir+'T1.nii"')
-reset_NIFTI_header ('"'+tempdir+'SpectroBOX.nii"')
-if debug: 
-    reset_NIFTI_header ('"'+tempdir+'T1_Isocenter.nii"')
-    reset_NIFTI_header ('"'+tempdir+'SpectroBOX_Isocenter.nii"')
-
-
-# ----- segmentation -----
-if not nosegmentation:
-    lprint ('Running    Segmentation')
-    if sys.platform=="win32": # from here on things go differently for a while
-        # the FAST segmentation tool under windows doesn't like NIFTI, so first transform to Analyze
-        #os.environ["FSLOUTPUTTYPE"] = "ANALYZE" # set FSLOUTPUTTYPE=ANALYZE
-        my_env = os.environ.copy(); my_env["FSLOUTPUTTYPE"] = "ANALYZE" # set FSLOUTPUTTYPE=ANALYZE
-        # convert Image to ANALYZE
-        command=resourcedir+'dcm2nii'; checkcommand(command)
-        parameters=' -n N -s Y -m N "'+tempdir+'T1.nii"'
-        run(command,parameters)          
-        # Brain Extraction BET2 
-        command=resourcedir+'bet2'; checkcommand(command)
-        parameters=' "'+tempdir+'fT1.hdr" "'+tempdir+'T1_BET"'
-        run(command,parameters)      
-        # Segmentation  (windows version only works with analyze images)
-        command=resourcedir+'fast'; checkcommand(command)
-        # see conversion table at the end of https://fsl.fmrib.ox.ac.uk/fsl/fslwiki/FAST
-        parameters=' -v0 -n -e -ov -b 0.1 -l 20 -i 4 --p "'+tempdir+'T1_BET.img"'
-        run(command,parameters)    
-        # transform ANALYZE results back to NIFTI
-        lprint ('Measuring  Compartments')
-        command=resourcedir+'dcm2nii'; checkcommand(command)
-        parameters=' -n Y -m N -g N "'+tempdir+'T1_bet_pve_0.img"'
-        run(command,parameters)
-        parameters=' -n Y -m N -g N "'+tempdir+'T1_bet_pve_1.img"'
+    fast_parameters, downsample = seg_profiles[seg_profile]
+    setup_environment()
+    header_forget(); spectro_header_forget() # the headers of previous runs (batch cases, validation)
+    checkfile(Image_File); Spectro_Files = spectro_files(Spectro_File)
+    # make tempdir (in workdir, shared by parallel cases, therefore with the process id)
+    workdir = basedir
+    if options.get('workdir', ''): 
+        workdir = os.path.abspath(options['workdir'])+slash
+        if not os.path.isdir(workdir):
+            try: os.makedirs(workdir)
+            except: lprint ('ERROR:  Problem creating work dir: '+workdir); exit(1)
+    timestamp=datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+    tempname='.'+Program_name+'_temp'+timestamp+'_'+str(os.getpid())
+    tempdir=workdir+tempname+slash
+    if os.path.isdir(tempdir): # this should never happen
+        tempdir=''; lprint ('ERROR:  Problem creating temp dir (already exists)'); exit(1) 
+    try: os.mkdir (tempdir)
+    except: lprint ('ERROR:  Problem creating temp dir: '+tempdir); exit(1) 
+    if sys.platform=="win32":
+        command='attrib'; parameters=' +H "'+tempdir[:len(tempdir)-1]+'"'; 
+        run(command, parameters) # hide tempdir
+
+    Image_File = os.path.abspath(Image_File) 
+    # auto detect NIFTI by filename extension
+    NIFTI_Input=False
+    extension = os.path.basename(Image_File); 
+    extension = extension[extension.find('.'):].lower()
+    if extension=='.nii.gz' or extension=='.nii': NIFTI_Input=True
+    if debug:
+        if NIFTI_Input: logwrite ('Using NIFTI File at '+Image_File)
+        else: logwrite ('Using Image File at '+Image_File)
+
+
+    if debug: logwrite ('All output goes to  '+basedir)
+    event = profile_begin('spectro')
+    # geometry of every spectro voxel, output file names get the spectro name
+    # appended if there is more than one (e.g. SpectroBOX_<name>.nii)
+    voxels = []
+    for file in Spectro_Files:
+        file, size, offset, rot = read_spectro_voxel(file)
+        voxels.append({'Spectro_File': file, 'size': size, 'offset': offset, 'rot': rot, 'suffix': ''})
+    for voxel, suffix in zip(voxels, voxel_suffixes([voxel['Spectro_File'] for voxel in voxels])):
+        voxel['suffix'] = suffix
+    profile_end(event)
+
+    # ----- cache of T1.nii and segmentation (same image, tools and parameters) -----
+    if cache:
+        cache = os.path.abspath(cache)
+        try: 
+            if not os.path.isdir(cache): os.makedirs(cache)
+            key = cache_key([Image_File], Program_version, toolchain_version(), fast_parameters, downsample, crop_margin)
+        except: lprint ('ERROR:  Problem accessing cache '+cache); exit(1)
+        if debug: logwrite ('Cache entry         '+key)
+        def cached (names, link=False): # copy (or link) from cache to tempdir if available
+            try: return cache_get(cache, key, names, tempdir, link)
+            except: logwrite ('WARNING: Problem reading from cache '+cache); return False
+        def store (names): # store in cache, remove least recently used above the size limit
+            try: 
+                cache_put(cache, key, names, tempdir)
+                for entry in cache_evict(cache, options.get('cache_size', cache_size)*1024*1024, key):
+                    logwrite ('Cache entry removed '+os.path.basename(entry))
+            except: logwrite ('WARNING: Problem writing to cache '+cache)
+    else: 
+        def cached (names, link=False): return False
+        def store (names): pass
+
+    # ----- transform DICOM 2 NIFTI (uses dcm2nii) -----
+    event = profile_begin('conversion')
+    if cached(['T1.nii']): lprint ('Using cached NIFTI Image')
+    elif not NIFTI_Input:
+        lprint ('Converting DICOM Image to NIFTI')
+        # DICOM file to tempdir (dcm2nii converts whole directories), linked if possible
+        try: method = stage_file(Image_File, tempdir)
+        except: lprint ('ERROR:  Problem copying DICOM File '); exit(1)
+        if debug: logwrite ('DICOM File staged   ('+method+')')
+        # convert DICOM file to NIFTI
+        command=resourcedir+'dcm2nii'; checkcommand(command)    
+        parameters  = ' -4 Y -3 N -a Y -c Y -d N -e N -f Y -g N -i N -k 0 -l N'
+        parameters += ' -m N -n Y -p N -r Y -t N -v Y -x N "'+tempdir+'"'
+        run(command, parameters)
+        # dcm2nii "o" files are in neurological orientation
+        # switch to radiological
+        command=resourcedir+'fslswapdim'; checkcommand(command)
+        filename='o'+os.path.basename(os.path.splitext(Image_File)[0])+'.nii'
+        parameters=' "'+tempdir+filename+'" -x y z "'+tempdir+'T1.nii"'
         run(command,parameters)
-        parameters=' -n Y -m N -g N "'+tempdir+'T1_bet_pve_2.img"'
+        delete(tempdir+os.path.basename(os.path.splitext(Image_File)[0])+'.nii') #delete unused file
+        delete(tempdir+'co'+os.path.basename(os.path.splitext(Image_File)[0])+'.nii') #delete unused
+    else: 
+        # switch to radiological
+        command=resourcedir+'fslswapdim'; checkcommand(command)
+        parameters=' "'+Image_File+'" -x y z "'+tempdir+'T1.nii"'
         run(command,parameters)
-        #rename files
-        rename(tempdir+'fT1_bet_pve_0.nii', tempdir+'T1_CSF.nii')
-        rename(tempdir+'fT1_bet_pve_1.nii', tempdir+'T1_GM.nii')
-        rename(tempdir+'fT1_bet_pve_2.nii', tempdir+'T1_WM.nii')
-    else: # FSL v5 on linux
-        # Brain Extraction BET2 
-        command=resourcedir+'bet2'; checkcommand(command)
-        parameters=' "'+tempdir+'T1.nii" "'+tempdir+'T1_BET.nii"'
-        run(command,parameters)      
-        # Segmentation  (windows version only works with analyze images)
-        command=resourcedir+'fast'; checkcommand(command)
-        parameters=' "'+tempdir+'T1_BET.nii"' # no option switches default is OK in FSL v5
+    if os.path.isfile(tempdir+'T1.nii'): store(['T1.nii'])
+    # ----- check NIFTI file (neurological axial required) -----
+    if not os.path.isfile(tempdir+'T1.nii'): lprint ('ERROR:  NIFTI file not found '); exit(1)
+    # the header is read once in Python and kept for the rest of the run (replaces fslhd)
+    try: T1_header = header_info(tempdir+'T1.nii')
+    except: lprint ('ERROR:  Problem reading NIFTI header '); exit(1)
+    if debug:
+        logwrite ('T1.nii dims '+str(T1_header.dims)+', pixdims '+str(T1_header.pixdims))
+        logwrite ('qform '+T1_header.qform_name+' '+str(T1_header.qform_orient))
+        logwrite ('sform '+T1_header.sform_name+' '+str(T1_header.sform_orient))
+    neurological_axial = ('Left-to-Right', 'Posterior-to-Anterior', 'Inferior-to-Superior')
+    if T1_header.qform_name!='Scanner Anat' or T1_header.qform_orient!=neurological_axial: 
+        lprint ('ERROR:  could not locate NIFTI information confirming neurological axial'); exit(1)
+    if T1_header.sform_name!='Scanner Anat' or T1_header.sform_orient!=neurological_axial: 
+        lprint ('ERROR:  could not locate NIFTI information confirming neurological axial'); exit(1)
+    profile_end(event)
+
+    # ----- extract Image transformations -----
+    event = profile_begin('geometry')
+    lprint ('Extracting transformation matrix from Image')
+    qform = T1_header.qform.flatten().tolist() # this matrix still contains scalings
+    # get image dimensions
+    Image_size_X, Image_size_Y, Image_size_Z = T1_header.dims
+    Image_Resolution_X, Image_Resolution_Y, Image_Resolution_Z = T1_header.pixdims
+    Image_center_X = int(Image_size_X/2)
+    Image_center_Y = int(Image_size_Y/2)
+    Image_center_Z = int(Image_size_Z/2)
+    # image center as origin of the NIFTI files written (see reset_NIFTI_header)
+    origin = (Image_center_X*Image_Resolution_X, 
+             -Image_center_Y*Image_Resolution_Y, 
+             -Image_center_Z*Image_Resolution_Z)
+
+    # ----- extract Spectrum transformations -----
+    lprint ('Extracting transformation matrix from Spectrum')
+    # all rotations/translations are calculated in memory, see MRSpeCS_Geometry.py
+    for voxel in voxels:
+        try:
+            voxel['geometry'] = SpectroGeometry(qform,
+                (Image_size_X, Image_size_Y, Image_size_Z),
+                (Image_Resolution_X, Image_Resolution_Y, Image_Resolution_Z),
+                voxel['size'], voxel['offset'], voxel['rot'])
+        except: lprint ('ERROR:  Problem calculating the spectro transformation'); exit(1)
+    profile_end(event)
+
+    # ----- processing stages -----
+    # the stages run as soon as the stages they depend on are done (see run_stages),
+    # Spectro BOX generation and segmentation run at the same time
+    def stage_isocenter (): # apply transformation (debug mode only)
+        for voxel in voxels:
+            geometry = voxel['geometry']
+            for name in ['Image2Isocenter', 'SpectroTransformation', 'Spectro2ImageTransformation']:
+                logwrite (name+voxel['suffix']+' = '+str(getattr(geometry, name).round(6).tolist()))
+        voxels[0]['geometry'].write_mat(tempdir, ['Image2Isocenter']) # needed by flirt (same for all)
+        print ('Applying   transformation matrix to NIFTI')
+        command=resourcedir+'flirt'; checkcommand(command)
+        parameters=' -in "'+tempdir+'T1.nii" -ref "'+tempdir+'T1.nii"'
+        parameters+=' -out "'+tempdir+'T1_Isocenter.nii"'
+        parameters+=' -init "'+tempdir+'Image2Isocenter.mat" -applyxfm'
         run(command,parameters)
-        #rename files
-        rename(tempdir+'T1_BET_pve_0.nii', tempdir+'T1_CSF.nii')
-        rename(tempdir+'T1_BET_pve_1.nii', tempdir+'T1_GM.nii')
-        rename(tempdir+'T1_BET_pve_2.nii', tempdir+'T1_WM.nii')
-    # now we are back identical for both systems
-    # clean up NIFTI header 
-    reset_NIFTI_header ('"'+tempdir+'T1_CSF.nii"')
-    reset_NIFTI_header ('"'+tempdir+'T1_GM.nii"')
-    reset_NIFTI_header ('"'+tempdir+'T1_WM.nii"')
-
- 
-    # Extracting values
-    command=resourcedir+'fslmeants'; checkcommand(command)
-    parameters=' -i "'+tempdir+'T1_CSF.nii" -m "'+tempdir+'SpectroBOX.nii"'
-    output = run(command,parameters).decode('ascii').split(' ')
-    CSF_frac=float(output[0])
-    parameters=' -i "'+tempdir+'T1_GM.nii" -m "'+tempdir+'SpectroBOX.nii"'
-    output = run(command,parameters).decode('ascii').split(' ')
-    GM_frac=float(output[0])
-    parameters=' -i "'+tempdir+'T1_WM.nii" -m "'+tempdir+'SpectroBOX.nii"'
-    output = run(command,parameters).decode('ascii').split(' ')
-    WM_frac=float(output[0])
-    # normalize sum to 1.0 (raw outputs are always around 0.985, duno why)
-    total=CSF_frac+GM_frac+WM_frac
-    CSF_frac = CSF_frac/total
-    GM_frac = GM_frac/total
-    WM_frac = WM_frac/total
-    # calculate correction factor
-    # Water Conc. = F(GM)*43300mM + F(WM)*35880mM + F(CSF)*55556mM / (1-F(CFS))
-    # http://s-provencher.com/pub/LCModel/manual/manual.pdf (page 131)
-    WCONC =  (GM_frac*43300. + WM_frac*35880. + CSF_frac*55556.)/(1.-CSF_frac)
-    WCONC = str(int(WCONC))
-    CSF_frac = "%.6f" % CSF_frac
-    GM_frac  = "%.6f" % GM_frac
-    WM_frac  = "%.6f" % WM_frac
-
-    #write Results
-    lprint ('   CSF:   '+str(CSF_frac))
-    lprint ('   GM:    '+str(GM_frac))
-    lprint ('   WM:    '+str(WM_frac))
-    lprint ('WCONC:    '+str(WCONC))
-    f = open(tempdir+Program_name+'_Results.txt', 'w')
-    f.write(Program_name+space+Program_version+' Results:\n')
-    f.write('CSF \tGM \tWM \tWCONC \tImage_File \tSpectro_File \tbasedir\n')  
-    f.write(str(CSF_frac)+' \t')
-    f.write(str(GM_frac)+' \t')
-    f.write(str(WM_frac)+' \t')
-    f.write(str(WCONC)+' \t')
-    f.write(Image_File+' \t')
-    f.write(Spectro_File+' \t')
-    f.write(basedir+' \n') 
+        reset_NIFTI_header (tempdir+'T1_Isocenter.nii', origin)
+    def stage_reset_T1 (): # clean up NIFTI header (flirt above still needs the original)
+        reset_NIFTI_header (tempdir+'T1.nii', origin)
+        # intensity range in the header, the reports then only read the slices shown
+        try: set_display_range(tempdir+'T1.nii')
+        except: lprint ('ERROR:  Problem reading NIFTI Image'); exit(1)
+
+    def stage_box ():
+        lprint ('Generating Spectro BOX')
+        # the box (spectro size, centered in the image) is rasterized directly in image space
+        # with --pvbox as partial volume weights (fraction of the voxel inside the box)
+        # with several spectro voxels SpectroBOX.nii is a label volume (1,2,.. in voxel order)
+        if len(voxels)>1: 
+            if len(voxels)<256: Labels = np.zeros((Image_size_X, Image_size_Y, Image_size_Z), dtype=np.uint8)
+            else: Labels = np.zeros((Image_size_X, Image_size_Y, Image_size_Z), dtype=np.uint16)
+        for label, voxel in enumerate(voxels):
+            geometry = voxel['geometry']; suffix = voxel['suffix']
+            try:
+                if pvbox: 
+                    Box_lo, Box_data = geometry.box_weights('Spectro2ImageTransformation')
+                    Box_volume = geometry.box_volume(Box_lo, Box_data, dtype=Box_data.dtype)
+                else: 
+                    Box_lo, Box_data = geometry.box('Spectro2ImageTransformation')
+                    Box_volume = geometry.box_volume(Box_lo, Box_data)
+                write_volume(tempdir+'SpectroBOX'+suffix+'.nii', Box_volume, tempdir+'T1.nii')
+                del Box_volume
+                if len(voxels)>1: # the box above, later voxels overwrite overlaps
+                    if pvbox: mask = Box_data>0
+                    else: mask = Box_data
+                    hi = [Box_lo[i]+mask.shape[i] for i in range(3)]
+                    region = Labels[Box_lo[0]:hi[0], Box_lo[1]:hi[1], Box_lo[2]:hi[2]]
+                    overlap = int(np.count_nonzero(region[mask]))
+                    region[mask] = label+1
+                if debug: # same box at the isocenter, before the inverse image transformation
+                    lo, mask = geometry.box('SpectroTransformation')
+                    write_volume(tempdir+'SpectroBOX_Isocenter'+suffix+'.nii', geometry.box_volume(lo, mask), tempdir+'T1.nii')
+            except: lprint ('ERROR:  Problem generating Spectro BOX'+suffix); exit(1)
+            if len(voxels)>1 and overlap>0:
+                logwrite ('WARNING: Spectro BOX'+suffix+' overlaps earlier boxes ('+str(overlap)+' voxels relabeled)')
+            if debug: logwrite ('Spectro BOX'+suffix+' voxels  '+str(float(Box_data.sum())))
+            if not Box_data.any(): lprint ('ERROR:  Spectro BOX'+suffix+' outside of the image'); exit(1)
+            voxel['Box_lo'] = Box_lo; voxel['Box_data'] = Box_data
+            # clean up NIFTI header
+            reset_NIFTI_header (tempdir+'SpectroBOX'+suffix+'.nii', origin)
+            if debug: reset_NIFTI_header (tempdir+'SpectroBOX_Isocenter'+suffix+'.nii', origin)
+        if len(voxels)>1:
+            try: write_volume(tempdir+'SpectroBOX.nii', Labels, tempdir+'T1.nii')
+            except: lprint ('ERROR:  Problem generating Spectro BOX'); exit(1)
+        if len(voxels)>1: reset_NIFTI_header (tempdir+'SpectroBOX.nii', origin)
+
+
+    def stage_segmentation ():
+        # the maps are stored with the header already reset and not modified here, so linked
+        # (the outputs are copies though, see copy-out, the cache must not be handed out)
+        if cached(['T1_CSF.nii', 'T1_GM.nii', 'T1_WM.nii'], link=True): 
+            lprint ('Using cached Segmentation'); return
+        if seg_profile=='standard': lprint ('Running    Segmentation')
+        else: lprint ('Running    Segmentation ('+seg_profile+')')
+        Seg_File = 'T1.nii'
+        if downsample>1: # preview: segmentation of a downsampled image, pasted back below
+            try: downsample_volume(tempdir+'T1.nii', tempdir+'T1_small.nii', downsample)
+            except: lprint ('ERROR:  Problem downsampling NIFTI Image'); exit(1)
+            Seg_File = 'T1_small.nii'
+        if sys.platform=="win32": # from here on things go differently for a while
+            # the FAST segmentation tool under windows doesn't like NIFTI, so first transform to Analyze
+            analyze_env = my_env.copy(); analyze_env["FSLOUTPUTTYPE"] = "ANALYZE" # set FSLOUTPUTTYPE=ANALYZE
+            # convert Image to ANALYZE
+            command=resourcedir+'dcm2nii'; checkcommand(command)
+            parameters=' -n N -s Y -m N "'+tempdir+Seg_File+'"'
+            run(command,parameters,analyze_env)          
+            # Brain Extraction BET2 
+            command=resourcedir+'bet2'; checkcommand(command)
+            parameters=' "'+tempdir+'f'+os.path.splitext(Seg_File)[0]+'.hdr" "'+tempdir+'T1_BET"'
+            run(command,parameters,analyze_env)      
+            # Segmentation  (windows version only works with analyze images)
+            command=resourcedir+'fast'; checkcommand(command)
+            # see conversion table at the end of https://fsl.fmrib.ox.ac.uk/fsl/fslwiki/FAST
+            parameters=fast_parameters+' "'+tempdir+'T1_BET.img"'
+            run(command,parameters,analyze_env)    
+            # transform ANALYZE results back to NIFTI
+            lprint ('Measuring  Compartments')
+            command=resourcedir+'dcm2nii'; checkcommand(command)
+            parameters=' -n Y -m N -g N "'+tempdir+'T1_bet_pve_0.img"'
+            run(command,parameters,analyze_env)
+            parameters=' -n Y -m N -g N "'+tempdir+'T1_bet_pve_1.img"'
+            run(command,parameters,analyze_env)
+            parameters=' -n Y -m N -g N "'+tempdir+'T1_bet_pve_2.img"'
+            run(command,parameters,analyze_env)
+            #rename files
+            rename(tempdir+'fT1_bet_pve_0.nii', tempdir+'T1_CSF.nii')
+            rename(tempdir+'fT1_bet_pve_1.nii', tempdir+'T1_GM.nii')
+            rename(tempdir+'fT1_bet_pve_2.nii', tempdir+'T1_WM.nii')
+        else: # FSL v5 on linux
+            # Brain Extraction BET2 
+            command=resourcedir+'bet2'; checkcommand(command)
+            parameters=' "'+tempdir+Seg_File+'" "'+tempdir+'T1_BET.nii"'
+            run(command,parameters)      
+            # crop to the brain, FAST time and memory scale with the number of voxels
+            # (voxels outside the brain are zero after BET and not segmented anyway)
+            try:
+                margin = [int(np.ceil(crop_margin/size)) for size in header_info(tempdir+'T1_BET.nii').pixdims]
+                Brain = nonzero_bounds(tempdir+'T1_BET.nii', margin)
+            except: lprint ('ERROR:  Problem reading brain extraction'); exit(1)
+            if Brain==None: lprint ('ERROR:  Brain extraction is empty'); exit(1)
+            if debug: logwrite ('Brain bounding box  '+str(Brain[0])+' - '+str(Brain[1]))
+            try: crop_volume(tempdir+'T1_BET.nii', tempdir+'T1_BET_crop.nii', Brain[0], Brain[1])
+            except: lprint ('ERROR:  Problem cropping brain extraction'); exit(1)
+            # Segmentation  (windows version only works with analyze images)
+            command=resourcedir+'fast'; checkcommand(command)
+            parameters=fast_parameters+' "'+tempdir+'T1_BET_crop.nii"'
+            run(command,parameters)
+            # paste back into the full image (geometry from T1_BET.nii)
+            try:
+                uncrop_volume(tempdir+'T1_BET_crop_pve_0.nii', tempdir+'T1_CSF.nii', Brain[0], tempdir+'T1_BET.nii')
+                uncrop_volume(tempdir+'T1_BET_crop_pve_1.nii', tempdir+'T1_GM.nii', Brain[0], tempdir+'T1_BET.nii')
+                uncrop_volume(tempdir+'T1_BET_crop_pve_2.nii', tempdir+'T1_WM.nii', Brain[0], tempdir+'T1_BET.nii')
+            except: lprint ('ERROR:  Problem reading segmentation'); exit(1)
+        # now we are back identical for both systems
+        if downsample>1: # back to the voxel grid of T1.nii
+            for name in ['T1_CSF', 'T1_GM', 'T1_WM']:
+                rename(tempdir+name+'.nii', tempdir+name+'_small.nii')
+                try: uncrop_volume(tempdir+name+'_small.nii', tempdir+name+'.nii', (0,0,0), tempdir+'T1.nii', downsample)
+                except: lprint ('ERROR:  Problem upsampling segmentation'); exit(1)
+        # clean up NIFTI header 
+        reset_NIFTI_header (tempdir+'T1_CSF.nii', origin)
+        reset_NIFTI_header (tempdir+'T1_GM.nii', origin)
+        reset_NIFTI_header (tempdir+'T1_WM.nii', origin)
+        store(['T1_CSF.nii', 'T1_GM.nii', 'T1_WM.nii'])
+
+     
+    def stage_measure ():
+        # Extracting values, all maps in one pass over the sub-grid of all boxes
+        try: 
+            Box_sums = measure_boxes([(voxel['Box_lo'], voxel['Box_data']) for voxel in voxels], 
+                {'CSF': tempdir+'T1_CSF.nii', 'GM': tempdir+'T1_GM.nii', 'WM': tempdir+'T1_WM.nii'})
+        except: lprint ('ERROR:  Problem measuring compartments'); exit(1)
+        for voxel, sums in zip(voxels, Box_sums):
+            # normalize sum to 1.0 (raw mean values are always around 0.985, duno why)
+            if debug: logwrite ('Compartment means normalization '+str(sums['total']))
+            total=sums['CSF']+sums['GM']+sums['WM']
+            CSF_frac = sums['CSF']/total
+            GM_frac = sums['GM']/total
+            WM_frac = sums['WM']/total
+            # calculate correction factor
+            # Water Conc. = F(GM)*43300mM + F(WM)*35880mM + F(CSF)*55556mM / (1-F(CFS))
+            # http://s-provencher.com/pub/LCModel/manual/manual.pdf (page 131)
+            WCONC =  (GM_frac*43300. + WM_frac*35880. + CSF_frac*55556.)/(1.-CSF_frac)
+            WCONC = int(WCONC)
+            voxel['CSF'] = CSF_frac; voxel['GM'] = GM_frac; voxel['WM'] = WM_frac; voxel['WCONC'] = WCONC
+
+        #write Results, one line per spectro voxel
+        def write_results (filename, voxels):
+            f = open(filename, 'w')
+            f.write(Program_name+space+Program_version+' Results:\n')
+            f.write('CSF \tGM \tWM \tWCONC \tImage_File \tSpectro_File \tbasedir\n')  
+            for voxel in voxels:
+                f.write("%.6f" % voxel['CSF']+' \t')
+                f.write("%.6f" % voxel['GM']+' \t')
+                f.write("%.6f" % voxel['WM']+' \t')
+                f.write(str(voxel['WCONC'])+' \t')
+                f.write(Image_File+' \t')
+                f.write(voxel['Spectro_File']+' \t')
+                f.write(basedir+' \n') 
+            f.close()
+        for voxel in voxels:
+            if len(voxels)>1: lprint ('Spectro    '+os.path.basename(voxel['Spectro_File']))
+            lprint ('   CSF:   '+"%.6f" % voxel['CSF'])
+            lprint ('   GM:    '+"%.6f" % voxel['GM'])
+            lprint ('   WM:    '+"%.6f" % voxel['WM'])
+            lprint ('WCONC:    '+str(voxel['WCONC']))
+            if seg_profile=='preview': lprint ('          (preview, approximate, see --validate for the expected deviation)')
+        write_results (tempdir+Program_name+'_Results.txt', voxels)
+
+    def stage_report_images (): # box from memory, T1 memory mapped, while the segmentation runs
+        for voxel in voxels:
+            try: voxel['report_images'] = render_report(tempdir+'T1.nii', voxel['Box_data'], voxel['Box_lo'], report_dpi)
+            except Exception as error: voxel['report_images'] = error # reported by stage_report
+    def stage_report (): # the fractions (stage_measure) and the pages
+        for voxel in voxels:
+            suffix = voxel['suffix']; images = voxel.pop('report_images')
+            try: 
+                if isinstance(images, Exception): raise images
+                write_report (tempdir+'T1.nii', voxel['Box_data'], voxel['Box_lo'], voxel, tempdir+Program_name+"_Report"+suffix+".pdf", report_dpi, images)
+                lprint ("PDF report"+suffix+" generated")
+            except: lprint ("PDF report"+suffix+" generation failed ("+str(sys.exc_info()[1])+")")
+
+    stages = [('reset_T1', stage_reset_T1, []), ('box', stage_box, ['reset_T1'])]
+    if debug: stages = [('isocenter', stage_isocenter, [])] + [(name, function, ['isocenter']+after) for name, function, after in stages]
+    if not nosegmentation:
+        stages += [('segmentation', stage_segmentation, ['reset_T1']),
+                   ('measure', stage_measure, ['box', 'segmentation'])]
+    if report=='inline': # the images while the segmentation runs, the pages with the fractions
+        stages += [('report_images', stage_report_images, ['box'])]
+        if nosegmentation: stages += [('report', stage_report, ['report_images'])]
+        else: stages += [('report', stage_report, ['measure', 'report_images'])]
+    run_stages (stages)
+
+    # output files
+    event = profile_begin('copy-out')
+    names = ['T1.nii', 'SpectroBOX.nii']
+    if len(voxels)>1: names += ['SpectroBOX'+voxel['suffix']+'.nii' for voxel in voxels]
+    # (reports only if generated, a failed report is not fatal, see stage_report)
+    names += [Program_name+'_Report'+voxel['suffix']+'.pdf' for voxel in voxels 
+              if os.path.isfile(tempdir+Program_name+'_Report'+voxel['suffix']+'.pdf')]
+    if debug: 
+        names += ['T1_Isocenter.nii']
+        names += ['SpectroBOX_Isocenter'+voxel['suffix']+'.nii' for voxel in voxels]
+    if not nosegmentation: 
+        names += ['T1_CSF.nii', 'T1_GM.nii', 'T1_WM.nii', Program_name+'_Results.txt']
+    # name collision detection
+    stp=''
+    for name in names:
+        if os.path.isfile(basedir+name): stp=timestamp+ID+'_' 
+    # get output results
+    outputs = {}
+    for name in names: # move to the output directory, remember where it went
+        if os.stat(tempdir+name).st_nlink>1: # hardlinked from the cache (see cached), publish a copy
+            copy (tempdir+name, tempdir+'unlinked_'+name); rename (tempdir+'unlinked_'+name, tempdir+name)
+        try: method = publish_file (tempdir+name, basedir+stp+name)
+        except: lprint ('ERROR:  Unable to move file '+tempdir+name); exit(1)
+        if debug: logwrite ('Output '+name+' ('+method+')')
+        outputs[name] = basedir+stp+name
+    profile_end(event)
+    if report=='background': # from the published T1.nii, the boxes are still in memory
+        reports = [(outputs['T1.nii'], voxel['Box_data'], voxel['Box_lo'], 
+                    dict([(key, voxel.get(key)) for key in ['CSF', 'GM', 'WM', 'WCONC']]),
+                    basedir+stp+Program_name+'_Report'+voxel['suffix']+'.pdf', report_dpi) for voxel in voxels]
+        thread = threading.Thread(target=_background_reports, args=(reports, logname, ID), name='report')
+        thread.start(); report_threads.append(thread)
+        lprint ('PDF report in background')
+            
+
+    #delete tempdir
+    try: shutil.rmtree(tempdir)
+    except: pass # silent
+    tempdir = ''
+    profile_end(case_event); profile_stop()
+    if resource!=None: # of this process, for the memory needed per case
+        case_event['args']['peak_rss_self'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*(1 if sys.platform=='darwin' else 1024)
+    if options.get('profile', ''):
+        try: write_profile(options['profile'])
+        except: lprint ('ERROR:  Problem writing profile '+options['profile']); exit(1)
+        logwrite ('Timings written to  '+options['profile']+', '+trace_filename(options['profile']))
+    lprint ('done\n')
+    for voxel in voxels:
+        voxel['matrices'] = dict([(name, getattr(voxel['geometry'], name).copy()) for name in voxel['geometry'].matrices])
+        voxel['SpectroBOX'] = outputs['SpectroBOX'+voxel['suffix']+'.nii']
+        for key in ['geometry', 'size', 'offset', 'rot', 'Box_lo', 'Box_data']: del voxel[key]
+        for key in ['CSF', 'GM', 'WM', 'WCONC']: voxel.setdefault(key, None)
+    return {'CSF': voxels[0]['CSF'], 'GM': voxels[0]['GM'], 'WM': voxels[0]['WM'], 'WCONC': voxels[0]['WCONC'],
+            'matrices': voxels[0]['matrices'], 'voxels': voxels,
+            'outputs': outputs, 'timings': profile_tree(),
+            'Image_File': Image_File, 'Spectro_File': voxels[0]['Spectro_File'], 'outdir': basedir}
+
+# ----- batch processing -----
+batch_memory = 2*1024**3 # memory needed per parallel case (FAST on a 1mm 3DT1)
+output_names = ['T1.nii', 'SpectroBOX.nii', 'T1_Isocenter.nii', 'SpectroBOX_Isocenter.nii',
+                'T1_CSF.nii', 'T1_GM.nii', 'T1_WM.nii']
+def _find_case_files (directory):
+    # input files of a case directory: the spectro is a .SPAR file (or a DICOM XX* file),
+    # with several .SPAR files the directory (all spectro voxels, see spectro_files)
+    # the image is a .nii/.nii.gz file (not written by MRSpeCS) or the largest DICOM file
+    Image_File = ''; Spectro_File = ''; DICOM_Files = []; SPAR_Files = 0
+    for name in sorted(os.listdir(directory)):
+        file = os.path.join(directory, name)
+        if not os.path.isfile(file): continue
+        if name.lower().endswith('.spar'): 
+            SPAR_Files += 1
+            if Spectro_File=='' or not os.path.basename(Spectro_File).lower().endswith('.spar'): Spectro_File = file
+        elif name.lower().endswith('.nii') or name.lower().endswith('.nii.gz'):
+            if name.startswith('SpectroBOX'): continue # also the per voxel boxes
+            if not [True for output in output_names if name==output or name.endswith('_'+output)]:
+                if Image_File=='': Image_File = file
+        elif isDICOM(file):
+            if name.startswith('XX'): # other XX* files (e.g. images) are skipped
+                if Spectro_File=='' and isSpectroDICOM(file): Spectro_File = file
+            else: DICOM_Files.append((os.path.getsize(file), file))
+    if Image_File=='' and len(DICOM_Files)>0: Image_File = max(DICOM_Files)[1]
+    if SPAR_Files>1: Spectro_File = directory
+    return Image_File, Spectro_File
+def batch_cases (batch):
+    # list of (Image_File, Spectro_File, outdir) from a manifest or a root directory
+    # manifest: CSV file with lines image,spectro[,outdir] (relative to the manifest,
+    #           outdir defaults to the directory of the image)
+    # root directory: every subdirectory is one case, output goes to the subdirectory
+    cases = []
+    if os.path.isdir(batch):
+        for name in sorted(os.listdir(batch)):
+            directory = os.path.join(os.path.abspath(batch), name)
+            if not os.path.isdir(directory) or name.startswith('.'): continue
+            Image_File, Spectro_File = _find_case_files(directory)
+            if Image_File=='' or Spectro_File=='':
+                lprint ('WARNING: no image/spectro found in '+directory+', skipped'); continue
+            cases.append((Image_File, Spectro_File, directory))
+        spectro_header_forget() # the spectro headers of the scan, the cases read them again
+        return cases
+    manifest_dir = os.path.dirname(os.path.abspath(batch))
+    try: rows = list(csv.reader(open(batch, 'r')))
+    except: lprint ('ERROR:  Problem reading batch manifest '+batch); exit(1)
+    for row in rows:
+        row = [value.strip() for value in row]
+        if len(row)==0 or row[0]=='' or row[0].startswith('#'): continue
+        if row[0].lower()=='image': continue # header line
+        if len(row)<2: lprint ('ERROR:  batch manifest line without spectro: '+','.join(row)); exit(1)
+        Image_File = os.path.join(manifest_dir, row[0])
+        Spectro_File = os.path.join(manifest_dir, row[1])
+        if len(row)>2 and row[2]!='': outdir = os.path.join(manifest_dir, row[2])
+        else: outdir = os.path.dirname(Image_File)
+        cases.append((Image_File, Spectro_File, outdir))
+    return cases
+def batch_processes ():
+    # number of cases processed in parallel: one per core, as far as the memory allows
+    try: processes = multiprocessing.cpu_count()
+    except: processes = 1
+    try:
+        for line in open('/proc/meminfo'):
+            if line.startswith('MemAvailable:'):
+                memory = int(line.split()[1])*1024
+                processes = min(processes, max(1, int(memory/batch_memory)))
+    except: pass # not on linux, cores only
+    return processes
+def _batch_init ():
+    # pool processes leave Ctrl-C/kill to the batch process, which terminates the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+def _batch_case (case):
+    # one case of run_batch (in a pool process), console output goes to the case's logfile only
+    index, Image_File, Spectro_File, outdir, options = case
+    sys.stdout = open(os.devnull, 'w')
+    if options.get('profile', ''): # the timings of every case go to its output directory
+        options = options.copy(); options['profile'] = os.path.join(outdir, os.path.basename(options['profile']))
+    try: 
+        results = run_mrspecs(Image_File, Spectro_File, outdir, options); status = 'done'
+        del results['matrices']
+        for voxel in results['voxels']: del voxel['matrices']
+    except MRSpeCSError as error: results = None; status = error.message or 'ERROR'
+    except Exception as error: results = None; status = 'ERROR:  '+str(error)
+    wait_reports() # before the pool takes the next case
+    close_log()
+    return index, status, results
+def run_batch (batch, basedir, options=None, processes=None):
+    # process all cases of a manifest/root directory (see batch_cases) in parallel,
+    # cases with results from previous runs are skipped, all results are collected in
+    # <basedir>/<Program_name>_Batch_Results.txt
+    if options==None: options = {}
+    cases = batch_cases(batch)
+    if len(cases)==0: lprint ('ERROR:  No cases found in '+batch); exit(1)
+    if processes==None: processes = batch_processes()
+    trigger = Program_name+'_Results.txt'
+    if options.get('noseg', False): trigger = 'SpectroBOX.nii'
+    rows = [None]*len(cases); todo = []
+    for index, (Image_File, Spectro_File, outdir) in enumerate(cases):
+        if os.path.isfile(os.path.join(outdir, trigger)):
+            lprint ('Already done: '+outdir)
+            rows[index] = 'already done'
+        else: todo.append((index, Image_File, Spectro_File, outdir, options))
+    lprint ('Processing '+str(len(todo))+' of '+str(len(cases))+' cases, '+str(processes)+' in parallel')
+    pool = multiprocessing.Pool(processes, _batch_init)
+    try:
+        for index, status, results in pool.imap_unordered(_batch_case, todo):
+            rows[index] = status
+            if results!=None: rows[index] = results
+            lprint (status.split('\n')[0]+': '+cases[index][2])
+    except: pool.terminate(); raise
+    pool.close(); pool.join()
+    # consolidated results, one line per case (per spectro voxel)
+    f = open(basedir+Program_name+'_Batch_Results.txt', 'w')
+    f.write(Program_name+space+Program_version+' Batch Results:\n')
+    f.write('CSF \tGM \tWM \tWCONC \tImage_File \tSpectro_File \tbasedir \tstatus\n')
+    errors = 0
+    for (Image_File, Spectro_File, outdir), row in zip(cases, rows):
+        lines = [['', '', '', '', Image_File, Spectro_File, os.path.abspath(outdir)+slash]]
+        if isinstance(row, dict):
+            lines = []
+            for voxel in row['voxels']:
+                line = ['', '', '', '', Image_File, voxel['Spectro_File'], os.path.abspath(outdir)+slash]
+                if voxel['CSF']!=None: 
+                    line[0:4] = ["%.6f" % voxel['CSF'], "%.6f" % voxel['GM'], "%.6f" % voxel['WM'], str(voxel['WCONC'])]
+                lines.append(line)
+            row = 'done'
+        elif row=='already done':
+            if trigger.endswith('.txt'): # take results from previous run
+                try: lines = [line.rstrip(' \n').split(' \t') for line in open(os.path.join(outdir, trigger)).readlines()[2:]]
+                except: row = 'already done, '+trigger+' unreadable'
+        else: errors += 1
+        for line in lines: f.write(' \t'.join(line)+' \t'+row.replace('\n',' ')+'\n')
     f.close()
+    lprint ('Batch results in '+basedir+Program_name+'_Batch_Results.txt')
+    if errors>0: lprint ('WARNING: '+str(errors)+' cases failed, see the status column of '+Program_name+'_Batch_Results.txt and their logfiles')
+    if not options.get('noseg', False) and options.get('report', 'inline')!='none':
+        outdirs = []
+        for Image_File, Spectro_File, outdir in cases: 
+            if not outdir in outdirs: outdirs.append(outdir)
+        batch_summary (outdirs, basedir+Program_name+'_Batch_Summary.pdf', processes)
+    return rows
+def validate_profile (batch, basedir, options=None, processes=None, reference='standard'):
+    # runs all cases of a manifest/root directory (see batch_cases) with the segmentation
+    # profile of options (default 'preview') and with the reference profile, the 
+    # differences of the fractions per spectro voxel go to 
+    # <basedir>/<Program_name>_Validation_<profile>.txt, the runs to <Program_name>_Validation/
+    # returns the mean and maximum absolute differences by compartment
+    if options==None: options = {}
+    profile = options.get('seg_profile', 'preview')
+    for name in (profile, reference):
+        if not name in seg_profiles: 
+            lprint ('ERROR:  Unknown segmentation profile "'+str(name)+'" (use '+'/'.join(sorted(seg_profiles))+')')
+            exit(2)
+    cases = batch_cases(batch)
+    if len(cases)==0: lprint ('ERROR:  No cases found in '+batch); exit(1)
+    if processes==None: processes = batch_processes()
+    workdir = basedir+Program_name+'_Validation'+slash
+    todo = []
+    for index, (Image_File, Spectro_File, outdir) in enumerate(cases):
+        for name in (profile, reference):
+            directory = workdir+'case'+str(index+1)+'_'+name
+            if os.path.isdir(directory): shutil.rmtree(directory) # from a previous validation
+            os.makedirs(directory)
+            run_options = options.copy(); run_options['seg_profile'] = name; run_options['noseg'] = False
+            todo.append(((index, name), Image_File, Spectro_File, directory, run_options))
+    lprint ('Validating '+profile+' against '+reference+' on '+str(len(cases))+' cases, '+str(processes)+' in parallel')
+    results = {}
+    pool = multiprocessing.Pool(processes, _batch_init)
+    try:
+        for (index, name), status, result in pool.imap_unordered(_batch_case, todo):
+            results[(index, name)] = result or status
+            lprint (status.split('\n')[0]+': case '+str(index+1)+' '+name)
+    except: pool.terminate(); raise
+    pool.close(); pool.join()
+    # differences per spectro voxel
+    compartments = ['CSF', 'GM', 'WM', 'WCONC']
+    differences = dict([(compartment, []) for compartment in compartments])
+    f = open(basedir+Program_name+'_Validation_'+profile+'.txt', 'w')
+    f.write(Program_name+space+Program_version+' Validation '+profile+' - '+reference+':\n')
+    f.write('dCSF \tdGM \tdWM \tdWCONC \tImage_File \tSpectro_File \tstatus\n')
+    for index, (Image_File, Spectro_File, outdir) in enumerate(cases):
+        result, expected = results[(index, profile)], results[(index, reference)]
+        if not isinstance(result, dict) or not isinstance(expected, dict):
+            status = [value for value in (result, expected) if not isinstance(value, dict)][0]
+            f.write(' \t \t \t \t'+Image_File+' \t'+str(Spectro_File)+' \t'+status.replace('\n',' ')+'\n')
+            continue
+        for voxel, reference_voxel in zip(result['voxels'], expected['voxels']):
+            line = []
+            for compartment in compartments:
+                difference = voxel[compartment]-reference_voxel[compartment]
+                differences[compartment].append(abs(difference))
+                if compartment=='WCONC': line.append(str(difference))
+                else: line.append("%.6f" % difference)
+            f.write(' \t'.join(line)+' \t'+Image_File+' \t'+voxel['Spectro_File']+' \tdone\n')
+    summary = {}
+    for compartment in compartments:
+        if len(differences[compartment])==0: continue
+        summary[compartment] = (sum(differences[compartment])/len(differences[compartment]), max(differences[compartment]))
+    for row, title in [(0, 'mean |difference|'), (1, 'max |difference|')]:
+        if len(summary)==0: break
+        line = ["%.6f" % summary[compartment][row] for compartment in compartments[0:3]]
+        f.write(' \t'.join(line)+' \t'+"%.0f" % summary['WCONC'][row]+' \t'+title+'\n')
+    f.close()
+    if len(summary)==0: lprint ('ERROR:  No case could be validated, for details see their logfiles'); exit(1)
+    lprint (profile+' - '+reference+' in '+str(len(differences['CSF']))+' spectro voxels, mean / max |difference|:')
+    for compartment in compartments[0:3]:
+        lprint ('   '+(compartment+':').ljust(7)+"%.6f" % summary[compartment][0]+' / '+"%.6f" % summary[compartment][1])
+    lprint ('WCONC:    '+"%.0f" % summary['WCONC'][0]+' / '+"%.0f" % summary['WCONC'][1])
+    lprint ('Validation results in '+basedir+Program_name+'_Validation_'+profile+'.txt')
+    return summary
+def _noseg_suffixes (prefix, filenames):
+    # suffixes of the spectro voxels of a run without results file (--noseg), from
+    # the per voxel boxes prefix+'SpectroBOX_<name>.nii' (none with one voxel)
+    start = os.path.basename(prefix)+'SpectroBOX_'
+    suffixes = [name[len(start)-1:-len('.nii')] for name in filenames 
+                if name.startswith(start) and name.endswith('.nii') and not name.startswith(start+'Isocenter')]
+    if len(suffixes)==0: return ['']
+    return suffixes
+def _finished_runs (directory, recursive=True):
+    # the spectro voxels of the finished runs in directory (and its subdirectories):
+    # list of (prefix, suffix, line), the outputs are prefix+'T1.nii', 
+    # prefix+'SpectroBOX'+suffix+'.nii', .., line the voxel's line of the results file,
+    # None for runs without segmentation (SpectroBOX.nii and T1.nii, no results file)
+    # (outputs with the timestamp prefix of a name collision are included)
+    runs = []
+    for path, dirnames, filenames in os.walk(directory):
+        dirnames.sort()
+        if not recursive: del dirnames[:]
+        for name in sorted(filenames):
+            if name.endswith('SpectroBOX.nii'): # --noseg, the boxes only
+                prefix = os.path.join(path, name[:-len('SpectroBOX.nii')])
+                if os.path.basename(prefix)+Program_name+'_Results.txt' in filenames: continue # see below
+                if not os.path.basename(prefix)+'T1.nii' in filenames: continue
+                for suffix in _noseg_suffixes(prefix, sorted(filenames)): runs.append((prefix, suffix, None))
+            if not name.endswith(Program_name+'_Results.txt'): continue
+            prefix = os.path.join(path, name[:-len(Program_name+'_Results.txt')]) # the output names
+            try: lines = [line.rstrip(' \n').split(' \t') for line in open(prefix+Program_name+'_Results.txt').readlines()[2:]]
+            except: lprint ('WARNING: '+prefix+Program_name+'_Results.txt unreadable'); continue
+            # one line per spectro voxel, in the order of run_mrspecs
+            try: suffixes = voxel_suffixes([line[5] for line in lines])
+            except IndexError: lprint ('WARNING: '+prefix+Program_name+'_Results.txt unreadable'); continue
+            for line, suffix in zip(lines, suffixes): runs.append((prefix, suffix, line))
+    return runs
+def _fractions (line):
+    return {'CSF': float(line[0]), 'GM': float(line[1]), 'WM': float(line[2]), 'WCONC': int(line[3])}
+def report_only (directory, dpi=None):
+    # writes the missing PDF reports of finished runs (e.g. with report 'none') in
+    # directory and its subdirectories, from T1.nii, SpectroBOX*.nii and the results file
+    # (runs without segmentation: T1.nii and SpectroBOX*.nii, a report without fractions)
+    # (dpi of the images, see MRSpeCS_Report_arrays)
+    # returns the number of reports written
+    written = 0; failed = 0
+    for prefix, suffix, line in _finished_runs(directory):
+        PDF_File = prefix+Program_name+'_Report'+suffix+'.pdf'
+        if os.path.isfile(PDF_File): continue
+        try:
+            Box_data, Box_scaling = memmap_volume(prefix+'SpectroBOX'+suffix+'.nii')
+            fractions = None # without segmentation
+            if line!=None: fractions = _fractions(line)
+            try: write_report (prefix+'T1.nii', Box_data, (0,0,0), fractions, PDF_File, dpi)
+            finally: del Box_data
+            lprint ('PDF report written  '+PDF_File); written += 1
+        except: lprint ('PDF report '+PDF_File+' generation failed ('+str(sys.exc_info()[1])+')'); failed += 1
+    if written+failed==0: lprint ('No missing reports in '+directory)
+    return written
+def _summary_thumbnails (job):
+    # thumbnails of one spectro voxel for batch_summary (in a pool process)
+    index, T1_File, Box_File = job
+    try:
+        T1, T1_scaling = memmap_volume(T1_File)
+        Box_data, Box_scaling = memmap_volume(Box_File)
+        header = header_info(T1_File)
+        try: thumbnails = report_thumbnails(report_views(T1, header.pixdims, Box_data, (0,0,0), T1_scaling, _T1_max(header)))
+        finally: del T1, Box_data
+        return index, thumbnails, 'done'
+    except: return index, None, 'no images: '+str(sys.exc_info()[1])
+def batch_summary (directories, PDF_File, processes=None, recursive=False):
+    # one document with the results and thumbnails of all finished runs in
+    # directories (see MRSpeCS_Summary), the thumbnails are rendered in parallel
+    # (JPEG in memory) and the document is written in one pass
+    # returns the number of spectro voxels
+    rows = []; jobs = []
+    for directory in directories:
+        for prefix, suffix, line in _finished_runs(directory, recursive):
+            name = os.path.basename(os.path.dirname(prefix+'T1.nii'))+': '
+            if line==None: name += 'SpectroBOX'+suffix+'.nii' # without segmentation, no spectro name
+            else: name += os.path.basename(line[5])
+            try: fractions = _fractions(line)
+            except: fractions = None
+            jobs.append((len(rows), prefix+'T1.nii', prefix+'SpectroBOX'+suffix+'.nii'))
+            rows.append({'name': name, 'fractions': fractions, 'thumbnails': None, 'status': 'done'})
+    if len(rows)==0: lprint ('WARNING: No results for a summary'); return 0
+    if processes==None: processes = batch_processes()
+    lprint ('Summary of '+str(len(rows))+' spectro voxels, '+str(processes)+' in parallel')
+    pool = multiprocessing.Pool(processes, _batch_init)
+    try:
+        for index, thumbnails, status in pool.imap_unordered(_summary_thumbnails, jobs, 4):
+            rows[index]['thumbnails'] = thumbnails; rows[index]['status'] = status
+    except: pool.terminate(); raise
+    pool.close(); pool.join()
+    partial = os.path.join(os.path.dirname(PDF_File), '.'+os.path.basename(PDF_File)+'.partial'+str(os.getpid()))
+    try: 
+        MRSpeCS_Summary(rows, partial, Program_name+' Summary')
+        publish_file (partial, PDF_File)
+    except: delete (partial); lprint ('WARNING: Problem writing summary '+PDF_File); return 0 # results are there
+    lprint ('Summary in '+PDF_File)
+    return len(rows)
 
-try: 
-    MRSpeCS_Report(tempdir+'T1.nii', tempdir+'SpectroBOX.nii', tempdir+Program_name+'_Results.txt' , tempdir+Program_name+"_Report.pdf")
-    lprint ("PDF report generated")
-except: lprint ("PDF report generation failed")
-
-# name collision detection
-stp=''
-if os.path.isfile(basedir+'T1.nii'): stp=timestamp+ID+'_' 
-if os.path.isfile(basedir+'SpectroBOX.nii'): stp=timestamp+ID+'_'
-if os.path.isfile(basedir+'T1_Isocenter.nii'): stp=timestamp+ID+'_'
-if os.path.isfile(basedir+'SpectroBOX_Isocenter.nii'): stp=timestamp+ID+'_'
-if os.path.isfile(basedir+'T1_CSF.nii'): stp=timestamp+ID+'_'
-if os.path.isfile(basedir+'T1_GM.nii'): stp=timestamp+ID+'_'
-if os.path.isfile(basedir+'T1_WM.nii'): stp=timestamp+ID+'_'
-if os.path.isfile(basedir+Program_name+'_Results.txt'): stp=timestamp+ID+'_'
-if os.path.isfile(basedir+Program_name+'_Report.pdf'): stp=timestamp+ID+'_'
-# get output results
-copy (tempdir+'T1.nii', basedir+stp+'T1.nii')
-copy (tempdir+'SpectroBOX.nii', basedir+stp+'SpectroBOX.nii')
-copy (tempdir+Program_name+"_Report.pdf", basedir+stp+Program_name+'_Report.pdf')
-if debug: 
-    copy(tempdir+'T1_Isocenter.nii', basedir+stp+'T1_Isocenter.nii')
-    copy(tempdir+'SpectroBOX_Isocenter.nii', basedir+stp+'SpectroBOX_Isocenter.nii')
-if not nosegmentation:
-    copy(tempdir+'T1_CSF.nii', basedir+stp+'T1_CSF.nii')
-    copy(tempdir+'T1_GM.nii', basedir+stp+'T1_GM.nii')
-    copy(tempdir+'T1_WM.nii', basedir+stp+'T1_WM.nii')
-    copy(tempdir+Program_name+'_Results.txt', basedir+stp+Program_name+'_Results.txt')
-        
-
-#delete tempdir
-try: shutil.rmtree(tempdir)
-except: pass # silent
-lprint ('done\n')
-sys.stderr.close() # close logfile
-
-if pywin32_installed:
-    try: # reenable console windows close button (useful if called command line or batch file)
-        hwnd = win32console.GetConsoleWindow()
-        hMenu = win32gui.GetSystemMenu(hwnd, 1)
-        win32gui.DeleteMenu(hMenu, win32con.SC_CLOSE, win32con.MF_BYCOMMAND)
-    except: pass #silent
-if Interactive:
-    if sys.platform=="win32": os.system("pause") # windows
-    else: 
-        #os.system('read -s -n 1 -p "Press any key to continue...\n"')
-        import termios
-        print("Press any key to continue...")
-        fd = sys.stdin.fileno()
-        oldterm = termios.tcgetattr(fd)
-        newattr = termios.tcgetattr(fd)
-        newattr[3] = newattr[3] & ~termios.ICANON & ~termios.ECHO
-        termios.tcsetattr(fd, termios.TCSANOW, newattr)
-        try: result = sys.stdin.read(1)
-        except IOError: pass
-        finally: termios.tcsetattr(fd, termios.TCSAFLUSH, oldterm)
+
+def main ():
+    # the command line program: parse the commandline, choose input files
+    # interactively if not specified, then run_mrspecs
+    global debug
+    Image_File=''; Spectro_File=''
+    basedir = os.getcwd()+slash # current working directory is the default output directory 
+    for arg in sys.argv[1:]: # look in command line arguments if the output directory specified
+        if "--outdir" in arg: basedir = os.path.abspath(arg[arg.find('=')+1:])+slash #
+    open_log (basedir)
+    sys.stderr = logfile # errors from Python itself also go to the logfile
+    # catch signals to be able to cleanup temp files before exit
+    signal.signal(signal.SIGINT, signal_handler)  # keyboard interrupt
+    signal.signal(signal.SIGTERM, signal_handler) # kill/shutdown
+    if  'SIGHUP' in dir(signal): signal.signal(signal.SIGHUP, signal_handler)  # shell exit (linux)
+    if sys.platform=="win32":
+        os.system("title "+Program_name)
+        if pywin32_installed:
+            try: # disable console windows close button (substitutes catch shell exit under linux)
+                hwnd = win32console.GetConsoleWindow()
+                hMenu = win32gui.GetSystemMenu(hwnd, False)
+                win32gui.EnableMenuItem(hMenu, win32con.SC_CLOSE, win32con.MF_GRAYED) 
+            except: pass #silent
+    TK_installed=True
+    try: from tkFileDialog import askopenfilename # Python 2
+    except: 
+      try: from tkinter.filedialog import askopenfilename; # Python3
+      except: TK_installed=False
+    try: import Tkinter as tk; # Python2
+    except: 
+      try: import tkinter as tk; # Python3
+      except: TK_installed=False
+
+
+    # parse commandline parameters (if present)
+    try: opts, args =  getopt( sys.argv[1:],'hd',['help','version','debug','img=','spec=','outdir=','noseg','pvbox',
+                                                  'batch=','jobs=','cache=','cachesize=','workdir=',
+                                                  'seg-profile=','validate=','profile=',
+                                                  'report=','report-only=','summary=','report-dpi='])
+    except:
+        error=str(sys.argv[1:]).replace("[","").replace("]","")
+        if "-" in str(error) and not "--" in str(error): 
+              lprint ('ERROR: Commandline '+str(error)+',   maybe you mean "--"')
+        else: lprint ('ERROR: Commandline '+str(error))
+        usage(); exit(2)
+    if len(args)>0: 
+        lprint ('ERROR: Commandline option "'+args[0]+'" not recognized')
+        lprint ('       (see logfile for details)')
+        logwrite ('       Calling parameters: '+str(sys.argv[1:]).replace("[","").replace("]",""))
+        usage(); exit(2)  
+    argDict = dict(opts)
+    if "--outdir" in argDict and not [True for arg in sys.argv[1:] if "--outdir" in arg]:
+        # "--outdir" must be spelled out, getopt also excepts substrings (e.g. "--outd"), but
+        # my simple pre-initialization code to get basedir early doesn't
+        lprint ('ERROR: Commandline option "--outdir" must be spelled out')
+        usage(); exit(2)
+    if '-h' in argDict: usage(); help(); exit(0)   
+    if '--help' in argDict: usage(); help(); exit(0)  
+    if '-d' in argDict: debug = True  
+    if '--debug' in argDict: debug = True   
+    if '--version' in argDict: lprint (Program_name+' '+Program_version); exit(0)
+    if '--img' in argDict: Image_File=argDict['--img']; checkfile(Image_File)
+    # --spec can be repeated and can be a directory, several spectro voxels on the same image
+    Spectro_Files = [value for option, value in opts if option=='--spec']
+    for file in Spectro_Files: 
+        if not os.path.isdir(file): checkfile(file)
+    if len(Spectro_Files)==1: Spectro_File = Spectro_Files[0]
+    if len(Spectro_Files)>1: Spectro_File = Spectro_Files
+    options = {'debug': debug, 'noseg': '--noseg' in argDict, 'pvbox': '--pvbox' in argDict}
+    options['cache'] = os.environ.get('MRSPECS_CACHE', '')
+    if '--cache' in argDict: options['cache'] = argDict['--cache']
+    options['workdir'] = os.environ.get('MRSPECS_WORKDIR', '')
+    if '--workdir' in argDict: options['workdir'] = argDict['--workdir']
+    if '--cachesize' in argDict: 
+        try: options['cache_size'] = float(argDict['--cachesize'])
+        except: lprint ('ERROR: Commandline option "--cachesize" must be a number'); usage(); exit(2)
+    if '--seg-profile' in argDict: options['seg_profile'] = argDict['--seg-profile']
+    if '--profile' in argDict: options['profile'] = os.path.abspath(argDict['--profile'])
+    if '--report' in argDict: options['report'] = argDict['--report']
+    if '--report-dpi' in argDict: 
+        try: options['report_dpi'] = float(argDict['--report-dpi'])
+        except: lprint ('ERROR: Commandline option "--report-dpi" must be a number'); usage(); exit(2)
+        if options['report_dpi']<=0: lprint ('ERROR: Commandline option "--report-dpi" must be positive'); usage(); exit(2)
+    Batch = ''; processes = None; Validate = ''; Report_only = ''; Summary = ''
+    if '--summary' in argDict: Summary=argDict['--summary']
+    if Summary!='' and not os.path.isdir(Summary): lprint ('ERROR:  Directory "'+Summary+'" not found '); exit(1)
+    if '--report-only' in argDict: Report_only=argDict['--report-only']
+    if Report_only!='' and not os.path.isdir(Report_only): lprint ('ERROR:  Directory "'+Report_only+'" not found '); exit(1)
+    if '--validate' in argDict: Validate=argDict['--validate']
+    if Validate!='' and not os.path.exists(Validate): lprint ('ERROR:  Validation set "'+Validate+'" not found '); exit(1)
+    if '--batch' in argDict: Batch=argDict['--batch']
+    if Batch!='' and not os.path.exists(Batch): lprint ('ERROR:  Batch "'+Batch+'" not found '); exit(1)
+    if '--jobs' in argDict: 
+        try: processes = int(argDict['--jobs'])
+        except: lprint ('ERROR: Commandline option "--jobs" must be a number'); usage(); exit(2)
+        if processes<1: lprint ('ERROR: Commandline option "--jobs" must be at least 1'); usage(); exit(2)
+
+
+    # ----- start to really do something -----
+    lprint ('Starting   Spectro Compartment Segmentation - '+Program_name+' '+Program_version)
+    logwrite ('Calling sequence    '+' '.join(sys.argv))
+    logwrite ('OS & Python version '+sys.platform+' '+python_version)
+    logwrite ('tkinter & pydicom   '+str(TK_installed)+' '+str(pydicom_installed))
+    if Batch!='':
+        run_batch (Batch, basedir, options, processes)
+        close_log(); sys.stderr = sys.__stderr__ # close logfile
+        return False
+    if Validate!='':
+        validate_profile (Validate, basedir, options, processes)
+        close_log(); sys.stderr = sys.__stderr__ # close logfile
+        return False
+    if Report_only!='':
+        report_only (Report_only, options.get('report_dpi', None))
+        close_log(); sys.stderr = sys.__stderr__ # close logfile
+        return False
+    if Summary!='':
+        batch_summary ([Summary], basedir+Program_name+'_Summary.pdf', processes, recursive=True)
+        close_log(); sys.stderr = sys.__stderr__ # close logfile
+        return False
+
+    Interactive = False
+    # Interactive Input (tkinter only started when needed)
+    if TK_installed and (Image_File == "" or Spectro_File == ""):
+        TKwindows = tk.Tk(); TKwindows.withdraw() #hiding tkinter window
+        TKwindows.update()
+        # the following tries to disable showing hidden files/folders under linux
+        try: TKwindows.tk.call('tk_getOpenFile', '-foobarz')
+        except: pass
+        try: TKwindows.tk.call('namespace', 'import', '::tk::dialog::file::')
+        except: pass
+        try: TKwindows.tk.call('set', '::tk::dialog::file::showHiddenBtn', '1')
+        except: pass
+        try: TKwindows.tk.call('set', '::tk::dialog::file::showHiddenVar', '0')
+        except: pass
+        TKwindows.update()
+        # Choose Image file
+        if Image_File == "": # use interactive input if not in commandline
+            Image_File = askopenfilename(title="Choose Image file")
+            if Image_File == "": lprint ('ERROR:  No Image input file specified'); exit(2)
+            Interactive = True
+        TKwindows.update()
+        # Choose Spectro file
+        if Spectro_File == "": # use interactive input if not specified in commandline
+            Spectro_File = askopenfilename(title="Choose Spectro file")
+            if Spectro_File == "": lprint ('ERROR:  No Spectro input file specified'); exit(2)
+            Interactive = True
+        TKwindows.update()    
+    else:
+        if Image_File == "": 
+            lprint ('ERROR:  No Image input file specified');
+            lprint ('        to interactively choose input files you need tkinter')
+            lprint ('        on Linux try "yum install tkinter"')
+            lprint ('        on MacOS install ActiveTcl from:')
+            lprint ('        http://www.activestate.com/activetcl/downloads')
+            usage()
+            exit(2)
+        if Spectro_File == "": 
+            lprint ('ERROR:  No Spectro input file specified')
+            lprint ('        to interactively choose input files you need tkinter')
+            lprint ('        on Linux try "yum install tkinter"')
+            lprint ('        on MacOS install ActiveTcl from:')
+            lprint ('        http://www.activestate.com/activetcl/downloads')  
+            usage()
+            exit(2)
+
+    run_mrspecs (Image_File, Spectro_File, basedir, options)
+    wait_reports() # results are already published
+    close_log(); sys.stderr = sys.__stderr__ # close logfile
+    return Interactive
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support() # batch mode in the PyInstaller executable
+    try: Interactive = main(); code = 0
+    except MRSpeCSError as error: Interactive = False; code = error.code
+    if pywin32_installed:
+        try: # reenable console windows close button (useful if called command line or batch file)
+            hwnd = win32console.GetConsoleWindow()
+            hMenu = win32gui.GetSystemMenu(hwnd, False)
+            win32gui.EnableMenuItem(hMenu, win32con.SC_CLOSE, win32con.MF_ENABLED)
+        except: pass #silent
+    if Interactive:
+        if sys.platform=="win32": os.system("pause") # windows
+        else: 
+            #os.system('read -s -n 1 -p "Press any key to continue...\n"')
+            import termios
+            print("Press any key to continue...")
+            fd = sys.stdin.fileno()
+            oldterm = termios.tcgetattr(fd)
+            newattr = termios.tcgetattr(fd)
+            newattr[3] = newattr[3] & ~termios.ICANON & ~termios.ECHO
+            termios.tcsetattr(fd, termios.TCSANOW, newattr)
+            try: result = sys.stdin.read(1)
+            except IOError: pass
+            finally: termios.tcsetattr(fd, termios.TCSAFLUSH, oldterm)
+    sys.exit(code)
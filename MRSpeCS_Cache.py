@@ -0,0 +1,102 @@
+#
+# MRSpeCS_Cache - persistent cache of intermediate results for MRSpeCS
+#
+# several spectro voxels are often measured on the same 3D T1, the NIFTI
+# conversion and the segmentation only depend on the image, so they are
+# kept in a cache directory with one subdirectory per entry, named by a
+# hash of the input image bytes, the tool chain and the parameters used
+# least recently used entries are removed above a total size limit
+# files are stored under a temporary name and renamed, so several MRSpeCS
+# processes (e.g. --batch) can share one cache directory
+#
+# ----- VERSION HISTORY -----
+#
+# Version 0.1 - 18, October 2026
+#       - initial version, caching T1.nii and the CSF/GM/WM maps
+#       - cached CSF/GM/WM maps are hardlinked (T1.nii is still copied, its
+#         header is reset in place)
+#
+# ----- LICENSE -----
+#
+#    GPL, see details inside MRSpeCS.py
+#
+# ----- REQUIREMENTS -----
+#
+#    none (python standard library only)
+#
+
+from __future__ import print_function
+import os
+import random
+import shutil
+import hashlib
+
+
+def cache_key (files, *strings):
+    # hash over the contents of files and strings (e.g. tool versions, parameters)
+    key = hashlib.sha1()
+    for filename in files:
+        f = open(filename, 'rb')
+        while True:
+            block = f.read(1024*1024)
+            if len(block)==0: break
+            key.update(block)
+        f.close()
+    for string in strings: key.update(('\n'+str(string)).encode('utf-8'))
+    return key.hexdigest()
+def _touch (entry): # mark as recently used
+    try: os.utime(entry, None)
+    except: pass
+def _link (fromfile, tofile): # hardlink, copy if not possible (other filesystem, windows)
+    try: os.link(fromfile, tofile)
+    except (OSError, AttributeError): shutil.copyfile(fromfile, tofile)
+def cache_get (cachedir, key, names, destdir, link=False):
+    # copy the files names of entry key to destdir, True if all were present
+    # link: hardlink instead, only for files that are not modified in place and
+    #       not handed out (copy them before they leave destdir)
+    entry = os.path.join(cachedir, key)
+    if not [True for name in names if not os.path.isfile(os.path.join(entry, name))]:
+        for name in names: 
+            if link: _link(os.path.join(entry, name), os.path.join(destdir, name))
+            else: shutil.copyfile(os.path.join(entry, name), os.path.join(destdir, name))
+        _touch (entry)
+        return True
+    return False
+def cache_put (cachedir, key, names, srcdir):
+    # store the files names from srcdir in entry key (added to an existing entry)
+    entry = os.path.join(cachedir, key)
+    if not os.path.isdir(entry):
+        try: os.makedirs(entry)
+        except OSError:
+            if not os.path.isdir(entry): raise # not created meanwhile by another process
+    suffix = '.tmp'+str(os.getpid())+str(random.randrange(1000,10000))
+    for name in names:
+        filename = os.path.join(entry, name)
+        if os.path.isfile(filename): continue
+        shutil.copyfile(os.path.join(srcdir, name), filename+suffix)
+        try: os.rename(filename+suffix, filename)
+        except OSError: os.remove(filename+suffix) # windows, stored meanwhile by another process
+    _touch (entry)
+def cache_size (cachedir):
+    # list of (last use, size in bytes, entry directory), most recently used first
+    entries = []
+    for key in os.listdir(cachedir):
+        entry = os.path.join(cachedir, key)
+        if not os.path.isdir(entry): continue
+        size = 0
+        for name in os.listdir(entry):
+            try: size += os.path.getsize(os.path.join(entry, name))
+            except OSError: pass # removed meanwhile
+        entries.append((os.path.getmtime(entry), size, entry))
+    entries.sort(reverse=True)
+    return entries
+def cache_evict (cachedir, max_size, keep=''):
+    # remove least recently used entries until the cache is below max_size bytes,
+    # entry keep (the one just used) is never removed, returns the removed entries
+    total = 0; removed = []
+    for last_use, size, entry in cache_size(cachedir):
+        total += size
+        if total>max_size and os.path.basename(entry)!=keep:
+            shutil.rmtree(entry, ignore_errors=True)
+            removed.append(entry)
+    return removed
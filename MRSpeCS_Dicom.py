@@ -0,0 +1,119 @@
+#
+# MRSpeCS_Dicom - header only reading of Philips DICOM spectro files for MRSpeCS
+#
+# the spectro voxel geometry is in the private sequence (2005,1085), reading
+# stops at the first element after group 2005, so the spectroscopy data
+# (5600,0020) and everything after it is never read, large elements before
+# it (other private data) are skipped, not loaded (defer_size)
+# Modality, Manufacturer and ImageType are checked from the same partial read
+#
+# ----- VERSION HISTORY -----
+#
+# Version 0.1 - 18, October 2026
+#       - initial version, replaces reading the whole file with pydicom
+#       - header cache cleared per run and batch scan
+#
+# ----- LICENSE -----
+#
+#    GPL, see details inside MRSpeCS.py
+#
+# ----- REQUIREMENTS -----
+#
+#    pydicom (any version, imported as dicom before v1.0)
+#
+
+from __future__ import print_function
+import os
+import struct
+from io import BytesIO
+try: import pydicom as dicom #  >v1.0
+except ImportError:
+    try: import dicom # <v1.0
+    except ImportError: dicom = None
+if dicom!=None:
+    try: from pydicom.filereader import read_partial, read_sequence
+    except ImportError: from dicom.filereader import read_partial, read_sequence
+
+
+geometry_sequence = (0x2005, 0x1085)
+# elements of the first item of geometry_sequence: name: (element, direction index AP/LR/FH)
+geometry_elements = {
+    'rot':    (0x1054, 0x1056, 0x1055),
+    'size':   (0x1057, 0x1059, 0x1058),
+    'offset': (0x105A, 0x105C, 0x105B)}
+defer_size = 4096 # elements larger than this [bytes] are skipped, not read
+
+
+class SpectroDicomError(ValueError):
+    # file read, but not a Philips spectro DICOM or without the geometry
+    pass
+
+
+def _after_geometry (tag, VR, length):
+    # stop_when of read_partial: the geometry group is complete
+    return tag.group > geometry_sequence[0]
+def _read (filename):
+    # the elements of filename up to group 0x2005 (header only)
+    if dicom==None: raise ImportError('pydicom is not installed')
+    f = open(filename, 'rb')
+    try: return read_partial(f, stop_when=_after_geometry, defer_size=defer_size)
+    finally: f.close()
+def _items (element):
+    # items of a sequence, also with implicit VR (unknown private element, raw bytes)
+    if isinstance(element.value, bytes):
+        return read_sequence(BytesIO(element.value), True, True, len(element.value), 'iso8859')
+    return element.value
+def _float (element):
+    # FL value, also with implicit VR (unknown private element, 4 bytes little endian)
+    value = element.value
+    if isinstance(value, bytes): value = struct.unpack('<f', value[:4])[0]
+    return float(value)
+
+
+class SpectroDicomHeader(object):
+    # typed view of the fields of a Philips spectro DICOM file that MRSpeCS needs
+    #   modality, manufacturer: as in the file
+    #   image_type:             list of the ImageType values
+    #   size, offset, rot:      (AP, LR, FH) voxel size [mm], off center [mm]
+    #                           and angulation [degrees], as stored (no sign changes)
+    # raises SpectroDicomError if Modality is not MR, the Manufacturer not Philips,
+    # ImageType not SPECTROSCOPY or the geometry is incomplete
+    def __init__(self, filename):
+        dataset = _read(filename)
+        self.filename = filename
+        try: self.modality = str(dataset.Modality) # must be MR
+        except AttributeError: raise SpectroDicomError('Unable to determine DICOM Modality')
+        if self.modality!='MR': raise SpectroDicomError('DICOM Modality not MR')
+        try: self.manufacturer = str(dataset.Manufacturer) # currently Philips only
+        except AttributeError: raise SpectroDicomError('Unable to determine Manufacturer')
+        if not self.manufacturer.find("Philips")>=0:
+            raise SpectroDicomError('Currently only Philips DICOM implemented')
+        try: self.image_type = [str(value) for value in dataset.ImageType] # sanity check: spectroscopy
+        except AttributeError: raise SpectroDicomError('Unable to determine if DICOM contains spectroscopy data')
+        if not 'SPECTROSCOPY' in ' '.join(self.image_type):
+            raise SpectroDicomError('DICOM file does not contain spectroscopy data')
+        try: item = _items(dataset[geometry_sequence])[0]
+        except (KeyError, IndexError, TypeError): raise SpectroDicomError('Unable to extract geometry data from DICOM')
+        for name, elements in geometry_elements.items():
+            try: values = tuple([_float(item[geometry_sequence[0], element]) for element in elements])
+            except (KeyError, ValueError, TypeError, struct.error):
+                raise SpectroDicomError('Unable to extract all geometry data from DICOM')
+            setattr(self, name, values)
+
+
+_header_cache = {}
+def spectro_header (filename):
+    # SpectroDicomHeader of filename, cached until spectro_header_forget
+    # (e.g. checked while scanning a directory, then read for the geometry)
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), stat.st_mtime, stat.st_size)
+    header = _header_cache.get(key)
+    if header==None: header = _header_cache[key] = SpectroDicomHeader(filename)
+    return header
+def spectro_header_forget (filename=None):
+    # drops the cached headers of filename, all with None (start of a run,
+    # end of a batch scan)
+    if filename==None: _header_cache.clear(); return
+    filename = os.path.abspath(filename)
+    for key in list(_header_cache):
+        if key[0]==filename: _header_cache.pop(key, None)
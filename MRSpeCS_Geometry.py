@@ -0,0 +1,232 @@
+#
+# MRSpeCS_Geometry - geometry of the spectroscopy voxel for MRSpeCS
+#
+# builds the transformation matrices between the spectro voxel (straight,
+# centered in the image), the scanner isocenter and the image space
+# with numpy, in the same convention as FSL's flirt/convert_xfm
+# (4x4 matrices in mm, origin at the first voxel corner)
+# this replaces the former chain of avscale/convert_xfm calls on .mat files,
+# .mat files are only written on request (debug mode)
+# the spectro box is rasterized directly into the image voxel grid, only
+# voxels inside the bounding box of the rotated box are tested
+# optionally as partial volume weights (fraction of each voxel inside the box)
+#
+# ----- VERSION HISTORY -----
+#
+# Version 0.1 - 18, October 2026
+#       - initial version, ported from the avscale/convert_xfm chain in MRSpeCS.py
+#       - rasterization of the spectro box (replaces fslmaths -roi/flirt/fslmaths -bin)
+#       - partial volume weighted spectro box (supersampling)
+#       - CSF/GM/WM measurement in the box (replaces three fslmeants calls)
+#       - measurement of several boxes in one pass
+#
+# ----- LICENSE -----
+#
+#    GPL, see details inside MRSpeCS.py
+#
+# ----- REQUIREMENTS -----
+#
+#    numpy
+#
+
+from __future__ import print_function
+import math
+import numpy as np
+from MRSpeCS_Nifti import read_subvolume
+
+
+d2r = math.pi/180. # degree to rad conversion
+eps = 1e-6          # [mm] tolerance for voxel centers exactly on the box faces
+
+
+def _translation (vector): # 4x4 translation matrix [mm]
+    mat = np.identity(4)
+    mat[0:3,3] = vector
+    return mat
+def _rotation_X (angle): # rotation about X [rad] as in FSL's make_rot
+    c = math.cos(angle); s = math.sin(angle)
+    return np.array([[1.,0.,0.,0.], [0.,c,s,0.], [0.,-s,c,0.], [0.,0.,0.,1.]])
+def _rotation_Y (angle): # rotation about Y [rad] as in FSL's make_rot
+    c = math.cos(angle); s = math.sin(angle)
+    return np.array([[c,0.,-s,0.], [0.,1.,0.,0.], [s,0.,c,0.], [0.,0.,0.,1.]])
+def _rotation_Z (angle): # rotation about Z [rad] as in FSL's make_rot
+    c = math.cos(angle); s = math.sin(angle)
+    return np.array([[c,s,0.,0.], [-s,c,0.,0.], [0.,0.,1.,0.], [0.,0.,0.,1.]])
+def _about_center (mat, center): # apply mat around center instead of origin
+    return np.dot(_translation(center), np.dot(mat, _translation(-center)))
+def avscale (affmat):
+    # rotation & translation part of an affine matrix, as FSL's "avscale"
+    # prints it as "Rotation & Translation Matrix" (decompose_aff, centre at 0)
+    # i.e. affmat = [rotmat * scales * skew | translation], for radiological
+    # images (negative determinant) rotmat keeps the LR flip
+    affmat = np.asarray(affmat, dtype=np.float64)
+    x = affmat[0:3,0]; y = affmat[0:3,1]; z = affmat[0:3,2]
+    sx = math.sqrt(np.dot(x,x))
+    sy = math.sqrt(np.dot(y,y) - np.dot(x,y)**2/sx**2)
+    a = np.dot(x,y)/(sx*sy)
+    x0 = x/sx
+    y0 = y/sy - a*x0
+    sz = math.sqrt(np.dot(z,z) - np.dot(x0,z)**2 - np.dot(y0,z)**2)
+    b = np.dot(x0,z)/(sx*sz)
+    c = np.dot(y0,z)/(sy*sz)
+    scales = np.diag([sx,sy,sz])
+    skew = np.array([[1.,a,b], [0.,1.,c], [0.,0.,1.]])
+    mat = np.identity(4)
+    mat[0:3,0:3] = np.dot(affmat[0:3,0:3], np.linalg.inv(np.dot(scales,skew)))
+    mat[0:3,3] = affmat[0:3,3]
+    return mat
+def measure_boxes (boxes, maps):
+    # sums of the maps (e.g. PVE .nii files {'CSF':..., 'GM':..., 'WM':...})
+    # over several boxes, given as list of sub-grids (lo, box) with binary or
+    # weight values, the maps are read once over the bounding sub-grid of all
+    # boxes and every box is one matrix product with the stacked maps
+    los = np.array([lo for lo, box in boxes])
+    his = np.array([np.asarray(lo) + np.asarray(np.shape(box)) for lo, box in boxes])
+    lo_all = los.min(axis=0); hi_all = his.max(axis=0)
+    names = list(maps)
+    data = np.array([read_subvolume(maps[name], lo_all, hi_all) for name in names])
+    results = []
+    for (lo, box), hi in zip(boxes, his):
+        box = np.asarray(box, dtype=np.float64)
+        start = np.asarray(lo) - lo_all; stop = hi - lo_all
+        inside = box>0
+        weights = box[inside]
+        sub = data[:, start[0]:stop[0], start[1]:stop[1], start[2]:stop[2]][:, inside]
+        result = dict(zip(names, [float(value) for value in np.dot(sub, weights)]))
+        result['voxels'] = float(weights.sum()) # voxel count (sum of weights)
+        # normalization term, the sum of the mean values (fslmeants outputs)
+        result['total'] = sum([result[name] for name in names])/result['voxels']
+        results.append(result)
+    return results
+def measure_box (lo, box, maps): # the same for one box
+    return measure_boxes([(lo, box)], maps)[0]
+def write_mat (filename, mat): # FSL style ascii matrix
+    f = open(filename, 'w')
+    for row in mat: f.write('  '.join(['%.10f' % value for value in row])+'  \n')
+    f.close()
+
+
+class SpectroGeometry(object):
+    # Spectro voxel geometry relative to a NIFTI image
+    #
+    #   qform:            4x4 qform matrix of the image (as from "fslorient -getqform")
+    #   image_size:       image dimensions in voxels (X,Y,Z)
+    #   image_resolution: voxel size in mm (X,Y,Z)
+    #   spectro_size:     spectro voxel size in mm (LR,AP,FH)
+    #   spectro_offset:   spectro voxel offcenter in mm (LR,AP,FH)
+    #   spectro_rot:      spectro voxel angulation in degrees (LR,AP,FH)
+    # spectro values are expected with the sign conventions already applied
+    #
+    # all matrices are available as attributes named like the .mat files
+    # formerly written by the convert_xfm chain, e.g. geometry.Isocenter2Image
+    # these work in FSL's mm coordinates, Voxel2FSL maps voxel indices to them
+    # (FSL swaps X for images in neurological orientation, positive determinant)
+
+    matrices = ['ImageTransform_raw', 'TranslImageOrigin', 'TranslImageOrigin_Inv',
+                'Image2Isocenter', 'Isocenter2Image',
+                'SpectroRotationLR_raw', 'SpectroRotationAP_raw', 'SpectroRotationFH_raw',
+                'SpectroRotationLR', 'SpectroRotationAP', 'SpectroRotationFH',
+                'SpectroRotation', 'SpectroTranslation', 'SpectroTransformation',
+                'Spectro2ImageTransformation']
+
+    def __init__(self, qform, image_size, image_resolution,
+                 spectro_size, spectro_offset, spectro_rot):
+        self.qform = np.asarray(qform, dtype=np.float64).reshape(4,4)
+        self.image_size = np.asarray(image_size, dtype=np.int64)
+        self.image_resolution = np.asarray(image_resolution, dtype=np.float64)
+        self.image_center = (self.image_size/2).astype(np.int64) # in voxels
+        self.spectro_size = np.asarray(spectro_size, dtype=np.float64)
+        self.spectro_offset = np.asarray(spectro_offset, dtype=np.float64)
+        self.spectro_rot = np.asarray(spectro_rot, dtype=np.float64)
+        center = self.image_center*self.image_resolution # in mm
+        # voxel indices -> FSL mm coordinates
+        self.Voxel2FSL = np.diag(np.append(self.image_resolution, 1.))
+        if np.linalg.det(self.qform[0:3,0:3]) > 0: # neurological
+            self.Voxel2FSL[0,0] = -self.image_resolution[0]
+            self.Voxel2FSL[0,3] = (self.image_size[0]-1)*self.image_resolution[0]
+        # image transformations
+        self.ImageTransform_raw = avscale(self.qform) # without scalings
+        self.TranslImageOrigin = _translation(-center)
+        self.TranslImageOrigin_Inv = _translation(center)
+        self.Image2Isocenter = np.dot(self.TranslImageOrigin_Inv, self.ImageTransform_raw)
+        self.Isocenter2Image = np.linalg.inv(self.Image2Isocenter)
+        # spectro transformations, rotations are around the image center
+        self.SpectroRotationLR_raw = _rotation_X(self.spectro_rot[0]*d2r)
+        self.SpectroRotationAP_raw = _rotation_Y(-self.spectro_rot[1]*d2r) # sign as in old .mat
+        self.SpectroRotationFH_raw = _rotation_Z(self.spectro_rot[2]*d2r)
+        self.SpectroRotationLR = _about_center(self.SpectroRotationLR_raw, center)
+        self.SpectroRotationAP = _about_center(self.SpectroRotationAP_raw, center)
+        self.SpectroRotationFH = _about_center(self.SpectroRotationFH_raw, center)
+        self.SpectroRotation = np.dot(self.SpectroRotationFH,
+                               np.dot(self.SpectroRotationAP, self.SpectroRotationLR))
+        self.SpectroTranslation = _translation(self.spectro_offset)
+        self.SpectroTransformation = np.dot(self.SpectroTranslation, self.SpectroRotation)
+        self.Spectro2ImageTransformation = np.dot(self.Isocenter2Image, self.SpectroTransformation)
+
+    def write_mat (self, directory, names=None):
+        # write matrices as FSL .mat files (all if no names given)
+        if names is None: names = self.matrices
+        for name in names: write_mat(directory+name+'.mat', getattr(self, name))
+
+    def box_bounds (self, transformation='Spectro2ImageTransformation', margin=0.):
+        # voxel index range [lo,hi) of the image grid that contains the box
+        # after transformation (the box corners transformed to image space)
+        # margin [voxels] e.g. 0.5 to include all voxels partially covered
+        mat = getattr(self, transformation)
+        half = self.spectro_size/2.
+        corners = np.array([[x,y,z] for x in (-1,1) for y in (-1,1) for z in (-1,1)])
+        corners = corners*half + self.image_center*self.image_resolution
+        mat = np.dot(np.linalg.inv(self.Voxel2FSL), mat) # to voxel indices
+        corners = np.dot(corners, mat[0:3,0:3].T) + mat[0:3,3]
+        lo = np.floor(corners.min(axis=0)-margin).astype(np.int64)
+        hi = np.ceil(corners.max(axis=0)+margin).astype(np.int64)+1
+        lo = np.clip(lo, 0, self.image_size)
+        hi = np.clip(hi, lo, self.image_size)
+        return lo, hi
+    def _voxel2box (self, transformation):
+        # voxel indices -> box coordinates (LR,AP,FH) in mm relative to the box center
+        mat = np.dot(np.linalg.inv(getattr(self, transformation)), self.Voxel2FSL)
+        return np.dot(_translation(-self.image_center*self.image_resolution), mat)
+    def box_coordinates (self, lo, hi, transformation='Spectro2ImageTransformation'):
+        # box coordinates (LR,AP,FH) in mm relative to the box center of the
+        # voxel centers in [lo,hi), with broadcastable shapes
+        mat = self._voxel2box(transformation)
+        X = np.arange(lo[0],hi[0])[:,None,None]
+        Y = np.arange(lo[1],hi[1])[None,:,None]
+        Z = np.arange(lo[2],hi[2])[None,None,:]
+        return [mat[i,0]*X + mat[i,1]*Y + mat[i,2]*Z + mat[i,3] for i in range(3)]
+    def box (self, transformation='Spectro2ImageTransformation'):
+        # binary box mask on the bounding sub-grid, returns (lo, mask)
+        # a voxel is inside if its center is inside the box (point-in-oriented-box)
+        lo, hi = self.box_bounds(transformation)
+        half = self.spectro_size/2.
+        mask = np.ones(hi-lo, dtype=bool)
+        for i, coordinate in enumerate(self.box_coordinates(lo, hi, transformation)):
+            mask &= (coordinate >= -half[i]-eps) & (coordinate < half[i]-eps)
+        return lo, mask
+    def box_weights (self, transformation='Spectro2ImageTransformation', samples=4):
+        # partial volume box on the bounding sub-grid, returns (lo, weights)
+        # weights are the fraction of each voxel's volume inside the box,
+        # estimated from samples**3 points per voxel (regular supersampling)
+        lo, hi = self.box_bounds(transformation, margin=0.5)
+        half = self.spectro_size/2.
+        coordinates = self.box_coordinates(lo, hi, transformation)
+        offsets = (np.arange(samples)+0.5)/samples-0.5 # in voxels
+        steps = self._voxel2box(transformation)[0:3,0:3] # mm per voxel step
+        count = np.zeros(hi-lo, dtype=np.uint16)
+        for x in offsets:
+            for y in offsets:
+                for z in offsets:
+                    shift = np.dot(steps, [x,y,z])
+                    inside = np.ones(hi-lo, dtype=bool)
+                    for i in range(3):
+                        coordinate = coordinates[i]+shift[i]
+                        inside &= (coordinate >= -half[i]-eps) & (coordinate < half[i]-eps)
+                    count += inside
+        return lo, (count/float(samples**3)).astype(np.float32)
+    def box_volume (self, lo, sub, dtype=np.uint8):
+        # paste a sub-grid (as returned by box) into a full size image volume
+        volume = np.zeros(self.image_size, dtype=dtype)
+        hi = lo + np.asarray(sub.shape)
+        volume[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]] = sub
+        return volume
@@ -0,0 +1,404 @@
+#
+# MRSpeCS_Nifti - minimal NIFTI-1 (single .nii file) access for MRSpeCS
+#
+# reads/writes the fixed 348 byte header with struct and the voxel data
+# with numpy, this avoids a round trip through the FSL tools (fslmaths etc.)
+# for files that MRSpeCS generates itself
+#
+# ----- VERSION HISTORY -----
+#
+# Version 0.1 - 18, October 2026
+#       - initial version, writing SpectroBOX.nii
+#       - memory mapped reading of sub-volumes
+#       - in place orientation reset (replaces the fslorient calls)
+#       - header inspection (replaces fslhd/fslorient -getqform)
+#       - cropping to the non-zero voxels and pasting back (segmentation)
+#       - downsampling (preview segmentation)
+#       - memory mapped volume with its scaling (report)
+#       - field by field header comparison (debug check against fslorient)
+#       - display range (cal_min/cal_max) stored once per case (report)
+#       - header cache cleared per run and after every write
+#
+# ----- LICENSE -----
+#
+#    GPL, see details inside MRSpeCS.py
+#
+# ----- REQUIREMENTS -----
+#
+#    numpy
+#
+
+from __future__ import print_function
+import os
+import struct
+import itertools
+import numpy as np
+
+
+# header fields used by MRSpeCS: name: (byte offset, struct format)
+fields = {
+    'sizeof_hdr': (0,   'i'),
+    'dim':        (40,  '8h'),
+    'datatype':   (70,  'h'),
+    'bitpix':     (72,  'h'),
+    'pixdim':     (76,  '8f'),
+    'vox_offset': (108, 'f'),
+    'scl_slope':  (112, 'f'),
+    'scl_inter':  (116, 'f'),
+    'cal_max':    (124, 'f'),
+    'cal_min':    (128, 'f'),
+    'qform_code': (252, 'h'),
+    'sform_code': (254, 'h'),
+    'quatern':    (256, '3f'),
+    'qoffset':    (268, '3f'),
+    'srow_x':     (280, '4f'),
+    'srow_y':     (296, '4f'),
+    'srow_z':     (312, '4f'),
+    'magic':      (344, '4s')}
+# NIFTI xform codes and orientation names (as printed by fslhd)
+xform_names = {0: 'Unknown', 1: 'Scanner Anat', 2: 'Aligned Anat', 3: 'Talairach', 4: 'MNI_152'}
+orient_names = {(0, 1): 'Left-to-Right', (0,-1): 'Right-to-Left',
+                (1, 1): 'Posterior-to-Anterior', (1,-1): 'Anterior-to-Posterior',
+                (2, 1): 'Inferior-to-Superior', (2,-1): 'Superior-to-Inferior'}
+# NIFTI datatype codes
+datatypes = {2: np.uint8, 4: np.int16, 8: np.int32, 16: np.float32, 64: np.float64,
+             256: np.int8, 512: np.uint16, 768: np.uint32}
+
+
+def read_header_endian (header, filename=''):
+    # byte order ('<' or '>') of a raw header, checks for single file NIFTI
+    if len(header)!=348: raise IOError('NIFTI header too short: '+filename)
+    for endian in ('<','>'):
+        if struct.unpack(endian+'i', bytes(header[0:4]))[0]==348: break
+    else: raise IOError('not a NIFTI file: '+filename)
+    if bytes(header[344:348])!=b'n+1\x00':
+        raise IOError('not a single file NIFTI (.nii): '+filename)
+    return endian
+def read_header (filename):
+    # returns the raw 348 byte header and its byte order ('<' or '>')
+    f = open(filename, 'rb')
+    try: header = f.read(348)
+    finally: f.close()
+    return bytearray(header), read_header_endian(header, filename)
+def get_field (header, endian, name):
+    offset, format = fields[name]
+    value = struct.unpack_from(endian+format, bytes(header), offset)
+    if len(value)==1: value = value[0]
+    return value
+def set_field (header, endian, name, value):
+    offset, format = fields[name]
+    if not isinstance(value, (tuple, list)): value = (value,)
+    struct.pack_into(endian+format, header, offset, *value)
+def write_volume (filename, data, template):
+    # writes data (X,Y,Z array) to filename, with the geometry from template
+    # (a .nii file on the same voxel grid, e.g. T1.nii)
+    header, endian = read_header(template)
+    data = np.asarray(data)
+    datatype = [code for code in datatypes if datatypes[code]==data.dtype.type]
+    if len(datatype)!=1: raise ValueError('unsupported NIFTI datatype '+str(data.dtype))
+    dim = list(get_field(header, endian, 'dim'))
+    if tuple(dim[1:4])!=data.shape[0:3]:
+        raise ValueError('data does not match the geometry of '+template)
+    dim[0] = 3; dim[4:] = [1,1,1,1]
+    set_field(header, endian, 'dim', dim)
+    set_field(header, endian, 'datatype', datatype[0])
+    set_field(header, endian, 'bitpix', 8*data.dtype.itemsize)
+    set_field(header, endian, 'vox_offset', 352.)
+    set_field(header, endian, 'scl_slope', 1.)
+    set_field(header, endian, 'scl_inter', 0.)
+    set_field(header, endian, 'cal_max', 0.)
+    set_field(header, endian, 'cal_min', 0.)
+    f = open(filename, 'wb')
+    try:
+        f.write(bytes(header))
+        f.write(b'\x00\x00\x00\x00') # no extensions
+        f.write(data.astype(data.dtype.newbyteorder(endian)).tobytes(order='F'))
+    finally: f.close(); header_forget(filename)
+def _memmap (filename):
+    # header, endian and the (unscaled) voxel data of a .nii file, memory mapped
+    header, endian = read_header(filename)
+    dim = get_field(header, endian, 'dim')
+    datatype = get_field(header, endian, 'datatype')
+    if not datatype in datatypes: raise ValueError('unsupported NIFTI datatype '+str(datatype))
+    dtype = np.dtype(datatypes[datatype]).newbyteorder(endian)
+    data = np.memmap(filename, dtype=dtype, mode='r', offset=int(get_field(header, endian, 'vox_offset')),
+                     shape=tuple(dim[1:4]), order='F')
+    return header, endian, data
+def memmap_volume (filename):
+    # the (unscaled) voxel data of a .nii file, memory mapped, and the scaling
+    # (slope, intercept), (1,0) if not scaled; delete the data to close the file
+    header, endian, data = _memmap(filename)
+    slope = get_field(header, endian, 'scl_slope')
+    if slope==0.: return data, (1., 0.)
+    return data, (slope, get_field(header, endian, 'scl_inter'))
+def read_subvolume (filename, lo, hi):
+    # voxel values (scaled, float64) in the index range [lo,hi) of a .nii file,
+    # the file is memory mapped so only the pages of the sub-volume are read
+    header, endian, data = _memmap(filename)
+    sub = np.array(data[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]], dtype=np.float64)
+    del data # close the memory map
+    slope = get_field(header, endian, 'scl_slope')
+    if slope!=0.: sub = sub*slope + get_field(header, endian, 'scl_inter')
+    return sub
+def nonzero_bounds (filename, margin=(0,0,0)):
+    # index range (lo,hi) of the non-zero voxels of a .nii file (e.g. the brain
+    # after BET), extended by margin voxels, None if all voxels are zero
+    header, endian, data = _memmap(filename)
+    mask = data!=0
+    del data # close the memory map
+    if not mask.any(): return None
+    lo = []; hi = []
+    for axis in range(3):
+        used = np.flatnonzero(mask.any(axis=tuple([i for i in range(3) if i!=axis])))
+        lo.append(max(0, int(used[0])-margin[axis]))
+        hi.append(min(mask.shape[axis], int(used[-1])+1+margin[axis]))
+    return tuple(lo), tuple(hi)
+def _write_grid (filename, data, header, endian, lo, factor=1):
+    # writes data with header (of the original file) on a new voxel grid starting at
+    # voxel index lo of the original grid with factor times the voxel size,
+    # qform/sform are adjusted such that the voxels keep their position in mm
+    dim = list(get_field(header, endian, 'dim'))
+    dim[0] = 3; dim[1:4] = data.shape[0:3]; dim[4:] = [1,1,1,1]
+    pixdim = list(get_field(header, endian, 'pixdim'))
+    if get_field(header, endian, 'qform_code') > 0:
+        qform = quatern_to_mat44(get_field(header, endian, 'quatern'), get_field(header, endian, 'qoffset'), pixdim)
+        set_field(header, endian, 'qoffset', list(np.dot(qform, list(lo)+[1.])[0:3]))
+    if get_field(header, endian, 'sform_code') > 0:
+        for name in ('srow_x','srow_y','srow_z'):
+            srow = list(get_field(header, endian, name))
+            srow = [value*factor for value in srow[0:3]] + [srow[3]+np.dot(srow[0:3], lo)]
+            set_field(header, endian, name, srow)
+    pixdim[1:4] = [value*factor for value in pixdim[1:4]]
+    datatype = [code for code in datatypes if datatypes[code]==data.dtype.type]
+    if len(datatype)!=1: raise ValueError('unsupported NIFTI datatype '+str(data.dtype))
+    set_field(header, endian, 'dim', dim)
+    set_field(header, endian, 'pixdim', pixdim)
+    set_field(header, endian, 'datatype', datatype[0])
+    set_field(header, endian, 'bitpix', 8*data.dtype.itemsize)
+    set_field(header, endian, 'vox_offset', 352.)
+    f = open(filename, 'wb')
+    try:
+        f.write(bytes(header))
+        f.write(b'\x00\x00\x00\x00') # no extensions
+        f.write(data.astype(data.dtype.newbyteorder(endian)).tobytes(order='F'))
+    finally: f.close(); header_forget(filename)
+def crop_volume (filename, cropped, lo, hi):
+    # writes the index range [lo,hi) of filename to cropped, same datatype and scaling
+    header, endian, data = _memmap(filename)
+    sub = np.array(data[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]])
+    del data # close the memory map
+    _write_grid(cropped, sub, header, endian, lo)
+def downsample_volume (filename, downsampled, factor):
+    # writes filename averaged over blocks of factor^3 voxels (float32, same scaling)
+    # to downsampled, the last blocks are padded with zeros
+    header, endian, data = _memmap(filename)
+    shape = [-(-size//factor) for size in data.shape[0:3]] # rounded up
+    padded = np.zeros([size*factor for size in shape], dtype=np.float32)
+    padded[0:data.shape[0], 0:data.shape[1], 0:data.shape[2]] = data
+    del data # close the memory map
+    blocks = padded.reshape(shape[0], factor, shape[1], factor, shape[2], factor).mean(axis=(1,3,5))
+    # the first new voxel is centered on the first block
+    _write_grid(downsampled, blocks.astype(np.float32), header, endian, [(factor-1)/2.]*3, factor)
+def uncrop_volume (cropped, filename, lo, template, factor=1):
+    # pastes cropped (see crop_volume) at lo into a zero volume on the voxel grid
+    # of template and writes it to filename with the geometry of template
+    # (same datatype and scaling as cropped), with factor every voxel is repeated
+    # factor times along each axis (back from downsample_volume)
+    header, endian, data = _memmap(cropped)
+    template_header, template_endian = read_header(template)
+    volume = np.zeros(get_field(template_header, template_endian, 'dim')[1:4], dtype=data.dtype.newbyteorder('='))
+    if factor>1: data = data.repeat(factor, axis=0).repeat(factor, axis=1).repeat(factor, axis=2)
+    hi = [min(lo[i]+data.shape[i], volume.shape[i]) for i in range(3)]
+    volume[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]] = data[0:hi[0]-lo[0], 0:hi[1]-lo[1], 0:hi[2]-lo[2]]
+    del data # close the memory map
+    write_volume(filename, volume, template)
+    f = open(filename, 'r+b')
+    try:
+        new_header, new_endian = read_header(filename)
+        set_field(new_header, new_endian, 'scl_slope', get_field(header, endian, 'scl_slope'))
+        set_field(new_header, new_endian, 'scl_inter', get_field(header, endian, 'scl_inter'))
+        f.write(bytes(new_header))
+    finally: f.close(); header_forget(filename)
+def mat44_to_quatern (mat):
+    # quaternion parameters (b,c,d), offsets and qfac of a 4x4 qform matrix
+    # as nifti1_io's nifti_mat44_to_quatern (columns assumed orthogonal)
+    mat = np.asarray(mat, dtype=np.float32).astype(np.float64)
+    R = mat[0:3,0:3].copy()
+    lengths = np.sqrt((R**2).sum(axis=0))
+    for i in range(3):
+        if lengths[i]==0.: R[:,i] = 0.; R[i,i] = 1.; lengths[i] = 1.
+    R = R/lengths
+    if np.linalg.det(R) > 0: qfac = 1.
+    else: qfac = -1.; R[:,2] = -R[:,2] # improper ==> flip 3rd column
+    a = R[0,0] + R[1,1] + R[2,2] + 1.
+    if a > 0.5:
+        a = 0.5*np.sqrt(a)
+        b = 0.25*(R[2,1]-R[1,2])/a
+        c = 0.25*(R[0,2]-R[2,0])/a
+        d = 0.25*(R[1,0]-R[0,1])/a
+    else:
+        xd = 1. + R[0,0] - (R[1,1]+R[2,2])
+        yd = 1. + R[1,1] - (R[0,0]+R[2,2])
+        zd = 1. + R[2,2] - (R[0,0]+R[1,1])
+        if xd > 1.:
+            b = 0.5*np.sqrt(xd)
+            c = 0.25*(R[0,1]+R[1,0])/b
+            d = 0.25*(R[0,2]+R[2,0])/b
+            a = 0.25*(R[2,1]-R[1,2])/b
+        elif yd > 1.:
+            c = 0.5*np.sqrt(yd)
+            b = 0.25*(R[0,1]+R[1,0])/c
+            d = 0.25*(R[1,2]+R[2,1])/c
+            a = 0.25*(R[0,2]-R[2,0])/c
+        else:
+            d = 0.5*np.sqrt(zd)
+            b = 0.25*(R[0,2]+R[2,0])/d
+            c = 0.25*(R[1,2]+R[2,1])/d
+            a = 0.25*(R[1,0]-R[0,1])/d
+        if a < 0.: b = -b; c = -c; d = -d
+    return (b,c,d), tuple(mat[0:3,3]), qfac
+def reset_orientation (filename, origin):
+    # rewrites the orientation in the header of filename in place, the voxel
+    # data is not touched. The result is the header that the FSL sequence
+    #     fslorient -deleteorient, -setqformcode 1, -forceradiological,
+    #     -getqform, -setqform <qform with origin>, -setsform <same>
+    # writes: after -deleteorient FSL falls back to the default radiological
+    # qform diag(-dx,dy,dz), -forceradiological has nothing left to do and
+    # -setsform keeps the (deleted) sform code, so no sform is stored
+    f = open(filename, 'r+b')
+    try:
+        header = bytearray(f.read(348))
+        endian = read_header_endian(header, filename)
+        pixdim = get_field(header, endian, 'pixdim')
+        mat = np.identity(4)
+        for i, sign in enumerate((-1.,1.,1.)): mat[i,i] = sign*pixdim[i+1]
+        mat[0:3,3] = origin
+        quatern, qoffset, qfac = mat44_to_quatern(mat)
+        pixdim = list(pixdim); pixdim[0] = qfac
+        set_field(header, endian, 'pixdim', pixdim)
+        set_field(header, endian, 'qform_code', 1)
+        set_field(header, endian, 'quatern', quatern)
+        set_field(header, endian, 'qoffset', qoffset)
+        set_field(header, endian, 'sform_code', 0)
+        for name in ('srow_x','srow_y','srow_z'): set_field(header, endian, name, (0.,0.,0.,0.))
+        f.seek(0)
+        f.write(bytes(header))
+    finally: f.close(); header_forget(filename)
+def header_differences (filename, reference):
+    # differences of all 348 header bytes of filename and reference, as a list of
+    # "name: value / reference value" for the fields above and byte ranges otherwise
+    header, endian = read_header(filename)
+    other, other_endian = read_header(reference)
+    differences = []; known = np.zeros(348, dtype=bool)
+    for name in sorted(fields, key=lambda name: fields[name][0]):
+        offset, format = fields[name]
+        known[offset:offset+struct.calcsize('<'+format)] = True
+        value = get_field(header, endian, name); value_other = get_field(other, other_endian, name)
+        if value!=value_other: differences.append(name+': '+str(value)+' / '+str(value_other))
+    differ = np.array([header[i]!=other[i] for i in range(348)]) & ~known
+    for offset in np.nonzero(differ)[0]: 
+        differences.append('byte '+str(offset)+': '+str(header[offset])+' / '+str(other[offset]))
+    return differences
+def quatern_to_mat44 (quatern, qoffset, pixdim):
+    # qform matrix from the header parameters, as nifti1_io's nifti_quatern_to_mat44
+    b, c, d = [float(value) for value in quatern]
+    a = 1. - (b*b + c*c + d*d)
+    if a < 1.e-7: 
+        a = 1./np.sqrt(b*b + c*c + d*d); b *= a; c *= a; d *= a; a = 0.
+    else: a = np.sqrt(a)
+    qfac = -1. if pixdim[0] < 0 else 1.
+    xd, yd, zd = [value if value > 0 else 1. for value in pixdim[1:4]]
+    zd = qfac*zd
+    mat = np.identity(4)
+    mat[0,0:3] = [(a*a+b*b-c*c-d*d)*xd, 2.*(b*c-a*d)*yd, 2.*(b*d+a*c)*zd]
+    mat[1,0:3] = [2.*(b*c+a*d)*xd, (a*a+c*c-b*b-d*d)*yd, 2.*(c*d-a*b)*zd]
+    mat[2,0:3] = [2.*(b*d-a*c)*xd, 2.*(c*d+a*b)*yd, (a*a+d*d-c*c-b*b)*zd]
+    mat[0:3,3] = qoffset
+    return mat.astype(np.float32).astype(np.float64)
+def mat44_to_orientation (mat):
+    # orientation names of the voxel axes, as nifti1_io's nifti_mat44_to_orientation:
+    # the signed permutation closest to the (orthogonalized) matrix
+    Q = np.asarray(mat, dtype=np.float64)[0:3,0:3].copy()
+    for i in range(3):
+        for j in range(i): Q[:,i] -= np.dot(Q[:,j],Q[:,i])*Q[:,j]/np.dot(Q[:,j],Q[:,j])
+        if np.dot(Q[:,i],Q[:,i]) > 0: Q[:,i] /= np.sqrt(np.dot(Q[:,i],Q[:,i]))
+    detQ = np.linalg.det(Q)
+    best = None; best_value = -666.
+    for axes in itertools.permutations(range(3)):
+        for signs in itertools.product((1,-1), repeat=3):
+            P = np.zeros((3,3))
+            for i in range(3): P[axes[i],i] = signs[i]
+            if np.linalg.det(P)*detQ <= 0: continue # improper
+            value = np.trace(np.dot(P.T,Q))
+            if value > best_value: best_value = value; best = (axes, signs)
+    return tuple([orient_names[(best[0][i], best[1][i])] for i in range(3)])
+
+
+def set_display_range (filename, slab=16):
+    # minimum and maximum of the scaled voxel values of a .nii file, read slab
+    # by slab (memory mapped) and stored as cal_min/cal_max in the header (in place)
+    header, endian, data = _memmap(filename)
+    try:
+        lo = min([data[:,:,z:z+slab].min() for z in range(0, data.shape[2], slab)])
+        hi = max([data[:,:,z:z+slab].max() for z in range(0, data.shape[2], slab)])
+    finally: del data # close the memory map
+    slope = get_field(header, endian, 'scl_slope')
+    if slope!=0.: lo, hi = sorted([value*slope + get_field(header, endian, 'scl_inter') for value in (lo, hi)])
+    set_field(header, endian, 'cal_min', float(lo))
+    set_field(header, endian, 'cal_max', float(hi))
+    f = open(filename, 'r+b')
+    try: f.write(bytes(header))
+    finally: f.close(); header_forget(filename)
+    return float(lo), float(hi)
+class NiftiHeader(object):
+    # typed view of the fields of a .nii header that MRSpeCS needs, parsed
+    # from the fixed 348 header bytes only (no voxel data is read)
+    #   dims, pixdims:          (X,Y,Z) size in voxels and voxel size in mm
+    #   qform_code, sform_code: NIFTI xform codes (qform_name/sform_name for names)
+    #   qform, sform:           4x4 matrices as fslorient -getqform/-getsform
+    #   qform_orient, sform_orient: axis orientations as printed by fslhd
+    #   cal_min, cal_max:       display range (scaled values, see set_display_range)
+    def __init__(self, filename):
+        header, endian = read_header(filename)
+        self.filename = filename
+        self.endian = endian
+        dim = get_field(header, endian, 'dim')
+        pixdim = get_field(header, endian, 'pixdim')
+        self.dims = tuple([int(value) for value in dim[1:4]])
+        self.pixdims = tuple([float(value) for value in pixdim[1:4]])
+        self.datatype = get_field(header, endian, 'datatype')
+        self.cal_min = get_field(header, endian, 'cal_min')
+        self.cal_max = get_field(header, endian, 'cal_max')
+        self.qform_code = get_field(header, endian, 'qform_code')
+        self.sform_code = get_field(header, endian, 'sform_code')
+        self.qform_name = xform_names.get(self.qform_code, 'Unknown')
+        self.sform_name = xform_names.get(self.sform_code, 'Unknown')
+        if self.qform_code > 0:
+            self.qform = quatern_to_mat44(get_field(header, endian, 'quatern'),
+                                          get_field(header, endian, 'qoffset'), pixdim)
+        else: self.qform = np.diag([-self.pixdims[0], self.pixdims[1], self.pixdims[2], 1.])
+        if self.sform_code > 0:
+            self.sform = np.identity(4)
+            for i, name in enumerate(('srow_x','srow_y','srow_z')):
+                self.sform[i,:] = get_field(header, endian, name)
+        else: self.sform = np.diag([-self.pixdims[0], self.pixdims[1], self.pixdims[2], 1.])
+        self.qform_orient = mat44_to_orientation(self.qform)
+        self.sform_orient = mat44_to_orientation(self.sform)
+
+
+_header_cache = {}
+def header_info (filename):
+    # NiftiHeader of filename, cached until header_forget (the writers here call
+    # it, a file rewritten in between with the same size may keep its
+    # modification time, e.g. the in place header writes)
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), stat.st_mtime, stat.st_size)
+    header = _header_cache.get(key) # (cleared by another thread, e.g. a background report)
+    if header==None: header = _header_cache[key] = NiftiHeader(filename)
+    return header
+def header_forget (filename=None):
+    # drops the cached headers of filename, all with None (start of a run)
+    if filename==None: _header_cache.clear(); return
+    filename = os.path.abspath(filename)
+    for key in list(_header_cache):
+        if key[0]==filename: _header_cache.pop(key, None)
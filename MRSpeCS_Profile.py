@@ -0,0 +1,157 @@
+#
+# MRSpeCS_Profile - wall clock timing of the processing stages for MRSpeCS
+#
+# every pipeline stage and every external tool call is recorded as an event
+# (name, category, start, duration, thread) with its parent event: the event
+# open in the same thread, or the case event for threads of parallel stages
+# the events of a run are written as a nested JSON tree and as a Chrome
+# trace-event file (chrome://tracing, https://ui.perfetto.dev)
+# tool calls also get their CPU time and peak RSS (see tool_usage), with
+# trace_memory every event gets the peak of the memory allocated by Python
+# (tracemalloc, Python 3.9+) while it was open, stages and tool calls run in
+# parallel so this is the process wide peak, not only the event's own memory
+#
+# ----- VERSION HISTORY -----
+#
+# Version 0.1 - 18, October 2026
+#       - initial version, stages and tool calls, JSON and Chrome trace export
+#       - CPU time and peak RSS of tool calls, tracemalloc peaks
+#
+# ----- LICENSE -----
+#
+#    GPL, see details inside MRSpeCS.py
+#
+# ----- REQUIREMENTS -----
+#
+#    none (python standard library only)
+#
+
+from __future__ import print_function
+import os
+import sys
+import time
+import json
+import threading
+try: import tracemalloc # Python 3.4+
+except ImportError: tracemalloc = None
+
+
+events = [] # of the current run, in start order
+_local = threading.local() # open events per thread
+_root = [] # the first event of the run (parent of the events of other threads)
+_open = [] # events open in any thread (for the memory peaks)
+_memory = [] # True while tracemalloc was started by profile_reset
+_lock = threading.Lock()
+
+
+def profile_reset (trace_memory=False):
+    # start a new run, optionally with the tracemalloc peaks (where available)
+    profile_stop()
+    del events[:]; del _root[:]; del _open[:]
+    _local.stack = []
+    if trace_memory and tracemalloc!=None and hasattr(tracemalloc, 'reset_peak'):
+        if not tracemalloc.is_tracing(): tracemalloc.start(); _memory.append(True)
+def profile_stop ():
+    # stops tracemalloc if started by profile_reset
+    if len(_memory)>0: tracemalloc.stop(); del _memory[:]
+def _memory_checkpoint ():
+    # the traced peak since the last checkpoint goes to all open events
+    current, peak = tracemalloc.get_traced_memory()
+    for event in _open: event['memory_peak'] = max(event['memory_peak'], peak)
+    tracemalloc.reset_peak()
+    return current
+def profile_begin (name, category='stage', args=None):
+    # opens an event in the current thread, returns it for profile_end
+    stack = getattr(_local, 'stack', None)
+    if stack==None: stack = _local.stack = []
+    if len(stack)>0: parent = stack[-1]
+    elif len(_root)>0: parent = _root[0]
+    else: parent = None
+    event = {'name': name, 'category': category, 'start': time.time(), 'duration': None,
+             'thread': threading.current_thread().name, 'parent': parent, 'args': args or {}}
+    if parent==None: _root.append(event)
+    events.append(event); stack.append(event)
+    if len(_memory)>0:
+        _lock.acquire()
+        try: 
+            event['memory_start'] = event['memory_peak'] = _memory_checkpoint()
+            _open.append(event)
+        finally: _lock.release()
+    return event
+def profile_end (event):
+    # closes event (and events left open inside it, e.g. after an error)
+    event['duration'] = time.time()-event['start']
+    stack = getattr(_local, 'stack', [])
+    closed = [event]
+    if event in stack: closed = stack[stack.index(event):]; del stack[stack.index(event):]
+    if len(_memory)>0:
+        _lock.acquire()
+        try: 
+            _memory_checkpoint()
+            for event in closed: 
+                if event in _open: _open.remove(event)
+        finally: _lock.release()
+def tool_usage (event, usage):
+    # stores the resource usage of a tool call (os.wait4 rusage) in event:
+    # 'cpu_user', 'cpu_system' [s] and 'peak_rss' [bytes]
+    event['cpu_user'] = usage.ru_utime
+    event['cpu_system'] = usage.ru_stime
+    if sys.platform=='darwin': event['peak_rss'] = usage.ru_maxrss # bytes on MacOS
+    else: event['peak_rss'] = usage.ru_maxrss*1024 # kilobytes on linux
+def _resources (event):
+    # resources of event and its children: CPU time of the tool calls (sum),
+    # peak RSS of the tool calls and tracemalloc peak (maximum, if recorded)
+    resources = {}
+    for name in ('cpu_user', 'cpu_system', 'peak_rss', 'memory_peak'):
+        if name in event: resources[name] = event[name]
+    for child in events:
+        if not child['parent'] is event: continue
+        for name, value in _resources(child).items():
+            if name=='memory_peak' and 'memory_peak' in event: continue # includes the child's
+            if name.startswith('cpu'): resources[name] = resources.get(name, 0.)+value
+            else: resources[name] = max(resources.get(name, 0), value)
+    return resources
+def profile_tree (event=None):
+    # nested timings: list of {'name', 'category', 'start' (s from the first event),
+    # 'duration' (s, None if not finished), 'thread', 'args', 'children'}
+    # plus the resources (see _resources) 'cpu_user', 'cpu_system' [s],
+    # 'peak_rss' and 'memory_peak' [bytes], where recorded
+    if len(events)==0: return []
+    t0 = events[0]['start']
+    def node (event):
+        tree = {'name': event['name'], 'category': event['category'],
+                'start': event['start']-t0, 'duration': event['duration'],
+                'thread': event['thread'], 'args': event['args'],
+                'children': [node(child) for child in events if child['parent'] is event]}
+        tree.update(_resources(event))
+        return tree
+    return [node(root) for root in events if root['parent'] is event]
+def chrome_trace ():
+    # the events in Chrome trace-event format (complete events, one tid per thread)
+    if len(events)==0: return {'traceEvents': []}
+    t0 = events[0]['start']; pid = os.getpid()
+    threads = []
+    for event in events:
+        if not event['thread'] in threads: threads.append(event['thread'])
+    trace = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': thread}}
+             for tid, thread in enumerate(threads)]
+    for event in events:
+        duration = event['duration']
+        if duration==None: duration = time.time()-event['start'] # not finished (error)
+        args = event['args'].copy(); args.update(_resources(event))
+        trace.append({'name': event['name'], 'cat': event['category'], 'ph': 'X', 'pid': pid,
+                      'tid': threads.index(event['thread']),
+                      'ts': int(round((event['start']-t0)*1e6)), 'dur': int(round(duration*1e6)),
+                      'args': args})
+    return {'traceEvents': trace, 'displayTimeUnit': 'ms'}
+def trace_filename (filename):
+    # the Chrome trace next to the JSON file: <name>_trace.json
+    return os.path.splitext(filename)[0]+'_trace.json'
+def write_profile (filename):
+    # writes the nested timings (JSON) to filename and the Chrome trace to trace_filename
+    f = open(filename, 'w')
+    try: json.dump({'timings': profile_tree()}, f, indent=1)
+    finally: f.close()
+    f = open(trace_filename(filename), 'w')
+    try: json.dump(chrome_trace(), f)
+    finally: f.close()
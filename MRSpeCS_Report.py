@@ -8,6 +8,16 @@
 #
 # Version 0.1 - 10, July 2020
 #       - 1st public github Release
+# Version 0.2 - 18, October 2026
+#       - only the three slices shown are read (memory mapped, the T1 maximum
+#         from the header, cal_max), box extent in one pass, color lookup
+#         tables and intensity scaling computed once
+#       - MRSpeCS_Report_arrays, the report from data in memory (used by MRSpeCS.py)
+#       - MRSpeCS_Summary, one document with the thumbnails of many voxels (batch)
+#       - JPEG images at report_dpi with the ROI outline as vector graphics 
+#         instead of the PNG overlays
+#       - report_images/report_document, the images can be rendered before
+#         the fractions are known
 #
 # ----- LICENSE -----                 
 #
@@ -55,130 +65,265 @@ from fpdf import __version__ as fpdf_version
 
 
 
-def MRSpeCS_Report(T1_filename, Spectro_filename, Results_filename, PDF_filename):
-    
-    #define some color lookup tables    
-        
-    lut_gray = np.zeros ([256,3], dtype=np.uint8)
-    lut_gray  [:,0] = np.linspace(0, 255, num=256, endpoint=True)
-    lut_gray  [:,1] = lut_gray  [:,0]
-    lut_gray  [:,2] = lut_gray  [:,0]
-    lut_gray = lut_gray.astype(np.uint8)
-
-    lut_red  = np.zeros ([256,3], dtype=np.uint8)
-    lut_red [:,0] = np.linspace(0, 255, num=256, endpoint=True)
-    lut_red = lut_red.astype(np.uint8)
-
-    lut_green = np.zeros ([256,3], dtype=np.uint8)
-    lut_green[:,1] = np.linspace(0, 255, num=256, endpoint=True)
-    lut_green = lut_green.astype(np.uint8)
-
-    lut_blue = np.zeros ([256,3], dtype=np.uint8)
-    lut_blue[:,2] = np.linspace(0, 255, num=256, endpoint=True)
-    lut_blue = lut_blue.astype(np.uint8)
-
-    lut_yellow  = np.zeros ([256,3], dtype=np.uint8)
-    lut_yellow [:,0] = np.linspace(0, 255, num=256, endpoint=True)
-    lut_yellow [:,1] = lut_yellow [:,0]
-    lut_yellow = lut_yellow.astype(np.uint8)
-
-    lut_magenta = np.zeros ([256,3], dtype=np.uint8)
-    lut_magenta [:,0] = np.linspace(0, 255, num=256, endpoint=True)
-    lut_magenta [:,2] = lut_magenta [:,0]
-    lut_magenta = lut_magenta.astype(np.uint8)
-
-    lut_cyan = np.zeros ([256,3], dtype=np.uint8)
-    lut_cyan [:,1] = np.linspace(0, 255, num=256, endpoint=True)
-    lut_cyan [:,2] = lut_cyan [:,1]
-    lut_cyan = lut_cyan.astype(np.uint8)
-
-    #http://dicom.nema.org/medical/dicom/current/output/chtml/part06/chapter_B.html#sect_B.1.1
-    lut_hotiron = np.asarray([
-    [ 0, 0,0],[ 2, 0,0],[ 4, 0,0],[ 6, 0,0],[ 8, 0,0],[ 10,0,0],[ 12,0,0],[ 14,0,0],
-    [ 16,0,0],[ 18,0,0],[ 20,0,0],[ 22,0,0],[ 24,0,0],[ 26,0,0],[ 28,0,0],[ 30,0,0],
-    [ 32,0,0],[ 34,0,0],[ 36,0,0],[ 38,0,0],[ 40,0,0],[ 42,0,0],[ 44,0,0],[ 46,0,0],
-    [ 48,0,0],[ 50,0,0],[ 52,0,0],[ 54,0,0],[ 56,0,0],[ 58,0,0],[ 60,0,0],[ 62,0,0],
-    [ 64,0,0],[ 66,0,0],[ 68,0,0],[ 70,0,0],[ 72,0,0],[ 74,0,0],[ 76,0,0],[ 78,0,0],
-    [ 80,0,0],[ 82,0,0],[ 84,0,0],[ 86,0,0],[ 88,0,0],[ 90,0,0],[ 92,0,0],[ 94,0,0],
-    [ 96,0,0],[ 98,0,0],[100,0,0],[102,0,0],[104,0,0],[106,0,0],[108,0,0],[110,0,0],
-    [112,0,0],[114,0,0],[116,0,0],[118,0,0],[120,0,0],[122,0,0],[124,0,0],[126,0,0],
-    [128,0,0],[130,0,0],[132,0,0],[134,0,0],[136,0,0],[138,0,0],[140,0,0],[142,0,0],
-    [144,0,0],[146,0,0],[148,0,0],[150,0,0],[152,0,0],[154,0,0],[156,0,0],[158,0,0],
-    [160,0,0],[162,0,0],[164,0,0],[166,0,0],[168,0,0],[170,0,0],[172,0,0],[174,0,0],
-    [176,0,0],[178,0,0],[180,0,0],[182,0,0],[184,0,0],[186,0,0],[188,0,0],[190,0,0],
-    [192,0,0],[194,0,0],[196,0,0],[198,0,0],[200,0,0],[202,0,0],[204,0,0],[206,0,0],
-    [208,0,0],[210,0,0],[212,0,0],[214,0,0],[216,0,0],[218,0,0],[220,0,0],[222,0,0],
-    [224,0,0],[226,0,0],[228,0,0],[230,0,0],[232,0,0],[234,0,0],[236,0,0],[238,0,0],
-    [240,0,0],[242,0,0],[244,0,0],[246,0,0],[248,0,0],[250,0,0],[252,0,0],[254,0,0],
-    [255, 0, 0],[255, 2, 0],[255, 4, 0],[255, 6, 0],[255, 8, 0],[255, 10,0],[255, 12,0],[255, 14,0],
-    [255, 16,0],[255, 18,0],[255, 20,0],[255, 22,0],[255, 24,0],[255, 26,0],[255, 28,0],[255, 30,0],
-    [255, 32,0],[255, 34,0],[255, 36,0],[255, 38,0],[255, 40,0],[255, 42,0],[255, 44,0],[255, 46,0],
-    [255, 48,0],[255, 50,0],[255, 52,0],[255, 54,0],[255, 56,0],[255, 58,0],[255, 60,0],[255, 62,0],
-    [255, 64,0],[255, 66,0],[255, 68,0],[255, 70,0],[255, 72,0],[255, 74,0],[255, 76,0],[255, 78,0],
-    [255, 80,0],[255, 82,0],[255, 84,0],[255, 86,0],[255, 88,0],[255, 90,0],[255, 92,0],[255, 94,0],
-    [255, 96,0],[255, 98,0],[255,100,0],[255,102,0],[255,104,0],[255,106,0],[255,108,0],[255,110,0],
-    [255,112,0],[255,114,0],[255,116,0],[255,118,0],[255,120,0],[255,122,0],[255,124,0],[255,126,0],
-    [255,128,  4],[255,130,  8],[255,132, 12],[255,134, 16],[255,136, 20],[255,138, 24],[255,140, 28],[255,142, 32],
-    [255,144, 36],[255,146, 40],[255,148, 44],[255,150, 48],[255,152, 52],[255,154, 56],[255,156, 60],[255,158, 64],
-    [255,160, 68],[255,162, 72],[255,164, 76],[255,166, 80],[255,168, 84],[255,170, 88],[255,172, 92],[255,174, 96],
-    [255,176,100],[255,178,104],[255,180,108],[255,182,112],[255,184,116],[255,186,120],[255,188,124],[255,190,128],
-    [255,192,132],[255,194,136],[255,196,140],[255,198,144],[255,200,148],[255,202,152],[255,204,156],[255,206,160],
-    [255,208,164],[255,210,168],[255,212,172],[255,214,176],[255,216,180],[255,218,184],[255,220,188],[255,222,192],
-    [255,224,196],[255,226,200],[255,228,204],[255,230,208],[255,232,212],[255,234,216],[255,236,220],[255,238,224],
-    [255,240,228],[255,242,232],[255,244,236],[255,246,240],[255,248,244],[255,250,248],[255,252,252],[255,255,255]])
-    lut_hotiron = lut_hotiron.astype(np.uint8)
-
-    lut_rediron = lut_hotiron # alias
-
-    lut_greeniron  = np.zeros ([256,3], dtype=np.uint8)
-    lut_greeniron [:,0] = lut_hotiron [:,2]    
-    lut_greeniron [:,1] = lut_hotiron [:,0]  
-    lut_greeniron [:,2] = lut_hotiron [:,1] 
-
-    lut_blueiron  = np.zeros ([256,3], dtype=np.uint8)
-    lut_blueiron [:,0] = lut_hotiron [:,2]    
-    lut_blueiron [:,1] = lut_hotiron [:,1]  
-    lut_blueiron [:,2] = lut_hotiron [:,0]  
-
-    transparancy = 0.4 # 0.5 is half-transparent, 1.0 is not-transparent 
-
-    #read T1 Image 
-    try: img0 = nib.load(T1_filename)
-    except: print ("Error reading", T1_filemname); sys.exit(2)
-    data0 = np.asanyarray(img0.dataobj).astype(np.float32)
-    SpatResol = np.asarray(img0.header.get_zooms())
-    
-    #read SpectroBOX
-    try: img1 = nib.load(Spectro_filename)
-    except: print ("Error reading", Spectro_filemname); sys.exit(2)
-    data1 = np.asanyarray(img1.dataobj).astype(np.float32)
-    data1 /= np.max(data1) # normalize to 1.0
+#define some color lookup tables    
+
+lut_gray = np.zeros ([256,3], dtype=np.uint8)
+lut_gray  [:,0] = np.linspace(0, 255, num=256, endpoint=True)
+lut_gray  [:,1] = lut_gray  [:,0]
+lut_gray  [:,2] = lut_gray  [:,0]
+lut_gray = lut_gray.astype(np.uint8)
+
+lut_red  = np.zeros ([256,3], dtype=np.uint8)
+lut_red [:,0] = np.linspace(0, 255, num=256, endpoint=True)
+lut_red = lut_red.astype(np.uint8)
+
+lut_green = np.zeros ([256,3], dtype=np.uint8)
+lut_green[:,1] = np.linspace(0, 255, num=256, endpoint=True)
+lut_green = lut_green.astype(np.uint8)
+
+lut_blue = np.zeros ([256,3], dtype=np.uint8)
+lut_blue[:,2] = np.linspace(0, 255, num=256, endpoint=True)
+lut_blue = lut_blue.astype(np.uint8)
+
+lut_yellow  = np.zeros ([256,3], dtype=np.uint8)
+lut_yellow [:,0] = np.linspace(0, 255, num=256, endpoint=True)
+lut_yellow [:,1] = lut_yellow [:,0]
+lut_yellow = lut_yellow.astype(np.uint8)
+
+lut_magenta = np.zeros ([256,3], dtype=np.uint8)
+lut_magenta [:,0] = np.linspace(0, 255, num=256, endpoint=True)
+lut_magenta [:,2] = lut_magenta [:,0]
+lut_magenta = lut_magenta.astype(np.uint8)
+
+lut_cyan = np.zeros ([256,3], dtype=np.uint8)
+lut_cyan [:,1] = np.linspace(0, 255, num=256, endpoint=True)
+lut_cyan [:,2] = lut_cyan [:,1]
+lut_cyan = lut_cyan.astype(np.uint8)
+
+#http://dicom.nema.org/medical/dicom/current/output/chtml/part06/chapter_B.html#sect_B.1.1
+lut_hotiron = np.asarray([
+[ 0, 0,0],[ 2, 0,0],[ 4, 0,0],[ 6, 0,0],[ 8, 0,0],[ 10,0,0],[ 12,0,0],[ 14,0,0],
+[ 16,0,0],[ 18,0,0],[ 20,0,0],[ 22,0,0],[ 24,0,0],[ 26,0,0],[ 28,0,0],[ 30,0,0],
+[ 32,0,0],[ 34,0,0],[ 36,0,0],[ 38,0,0],[ 40,0,0],[ 42,0,0],[ 44,0,0],[ 46,0,0],
+[ 48,0,0],[ 50,0,0],[ 52,0,0],[ 54,0,0],[ 56,0,0],[ 58,0,0],[ 60,0,0],[ 62,0,0],
+[ 64,0,0],[ 66,0,0],[ 68,0,0],[ 70,0,0],[ 72,0,0],[ 74,0,0],[ 76,0,0],[ 78,0,0],
+[ 80,0,0],[ 82,0,0],[ 84,0,0],[ 86,0,0],[ 88,0,0],[ 90,0,0],[ 92,0,0],[ 94,0,0],
+[ 96,0,0],[ 98,0,0],[100,0,0],[102,0,0],[104,0,0],[106,0,0],[108,0,0],[110,0,0],
+[112,0,0],[114,0,0],[116,0,0],[118,0,0],[120,0,0],[122,0,0],[124,0,0],[126,0,0],
+[128,0,0],[130,0,0],[132,0,0],[134,0,0],[136,0,0],[138,0,0],[140,0,0],[142,0,0],
+[144,0,0],[146,0,0],[148,0,0],[150,0,0],[152,0,0],[154,0,0],[156,0,0],[158,0,0],
+[160,0,0],[162,0,0],[164,0,0],[166,0,0],[168,0,0],[170,0,0],[172,0,0],[174,0,0],
+[176,0,0],[178,0,0],[180,0,0],[182,0,0],[184,0,0],[186,0,0],[188,0,0],[190,0,0],
+[192,0,0],[194,0,0],[196,0,0],[198,0,0],[200,0,0],[202,0,0],[204,0,0],[206,0,0],
+[208,0,0],[210,0,0],[212,0,0],[214,0,0],[216,0,0],[218,0,0],[220,0,0],[222,0,0],
+[224,0,0],[226,0,0],[228,0,0],[230,0,0],[232,0,0],[234,0,0],[236,0,0],[238,0,0],
+[240,0,0],[242,0,0],[244,0,0],[246,0,0],[248,0,0],[250,0,0],[252,0,0],[254,0,0],
+[255, 0, 0],[255, 2, 0],[255, 4, 0],[255, 6, 0],[255, 8, 0],[255, 10,0],[255, 12,0],[255, 14,0],
+[255, 16,0],[255, 18,0],[255, 20,0],[255, 22,0],[255, 24,0],[255, 26,0],[255, 28,0],[255, 30,0],
+[255, 32,0],[255, 34,0],[255, 36,0],[255, 38,0],[255, 40,0],[255, 42,0],[255, 44,0],[255, 46,0],
+[255, 48,0],[255, 50,0],[255, 52,0],[255, 54,0],[255, 56,0],[255, 58,0],[255, 60,0],[255, 62,0],
+[255, 64,0],[255, 66,0],[255, 68,0],[255, 70,0],[255, 72,0],[255, 74,0],[255, 76,0],[255, 78,0],
+[255, 80,0],[255, 82,0],[255, 84,0],[255, 86,0],[255, 88,0],[255, 90,0],[255, 92,0],[255, 94,0],
+[255, 96,0],[255, 98,0],[255,100,0],[255,102,0],[255,104,0],[255,106,0],[255,108,0],[255,110,0],
+[255,112,0],[255,114,0],[255,116,0],[255,118,0],[255,120,0],[255,122,0],[255,124,0],[255,126,0],
+[255,128,  4],[255,130,  8],[255,132, 12],[255,134, 16],[255,136, 20],[255,138, 24],[255,140, 28],[255,142, 32],
+[255,144, 36],[255,146, 40],[255,148, 44],[255,150, 48],[255,152, 52],[255,154, 56],[255,156, 60],[255,158, 64],
+[255,160, 68],[255,162, 72],[255,164, 76],[255,166, 80],[255,168, 84],[255,170, 88],[255,172, 92],[255,174, 96],
+[255,176,100],[255,178,104],[255,180,108],[255,182,112],[255,184,116],[255,186,120],[255,188,124],[255,190,128],
+[255,192,132],[255,194,136],[255,196,140],[255,198,144],[255,200,148],[255,202,152],[255,204,156],[255,206,160],
+[255,208,164],[255,210,168],[255,212,172],[255,214,176],[255,216,180],[255,218,184],[255,220,188],[255,222,192],
+[255,224,196],[255,226,200],[255,228,204],[255,230,208],[255,232,212],[255,234,216],[255,236,220],[255,238,224],
+[255,240,228],[255,242,232],[255,244,236],[255,246,240],[255,248,244],[255,250,248],[255,252,252],[255,255,255]])
+lut_hotiron = lut_hotiron.astype(np.uint8)
+
+lut_rediron = lut_hotiron # alias
+
+lut_greeniron  = np.zeros ([256,3], dtype=np.uint8)
+lut_greeniron [:,0] = lut_hotiron [:,2]    
+lut_greeniron [:,1] = lut_hotiron [:,0]  
+lut_greeniron [:,2] = lut_hotiron [:,1] 
+
+lut_blueiron  = np.zeros ([256,3], dtype=np.uint8)
+lut_blueiron [:,0] = lut_hotiron [:,2]    
+lut_blueiron [:,1] = lut_hotiron [:,1]  
+lut_blueiron [:,2] = lut_hotiron [:,0]  
+
+transparancy = 0.4 # 0.5 is half-transparent, 1.0 is not-transparent 
+report_dpi = 100 # resolution of the images in the report as printed (not above the image's own)
+jpeg_quality = 85
+outline_color = (255, 255, 0) # yellow
+outline_width = 0.4 # [mm]
+
+
+
+def _plane (volume, lo, shape, axis, index):
+    # 2D plane at index along axis of an image of shape, volume covers the
+    # index range from lo (e.g. the sub-grid of the spectro box), zeros elsewhere
+    position = [slice(None)]*3; position[axis] = index-lo[axis]
+    sub = np.asarray(volume[tuple(position)])
+    other = [i for i in range(3) if i!=axis]
+    if sub.shape==tuple([shape[i] for i in other]): return sub
+    plane = np.zeros([shape[i] for i in other], dtype=sub.dtype)
+    plane[lo[other[0]]:lo[other[0]]+sub.shape[0], lo[other[1]]:lo[other[1]]+sub.shape[1]] = sub
+    return plane
+
+def _gray (T1_slice, T1_scaling, T1_max):
+    # T1 slice scaled to 0..255
+    if T1_scaling!=(1.,0.): T1_slice = T1_slice*T1_scaling[0]+T1_scaling[1]
+    return (T1_slice.astype(np.float32)/T1_max*255).astype(np.uint8)
+
+def _overlay (gray, BOX_slice, BOX_max):
+    # gray T1 slice with the transparent yellow ROI on top, RGB image
+    img0 = Image.fromarray(lut_gray[gray])
+    BOX_slice = BOX_slice.astype(np.float32)/BOX_max # normalize to 1.0
+    imgdata1 = (BOX_slice*255).astype(np.uint8)
+    img1 = Image.fromarray(lut_yellow[imgdata1])
+    alpha = (BOX_slice*255*transparancy).astype(np.uint8)
+    img0.paste(img1, (0,0), Image.fromarray(alpha))
+    return img0
+
+def _hull (mask):
+    # convex hull of the pixels of mask as polygon (row, column) of the pixel 
+    # corners, the intersection of the (convex) spectro box with the slice
+    rows = np.flatnonzero(mask.any(axis=1))
+    first = mask[rows].argmax(axis=1)
+    last = mask.shape[1]-1-mask[rows][:,::-1].argmax(axis=1)
+    points = set()
+    for row, column0, column1 in zip(rows, first, last):
+        for corner in ((row-.5, column0-.5), (row+.5, column0-.5), (row-.5, column1+.5), (row+.5, column1+.5)):
+            points.add((float(corner[0]), float(corner[1])))
+    points = sorted(points)
+    if len(points)<3: return points
+    def cross (o, a, b): return (a[0]-o[0])*(b[1]-o[1]) - (a[1]-o[1])*(b[0]-o[0])
+    lower = []; upper = [] # monotone chain
+    for point in points:
+        while len(lower)>=2 and cross(lower[-2], lower[-1], point)<=0: lower.pop()
+        lower.append(point)
+    for point in reversed(points):
+        while len(upper)>=2 and cross(upper[-2], upper[-1], point)<=0: upper.pop()
+        upper.append(point)
+    return lower[:-1]+upper[:-1]
+
+def _outlines (BOX_slice, BOX_max):
+    # polygons of the ROI in the slice: partial volume weights at half the
+    # maximum weight, binary boxes and label volumes one per label
+    if BOX_slice.dtype.kind=='f': masks = [BOX_slice>=BOX_max/2.]
+    else: masks = [BOX_slice==label for label in np.unique(BOX_slice[BOX_slice!=0])]
+    return [_hull(mask) for mask in masks if mask.any()]
+
+def _draw_outlines (pdf, polygons, shape, x, y, w, h):
+    # the polygons as lines over the image of shape (rows, columns) at x, y, w, h [mm]
+    pdf.set_draw_color(*outline_color)
+    pdf.set_line_width(outline_width)
+    for polygon in polygons:
+        points = [(x+(column+.5)*w/shape[1], y+(row+.5)*h/shape[0]) for row, column in polygon]
+        for i in range(len(points)):
+            (x1, y1), (x2, y2) = points[i-1], points[i]
+            pdf.line(float(x1), float(y1), float(x2), float(y2))
+
+def _printed (gray, w, h, dpi):
+    # gray image at dpi for a printed size of w, h [mm], not above its own resolution
+    img = Image.fromarray(gray)
+    size = (int(round(w/25.4*dpi)), int(round(h/25.4*dpi)))
+    if size[0]<img.size[0] or size[1]<img.size[1]: img = img.resize(size, Image.BILINEAR)
+    return img
+
+def _texts (fractions):
+    # the lines with the results, values that are None or missing are left empty
+    texts = ['CSF fraction = ', 'GM  fraction = ', 'WM  fraction = ', 'WCONC        = ']
+    if fractions==None: fractions = {}
+    for i, (name, format) in enumerate((('CSF','{:.3f}'), ('GM','{:.3f}'), ('WM','{:.3f}'), ('WCONC','{:.0f}'))):
+      if fractions.get(name)!=None: texts[i] += format.format(float(fractions[name]))
+    return texts
+
+def _add_image (pdf, img, name, x, y, w, h):
+    # img JPEG compressed
+    if fpdf_version<"2": #old version, write on disk
+      tempfile = '.overlay_'+name+'.jpg'
+      img.save(tempfile, 'jpeg', quality=jpeg_quality)
+    else: #new version, write in memory
+      tempfile = BytesIO()
+      img.save(tempfile, 'jpeg', quality=jpeg_quality)
+      tempfile.name = name+'.jpg'
+      tempfile.seek(0)
+    pdf.image(tempfile, x=float(x), y=float(y), w=float(w), h=float(h), type="jpg")
+    if fpdf_version<"2": os.remove(tempfile) #old version, delete tempfile    
 
-    #read results 
-    text0 = 'MRSpeCS Report'
-    text1 = 'CSF fraction = '
-    text2 = 'GM  fraction = ' 
-    text3 = 'WM  fraction = '
-    text4 = 'WCONC        = '
-    try:   
-      with open(Results_filename) as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter='\t')
-        line_count = 0
-        for row in csv_reader:
-          line_count += 1
-          if line_count == 3:
-            CSF   = float(row[0])
-            GM    = float(row[1])
-            WM    = float(row[2])
-            WCONC = float(row[3])
-      text1 += '{:.3f}'.format(CSF)    
-      text2 += '{:.3f}'.format(GM)    
-      text3 += '{:.3f}'.format(WM)    
-      text4 += '{:.0f}'.format(WCONC)              
-    except: pass    
+
+def report_planes (T1, zooms, BOX, BOX_lo=(0,0,0), T1_scaling=(1.,0.), T1_max=None):
+    # the axial, coronal and sagittal slices through the center of the ROI,
+    # arguments as MRSpeCS_Report_arrays, with T1_max given only these slices
+    # are read from T1, otherwise the whole T1 for its maximum
+    # returns a list of (name, T1 slice (0..255), BOX slice, BOX maximum, width, height [mm])
+    T1_scaling = (float(T1_scaling[0]), float(T1_scaling[1]))
+    shape = T1.shape[:3]
+    (X, Y, Z) = shape
+    (zx, zy, zz) = [float(value) for value in zooms[:3]]
+
+    # ROI extent (planes that contain ROI) and maximum in one pass
+    nonzero = np.nonzero(BOX)
+    if len(nonzero[0])==0: raise ValueError('no ROI intersection found')
+    BOX_max = np.float32(np.max(BOX[nonzero]))
+    (xs, ys, zs) = [np.unique(indices)+BOX_lo[i] for i, indices in enumerate(nonzero)]
+    del nonzero
+
+    # intensity scaling (maximum of the scaled T1)
+    if T1_max==None:
+        if T1_scaling[0]>=0: T1_max = np.max(T1)
+        else: T1_max = np.min(T1)
+        T1_max = float(T1_max)*T1_scaling[0]+T1_scaling[1]
+    T1_max = np.float32(T1_max)
+
+    # center slices that contain ROI 
+    x = xs[int(len(xs)/2)]
+    y = ys[len(ys)-1-int(len(ys)/2)] # counted from anterior
+    z = zs[int(len(zs)/2)]
+    def planes (axis, index): # T1 and BOX plane, rows from superior/anterior
+        T1_plane = _plane(T1, (0,0,0), shape, axis, index)[:,::-1].T
+        BOX_plane = _plane(BOX, BOX_lo, shape, axis, index)[:,::-1].T
+        return _gray(T1_plane, T1_scaling, T1_max), BOX_plane, BOX_max
+    return [('axi'+str(z),)+planes(2, z)+(X*zx, Y*zy),
+            ('cor'+str(y),)+planes(1, y)+(X*zx, Z*zz),
+            ('sag'+str(x),)+planes(0, x)+(Y*zy, Z*zz)]
+
+def report_views (T1, zooms, BOX, BOX_lo=(0,0,0), T1_scaling=(1.,0.), T1_max=None):
+    # the slices of report_planes with the transparent yellow ROI on top (thumbnails),
+    # returns a list of (name, RGB image, width, height [mm])
+    return [(name, _overlay(gray, BOX_plane, BOX_max), width, height) 
+            for name, gray, BOX_plane, BOX_max, width, height in report_planes(T1, zooms, BOX, BOX_lo, T1_scaling, T1_max)]
+
+def report_images(T1, zooms, BOX, BOX_lo=(0,0,0), T1_scaling=(1.,0.), dpi=None, T1_max=None):
+    # the images of the report (see MRSpeCS_Report_arrays), everything but the
+    # fractions, so they can be rendered before these are measured (see report_document)
+    # returns a list of (name, image, outline polygons, slice shape, x, width, height [mm])
+    if dpi==None: dpi = report_dpi
+    planes = report_planes(T1, zooms, BOX, BOX_lo, T1_scaling, T1_max)
+
+    # image positioning
+    xoffset=10
+    (X, Y, Z) = T1.shape[:3]
+    (zx, zy, zz) = [float(value) for value in zooms[:3]]
+    width1 = X*zx / Y*zy 
+    width2 = X*zx / Z*zz
+    width3 = Y*zy / Z*zz
+    tot_w = width1+width2+width3
+    width1 = width1/tot_w*190
+    width2 = width2/tot_w*190
+    width3 = width3/tot_w*190
+
+    height1 = width1 * Y/X * zy/zx
+    height2 = width2 * Z/X * zz/zx
+    height3 = width3 * Z/Y * zz/zy
+    positions = [(xoffset, width1, height1), (width1+xoffset, width2, height2), (width1+width2+xoffset, width3, height3)]
+
+    # axial, coronal, sagital
+    return [(name, _printed(gray, width, height, dpi), _outlines(BOX_plane, BOX_max), gray.shape, xpos, width, height)
+            for (name, gray, BOX_plane, BOX_max, w, h), (xpos, width, height) in zip(planes, positions)]
+
+def report_document(images, fractions, PDF_filename):
+    # the PDF report from the images of report_images and the fractions
+    texts = _texts(fractions)
     
- 
-  
     #write PDF header
     pdf = FPDF('P','mm','A4')
     pdf.add_page()
@@ -186,179 +331,128 @@ def MRSpeCS_Report(T1_filename, Spectro_filename, Results_filename, PDF_filename
     pdf.cell(200, 45, txt='MRSpeCS Report', ln=1, align="C")
     pdf.set_font("Courier", 'B', size=12)
     pdf.set_text_color(90, 90, 90)
-    pdf.cell(200, 5, txt=text1, ln=1, align="L")
+    pdf.cell(200, 5, txt=texts[0], ln=1, align="L")
     pdf.set_text_color(75, 75, 75)    
-    pdf.cell(200, 5, txt=text2, ln=1, align="L")
+    pdf.cell(200, 5, txt=texts[1], ln=1, align="L")
     pdf.set_text_color(55, 55, 55)      
-    pdf.cell(200, 5, txt=text3, ln=1, align="L")
+    pdf.cell(200, 5, txt=texts[2], ln=1, align="L")
     pdf.set_text_color(55, 55, 200)        
-    pdf.cell(200, 5, txt=text4, ln=1, align="L")
+    pdf.cell(200, 5, txt=texts[3], ln=1, align="L")
     
-    # image positioning
-    xoffset=10
     yoffset=80
-    width=64 
-    width1 = data0.shape[0]*SpatResol[0] / data0.shape[1]*SpatResol[1] 
-    width2 = data0.shape[0]*SpatResol[0] / data0.shape[2]*SpatResol[2]
-    width3 = data0.shape[1]*SpatResol[1] / data0.shape[2]*SpatResol[2]
-    tot_w = width1+width2+width3
-    width1 = width1/tot_w*190
-    width2 = width2/tot_w*190
-    width3 = width3/tot_w*190
-    #print (width1,width2,width3)
-    #print (width1+width2+width3)
-    #height1 = width1 / (data0.shape[0]*SpatResol[0] / data0.shape[1]*SpatResol[1])
-    #height2 = width2 / (data0.shape[0]*SpatResol[0] / data0.shape[2]*SpatResol[2])
-    #height3 = width3 / (data0.shape[1]*SpatResol[1] / data0.shape[2]*SpatResol[2])
-    #print (height1,height2,height3)
-
-    
-    # --------------------------------------- AXIAL ----------------------------------------------
+    for name, img, polygons, shape, xpos, width, height in images:
+      _add_image (pdf, img, name, xpos, yoffset, width, height)
+      _draw_outlines (pdf, polygons, shape, xpos, yoffset, width, height)
+        
+    pdf.output(PDF_filename)
 
-    # transformations
-    data0 = np.rot90(data0, axes=(0,1))
-    data1 = np.rot90(data1, axes=(0,1))
-    SpatResol[1], SpatResol[0] = SpatResol[0], SpatResol[1]
-    
-    # find slices that contain ROI 
-    slices=[]
-    for slice in range (0,data0.shape[2]):
-      if len(np.nonzero(data1[:,:,slice])[0])>0: slices.append(slice)
-    if len(slices)==0: print("ERROR: no ROI intersection found"); sys.exit(1) 
-    else: slice = slices[int(len(slices)/2)] # center slice
-    
-    height1=width1 * data0.shape[0]/data0.shape[1] * SpatResol[0]/SpatResol[1]
-
-    imgdata0 = data0[:,:,slice]/np.max(data0)*255
-    imgdata0 = imgdata0.astype(np.uint8)
-    imgdata0  = lut_gray[imgdata0]
-    imgdata0 = np.append (imgdata0, np.zeros([imgdata0.shape[0],imgdata0.shape[1],1], dtype=np.uint8),axis=2)
-    imgdata0[:,:,3]=255 # but don't use it
-    img0 = Image.fromarray(imgdata0)
-    
-    imgdata1 = data1[:,:,slice]/np.max(data1)*255
-    imgdata1 = imgdata1.astype(np.uint8)
-    imgdata1  = lut_yellow[imgdata1]
-    imgdata1 = np.append (imgdata1, np.zeros([imgdata1.shape[0],imgdata1.shape[1],1], dtype=np.uint8),axis=2)
-    alpha = data1[:,:,slice]/np.max(data1)*255*transparancy
-    alpha = alpha.astype(np.uint8)
-    imgdata1[:,:,3] = alpha 
-    img1 = Image.fromarray(imgdata1)    
-    
-    img0.paste(img1, (0,0), img1)
-    img0 = img0.convert ("RGB") # remove alpha channel
-    if fpdf_version<"2": #old version, write on disk
-      tempfile = '.overlay_axi'+str(slice)+'.png'
-      img0.save(tempfile)
-    else: #new version, write in memory
-      tempfile = BytesIO()
-      img0.save(tempfile, 'png')
-      tempfile.name = 'test.png'
-      tempfile.seek(0)
-    xpos=xoffset
-    ypos=yoffset
-    pdf.image(tempfile, x = xpos, y=ypos, w = width1, h=height1, type="png")
-    if fpdf_version<"2": os.remove(tempfile) #old version, delete tempfile    
+def MRSpeCS_Report_arrays(T1, zooms, BOX, fractions, PDF_filename, BOX_lo=(0,0,0), T1_scaling=(1.,0.), dpi=None, T1_max=None):
+    # the report from data already in memory (or memory mapped), indexed [x,y,z]:
+    #    T1:         image voxel values, unscaled with T1_scaling=(slope, intercept)
+    #    zooms:      voxel size [mm]
+    #    BOX:        spectro box (binary, weights or labels), the whole image or 
+    #                a sub-grid starting at index BOX_lo
+    #    fractions:  dictionary with 'CSF', 'GM', 'WM', 'WCONC' (None or missing 
+    #                values are left empty, e.g. without segmentation)
+    #    dpi:        resolution of the images as printed (default report_dpi)
+    #    T1_max:     maximum of the scaled T1 (gray scale), e.g. the cal_max stored
+    #                by MRSpeCS, without it the whole T1 is read once for it
+    # otherwise only the center slices of the ROI are read from T1, the images are
+    # JPEG compressed with the ROI outlines drawn on top (vector graphics)
+    # raises ValueError if BOX is empty
+    report_document(report_images(T1, zooms, BOX, BOX_lo, T1_scaling, dpi, T1_max), fractions, PDF_filename)
+
+
+def MRSpeCS_Report(T1_filename, Spectro_filename, Results_filename, PDF_filename, dpi=None):
+    # the report from the files, the results are the first line (third row)
+    # of the results file, see MRSpeCS_Report_arrays
+
+    #read T1 Image (memory mapped for .nii, only the slices shown are read if cal_max is set)
+    try: img0 = nib.load(T1_filename)
+    except: print ("Error reading", T1_filename); sys.exit(2)
     
+    #read SpectroBOX
+    try: img1 = nib.load(Spectro_filename)
+    except: print ("Error reading", Spectro_filename); sys.exit(2)
 
-    # --------------------------------------- CORONAL ----------------------------------------------
-
-
-    # transformations
-    data0 = np.rot90(data0, axes=(1,2))
-    data1 = np.rot90(data1, axes=(1,2))
-    SpatResol[2], SpatResol[1] = SpatResol[1], SpatResol[2]
-
-    # find slices that contain ROI 
-    slices=[]
-    for slice in range (0,data0.shape[0]):
-      if len(np.nonzero(data1[slice,:,:])[0])>0: slices.append(slice)
-    if len(slices)==0: print("ERROR: no ROI intersection found"); sys.exit(1) 
-    else: slice = slices[int(len(slices)/2)] # center slice  
-     
-    height2=width2 * data0.shape[1]/data0.shape[2] * SpatResol[1]/SpatResol[2]
-
-    imgdata0 = data0[slice,:,:]/np.max(data0)*255
-    imgdata0 = imgdata0.astype(np.uint8)
-    imgdata0  = lut_gray[imgdata0]
-    imgdata0 = np.append (imgdata0, np.zeros([imgdata0.shape[0],imgdata0.shape[1],1], dtype=np.uint8),axis=2)
-    imgdata0[:,:,3]=255 # but don't use it
-    img0 = Image.fromarray(imgdata0)
-    
-    imgdata1 = data1[slice,:,:]/np.max(data1)*255
-    imgdata1 = imgdata1.astype(np.uint8)
-    imgdata1  = lut_yellow[imgdata1]
-    imgdata1 = np.append (imgdata1, np.zeros([imgdata1.shape[0],imgdata1.shape[1],1], dtype=np.uint8),axis=2)
-    alpha = data1[slice,:,:]/np.max(data1)*255*transparancy
-    alpha = alpha.astype(np.uint8)
-    imgdata1[:,:,3] = alpha 
-    img1 = Image.fromarray(imgdata1)     
-    
-    img0.paste(img1, (0,0), img1)
-    img0 = img0.convert ("RGB") # remove alpha channel
-    if fpdf_version<"2": #old version, write on disk
-      tempfile = '.overlay_cor'+str(slice)+'.png'
-      img0.save(tempfile)
-    else: #new version, write in memory
-      tempfile = BytesIO()
-      img0.save(tempfile, 'png')
-      tempfile.name = 'test.png'
-      tempfile.seek(0)    
-    xpos=width1 + xoffset
-    ypos=yoffset
-    pdf.image(tempfile, x = xpos, y=ypos, w = width2, h=height2, type="png")
-    if fpdf_version<"2": os.remove(tempfile) #old version, delete tempfile  
-
-
-    # --------------------------------------- SAGITAL RIGHT ----------------------------------------
-
-    # transformations
-    data0 = np.rot90(data0, axes=(0,1),k=3)
-    data1 = np.rot90(data1, axes=(0,1),k=3)
-    SpatResol[1], SpatResol[0] = SpatResol[0], SpatResol[1]
-
-    # find slices that contain ROI 
-    slices=[]
-    for slice in range (0,data0.shape[2]):
-      if len(np.nonzero(data1[:,:,slice])[0])>0: slices.append(slice)
-    if len(slices)==0: print("ERROR: no ROI intersection found"); sys.exit(1) 
-    else: slice = slices[int(len(slices)/2)] # center slice         
-    
-    height3=width3 * data0.shape[0]/data0.shape[1] * SpatResol[0]/SpatResol[1]
-    
-    imgdata0 = data0[:,:,slice]/np.max(data0)*255
-    imgdata0 = imgdata0.astype(np.uint8)
-    imgdata0  = lut_gray[imgdata0]
-    imgdata0 = np.append (imgdata0, np.zeros([imgdata0.shape[0],imgdata0.shape[1],1], dtype=np.uint8),axis=2)
-    imgdata0[:,:,3]=255 # but don't use it
-    img0 = Image.fromarray(imgdata0)
-    
-    imgdata1 = data1[:,:,slice]/np.max(data1)*255
-    imgdata1 = imgdata1.astype(np.uint8)
-    imgdata1  = lut_yellow[imgdata1]
-    imgdata1 = np.append (imgdata1, np.zeros([imgdata1.shape[0],imgdata1.shape[1],1], dtype=np.uint8),axis=2)
-    alpha = data1[:,:,slice]/np.max(data1)*255*transparancy
-    alpha = alpha.astype(np.uint8)
-    imgdata1[:,:,3] = alpha 
-    img1 = Image.fromarray(imgdata1)    
+    #read results 
+    fractions = {}
+    try:   
+      with open(Results_filename) as csv_file:
+        csv_reader = csv.reader(csv_file, delimiter='\t')
+        line_count = 0
+        for row in csv_reader:
+          line_count += 1
+          if line_count == 3:
+            fractions = {'CSF': float(row[0]), 'GM': float(row[1]), 'WM': float(row[2]), 'WCONC': float(row[3])}
+    except: pass    
     
-    img0.paste(img1, (0,0), img1)
-    img0 = img0.convert ("RGB") # remove alpha channel
-    if fpdf_version<"2": #old version, write on disk
-      tempfile = '.overlay_sag'+str(slice)+'.png'
-      img0.save(tempfile)
-    else: #new version, write in memory
-      tempfile = BytesIO()
-      img0.save(tempfile, 'png')
-      tempfile.name = 'test.png'
-      tempfile.seek(0)    
-    xpos=width1 + width2 + xoffset
-    ypos=yoffset
-    pdf.image(tempfile, x = xpos, y=ypos, w = width3, h=height3, type="png")
-    if fpdf_version<"2": os.remove(tempfile) #old version, delete tempfile  
-
-         
-        
+    T1_max = None # display range stored by MRSpeCS, the whole T1 is read without
+    if img0.header['cal_max']>img0.header['cal_min']: T1_max = float(img0.header['cal_max'])
+    try: MRSpeCS_Report_arrays (img0.dataobj.get_unscaled(), img0.header.get_zooms(), img1.dataobj.get_unscaled(), 
+                           fractions, PDF_filename, T1_scaling=(img0.dataobj.slope, img0.dataobj.inter), dpi=dpi, T1_max=T1_max)
+    except ValueError as error: print ("ERROR:", error); sys.exit(1)
+
+
+
+
+def report_thumbnails (views, height=160, quality=85):
+    # the views (see report_views) scaled to height pixels and JPEG encoded in
+    # memory, returns a list of (JPEG data, width, height [mm]) for MRSpeCS_Summary
+    thumbnails = []
+    for name, img, width_mm, height_mm in views:
+        size = (max(1, int(round(height*width_mm/height_mm))), height)
+        stream = BytesIO()
+        img.resize(size, Image.BILINEAR).save(stream, 'jpeg', quality=quality)
+        thumbnails.append((stream.getvalue(), width_mm, height_mm))
+    return thumbnails
+
+def MRSpeCS_Summary(rows, PDF_filename, title='MRSpeCS Summary'):
+    # one document with a row per spectro voxel: name, fractions and the 
+    # thumbnails of the axial, coronal and sagittal views, rows is a list of
+    # dictionaries with 'name', 'fractions' (see MRSpeCS_Report_arrays),
+    # 'thumbnails' (see report_thumbnails, None if not available) and 'status'
+    row_height = 32; image_height = 28; image_space = 128 # [mm]
+    pdf = FPDF('P','mm','A4')
+    pdf.set_auto_page_break(False)
+    for number, row in enumerate(rows):
+      ypos = 25+(number%8)*row_height
+      if number%8==0: # new page with title
+        pdf.add_page()
+        pdf.set_font("Arial", size=14)
+        pdf.set_text_color(0, 0, 0)
+        pdf.set_xy(10, 10)
+        pdf.cell(190, 8, txt=title+'   ('+str(len(rows))+' voxels, page '+str(int(number/8)+1)+')', ln=1, align="L")
+      # name and results
+      pdf.set_xy(10, ypos)
+      pdf.set_font("Arial", 'B', size=8)
+      pdf.set_text_color(0, 0, 0)
+      name = row['name']
+      while len(name)>4 and pdf.get_string_width(name)>60: name = '...'+name[4:]
+      pdf.cell(60, 4, txt=name, ln=2, align="L")
+      pdf.set_font("Courier", 'B', size=8)
+      for text, color in zip(_texts(row.get('fractions')), (90, 75, 55, None)):
+        if color==None: pdf.set_text_color(55, 55, 200)
+        else: pdf.set_text_color(color, color, color)
+        pdf.cell(60, 4, txt=text, ln=2, align="L")
+      if row.get('status', 'done')!='done':
+        pdf.set_text_color(200, 0, 0)
+        pdf.cell(60, 4, txt=str(row['status'])[:40], ln=2, align="L")
+      # thumbnails, scaled down to the space available
+      thumbnails = row.get('thumbnails') or []
+      widths = [image_height*width/height for data, width, height in thumbnails]
+      scale = min(1., image_space/max(sum(widths), 1e-6))
+      xpos = 72
+      for i, (data, width, height) in enumerate(thumbnails):
+        if fpdf_version<"2": #old version, write on disk
+          tempfile = '.thumbnail'+str(os.getpid())+'_'+str(i)+'.jpg'
+          f = open(tempfile, 'wb'); f.write(data); f.close()
+        else: #new version, from memory
+          tempfile = BytesIO(data)
+          tempfile.name = 'thumbnail'+str(i)+'.jpg'
+        pdf.image(tempfile, x=float(xpos), y=float(ypos), w=float(widths[i]*scale), h=float(image_height*scale), type="jpg")
+        if fpdf_version<"2": os.remove(tempfile) #old version, delete tempfile
+        xpos += widths[i]*scale+1
     pdf.output(PDF_filename)
 
 
@@ -369,5 +463,4 @@ def main():
     if sys.platform=="win32": os.system("pause") # windows
         
 if __name__ == '__main__':
-    main()        
-        
+    main()
@@ -13,14 +13,9 @@ for d in a.datas:
     if 'pyconfig' in d[0]: 
         a.datas.remove(d)
         break             
-a.binaries += [('avscale.exe', 'avscale.exe', 'DATA')]
-a.binaries += [('fslhd.exe', 'fslhd.exe', 'DATA')]
-a.binaries += [('fslmaths.exe', 'fslmaths.exe', 'DATA')]
-a.binaries += [('fslmeants.exe', 'fslmeants.exe', 'DATA')]
 a.binaries += [('fslorient.exe', 'fslorient.exe', 'DATA')]
 a.binaries += [('fslswapdim.exe', 'fslswapdim.exe', 'DATA')]
 a.binaries += [('bet2.exe', 'bet2.exe', 'DATA')]
-a.binaries += [('convert_xfm.exe', 'convert_xfm.exe', 'DATA')]
 a.binaries += [('cygwin1.dll', 'cygwin1.dll', 'DATA')]
 a.binaries += [('dcm2nii.exe', 'dcm2nii.exe', 'DATA')]
 a.binaries += [('fast.exe', 'fast.exe', 'DATA')]